@@ -4,12 +4,13 @@ from django.contrib.auth.models import Group, AbstractBaseUser, \
     PermissionsMixin, BaseUserManager
 from django.core.validators import RegexValidator
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch.dispatcher import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from cts.utils import uniqid
+from cts.versions import USERS, bump_versions
 
 # Role implementation notes:
 
@@ -256,3 +257,12 @@ def create_api_token(sender, instance=None, created=False, **kwargs):
     from rest_framework.authtoken.models import Token
     if created:
         Token.objects.create(user=instance)
+
+
+@receiver(post_save, sender=CtsUser)
+@receiver(post_delete, sender=CtsUser)
+def bump_users_version(update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        # Just someone logging in
+        return
+    bump_versions(USERS)
@@ -8,7 +8,7 @@ from accounts.utils import bootstrap_permissions
 
 
 class BaseAPITest(TestCase):
-    def call_api(self, url, token=None):
+    def call_api(self, url, token=None, **extra):
         """
         Call API with auth and return the response object
         Assumes self.email and self.password exist.
@@ -27,6 +27,7 @@ class BaseAPITest(TestCase):
         return self.client.get(url,
                                HTTP_ACCEPT='application/json',
                                HTTP_AUTHORIZATION=auth_header,
+                               **extra
                                )
 
     def post_api(self, url, data, token=None):
@@ -86,6 +87,32 @@ class APITest(BaseAPITest):
         rsp = self.call_api('/api/auth/users/')
         self.assertEqual(403, rsp.status_code)
 
+    def test_not_modified(self):
+        other = CtsUserFactory()
+        rsp = self.call_api('/api/auth/users/')
+        etag = rsp['ETag']
+        rsp = self.call_api('/api/auth/users/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, rsp.status_code)
+        self.assertEqual(etag, rsp['ETag'])
+        # Not for another user, who might see different data
+        rsp = self.call_api('/api/auth/users/', token=other.auth_token.key,
+                            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, rsp.status_code)
+        # Nor once the data has changed
+        other.name = "Somebody Else"
+        other.save()
+        rsp = self.call_api('/api/auth/users/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, rsp.status_code)
+
+    def test_not_modified_without_cookies(self):
+        # Token clients often don't keep cookies between requests
+        rsp = self.call_api('/api/auth/users/')
+        etag = rsp['ETag']
+        self.assertNotIn('csrftoken', rsp.cookies)
+        self.client.cookies.clear()
+        rsp = self.call_api('/api/auth/users/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, rsp.status_code)
+
     def test_post_user(self):
         # The API is read-only. Any POST should return a 405
         user = CtsUserFactory(name="barney fife")
@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.utils.decorators import method_decorator
 import django_filters
 
 from rest_framework import permissions, viewsets, serializers
@@ -6,6 +7,7 @@ from rest_framework.serializers import ModelSerializer
 
 from catalog.models import CatalogItem, Transporter, ItemCategory, Donor, Supplier, \
     DonorCode
+from cts.conditional import conditional_on_versions
 from shipments.models import Shipment, Package, PackageItem, Kit, PackageScan
 
 
@@ -27,6 +29,18 @@ class CTSViewSet(viewsets.ReadOnlyModelViewSet):
     # Django REST Framework will enforce Django model permissions on the API
     permission_classes = [CTSPermissions]
 
+    # Answer clients that already have the current data with 304 Not
+    # Modified. These run after authentication and the permission checks.
+    # The responses have no CSRF token in them, and token clients often
+    # don't keep cookies.
+    @method_decorator(conditional_on_versions(csrf=False))
+    def list(self, request, *args, **kwargs):
+        return super(CTSViewSet, self).list(request, *args, **kwargs)
+
+    @method_decorator(conditional_on_versions(csrf=False))
+    def retrieve(self, request, *args, **kwargs):
+        return super(CTSViewSet, self).retrieve(request, *args, **kwargs)
+
 
 # Keep the following classes in alphabetical order, please.
 
@@ -4,8 +4,11 @@ from decimal import Decimal
 from django.conf import settings
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from cts.utils import USDCurrencyField
+from cts.versions import CATALOG, bump_versions
 from currency.currencies import format_currency, quantize_local
 
 
@@ -154,3 +157,10 @@ class ItemCategory(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_catalog_version(sender, **kwargs):
+    if sender in (DonorCode, Donor, Supplier, Transporter, CatalogItem, ItemCategory):
+        bump_versions(CATALOG)
@@ -3,10 +3,10 @@ import xlrd
 
 from collections import OrderedDict
 
-from django.db import transaction
 from django.forms.utils import ErrorDict
 
 from catalog.forms import CatalogItemImportForm
+from reports.signals import bulk_updates
 
 
 IMPORT_COLUMN_NAMES = [
@@ -121,7 +121,7 @@ def _catalog_import_from_simple_sheet(sheet):
     num_new = 0
     errors = []
     # import all, or none
-    with transaction.atomic():
+    with bulk_updates():
         for row_number, values in sheet.rows():
             try:
                 num_new += 1
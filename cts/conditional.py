@@ -0,0 +1,83 @@
+"""
+Conditional GETs, for views whose responses only change when the data does.
+
+The ETag of a response is made from the data versions (see cts.versions),
+the user, their session and anything else the response depends on, so a
+client that already has the current response gets a 304 Not Modified
+instead, before the view runs any queries of its own.
+
+Use conditional_on_versions() to decorate a view function, or, with
+Django's method_decorator(), a class-based view's get() (so that the
+view's login and permission checks still come first). Pass csrf=False for
+views whose responses have no CSRF token in them, like the API's, whose
+clients often don't keep cookies.
+"""
+from functools import wraps
+import hashlib
+
+from django.contrib.messages import get_messages
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from cts.versions import DOMAINS, versions_tag
+
+
+# Request headers that can change the response for the same URL: reports
+# answer AJAX requests with just their table, and the API picks its
+# format from the Accept header.
+VARY_HEADERS = ('X-Requested-With', 'Accept')
+
+
+def data_etag(request, domains=DOMAINS, csrf=True):
+    """
+    Return the ETag for the response to the request as of the current
+    versions of the data domains, or None if the response mustn't be
+    skipped (if there are messages waiting to be shown in it).
+
+    With csrf=False, the ETag doesn't depend on the session or the CSRF
+    token, which a client without cookies gets a new one of every time.
+    """
+    if csrf and len(get_messages(request)):
+        return None
+    user = request.user
+    parts = [
+        versions_tag(domains),
+        # Whose data they can see, and the menus they get
+        user.pk if user.is_authenticated() else None,
+    ]
+    if csrf:
+        # Pages have the CSRF token in them
+        parts.extend([request.session.session_key, get_token(request)])
+    parts.extend(request.META.get('HTTP_' + name.upper().replace('-', '_'))
+                 for name in VARY_HEADERS)
+    return hashlib.md5(repr(parts)).hexdigest()
+
+
+def conditional_on_versions(*domains, **options):
+    """
+    Decorator for a GET view whose response only depends on the user and the
+    data in the given domains (default all of them). Adds an ETag to its
+    responses, and answers requests that already have the current one with
+    304 Not Modified without calling the view.
+
+    Pass csrf=False if the response has no CSRF token or messages in it.
+    """
+    domains = domains or DOMAINS
+    csrf = options.pop('csrf', True)
+
+    def etag_func(request, *args, **kwargs):
+        return data_etag(request, domains, csrf)
+
+    def decorator(view_func):
+        conditional_view = condition(etag_func=etag_func)(view_func)
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_vary_headers(response, VARY_HEADERS)
+            # It's only for this user
+            patch_cache_control(response, private=True)
+            return response
+        return wrapper
+    return decorator
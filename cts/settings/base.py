@@ -292,6 +292,20 @@ CELERYBEAT_SCHEDULE = {
             'expires': 50*50,  # 50 minutes
         }
     },
+    'mark_overdue_packages': {
+        'task': 'shipments.tasks.mark_overdue_packages',
+        'schedule': timedelta(hours=1),
+        'options': {
+            'expires': 50*60,  # 50 minutes
+        }
+    },
+    'delete_old_exports': {
+        'task': 'reports.tasks.delete_old_exports',
+        'schedule': timedelta(hours=6),
+        'options': {
+            'expires': 5*60*60,  # 5 hours
+        }
+    },
 }
 CELERY_RESULT_BACKEND = None  # We never care about task results
 # Each instance needs its own queue
@@ -301,6 +315,24 @@ CELERY_DEFAULT_QUEUE = 'queue_%s' % INSTANCE
 SENDFILE_URL = "/protected/"
 SENDFILE_BACKEND = 'sendfile.backends.development'
 
+# How the Ona API is reached (the domain and token are per instance), and how
+# many form submissions to get from it at a time
+ONA_API_SCHEME = 'https'
+ONA_PAGE_SIZE = 1000
+# Seconds to wait for Ona to connect, and then to answer
+ONA_CONNECT_TIMEOUT = 10
+ONA_READ_TIMEOUT = 60
+# Failed requests to Ona are tried again this many times, after a random
+# wait of up to ONA_RETRY_BACKOFF seconds, doubling each time
+ONA_MAX_RETRIES = 3
+ONA_RETRY_BACKOFF = 0.5
+# Connections to keep open to Ona
+ONA_POOL_SIZE = 10
+
+# The cache to keep the reports' rendered tables in, from CACHES. If there's
+# no such cache, they're kept in local memory.
+REPORT_FRAGMENT_CACHE = 'report_fragments'
+
 BOOTSTRAP3 = {
     'success_css_class': '',
 }
@@ -51,7 +51,12 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
         'LOCATION': '%(CACHE_HOST)s' % os.environ,
         'KEY_PREFIX': INSTANCE,
-    }
+    },
+    'report_fragments': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '%(CACHE_HOST)s' % os.environ,
+        'KEY_PREFIX': INSTANCE + '-reports',
+    },
 }
 
 MEDIA_URL = PREFIX_URL + '/media/'
@@ -0,0 +1,36 @@
+"""
+Helpers for benchmarks.
+
+Benchmarks are slow, so they're skipped unless the CTS_BENCHMARK
+environment variable is set, e.g.::
+
+    CTS_BENCHMARK=1 python manage.py test reports.tests.test_benchmarks
+"""
+import os
+import time
+from unittest import skipUnless
+
+
+benchmark = skipUnless(os.environ.get('CTS_BENCHMARK'),
+                       "Set CTS_BENCHMARK=1 in the environment to run benchmarks")
+
+
+def best_time(func, repeat=5):
+    """Call func() `repeat` times and return the fastest run's time in seconds"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def cpu_time(func):
+    """
+    Call func() and return the CPU time this process spent on it in
+    seconds, leaving out time spent waiting on the database.
+    """
+    start = os.times()
+    func()
+    end = os.times()
+    return (end[0] - start[0]) + (end[1] - start[1])
@@ -0,0 +1,112 @@
+from mock import patch
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+
+from accounts.tests.factories import CtsUserFactory
+from catalog.tests.factories import DonorFactory
+from cts.versions import CATALOG, DOMAINS, ITEMS, PACKAGES, SCANS, SHIPMENTS, USERS, \
+    bump_versions, deferred_version_bumps, get_versions, versions_tag
+from reports.signals import bulk_updates, note_changed_items
+from shipments.models import PackageItem
+from shipments.tests.factories import PackageItemFactory, PackageScanFactory, ShipmentFactory
+
+
+class TestVersions(TestCase):
+    def setUp(self):
+        super(TestVersions, self).setUp()
+        cache.clear()
+
+    def bumped_by(self, func):
+        """Return the domains whose versions func() changed"""
+        before = get_versions()
+        func()
+        after = get_versions()
+        return set(domain for domain in DOMAINS if before[domain] != after[domain])
+
+    def test_starts_from_time(self):
+        versions = get_versions()
+        self.assertEqual(set(DOMAINS), set(versions))
+        self.assertTrue(all(versions.values()))
+        # And stays put
+        self.assertEqual(versions, get_versions())
+
+    def test_bump(self):
+        self.assertEqual({ITEMS, SCANS}, self.bumped_by(lambda: bump_versions(ITEMS, SCANS)))
+
+    def test_tag(self):
+        tag = versions_tag()
+        bump_versions(CATALOG)
+        self.assertNotEqual(tag, versions_tag())
+        # Only the domains asked for
+        tag = versions_tag([USERS])
+        bump_versions(CATALOG)
+        self.assertEqual(tag, versions_tag([USERS]))
+
+    def test_deferred(self):
+        before = get_versions()
+
+        def bump_a_lot():
+            with deferred_version_bumps():
+                for i in range(5):
+                    with deferred_version_bumps():
+                        bump_versions(ITEMS)
+                # Not yet
+                self.assertEqual(before, get_versions())
+
+        self.assertEqual({ITEMS}, self.bumped_by(bump_a_lot))
+        self.assertEqual(before[ITEMS] + 1, get_versions()[ITEMS])
+
+    def test_after_commit(self):
+        # The versions don't move until the changes are committed, so nothing
+        # read before then is cached under the new versions
+        before = get_versions()
+        seen = []
+        savepoint_commit = connection.savepoint_commit
+
+        def commit(sid):
+            # The test's own transaction is still open, so the block's
+            # transaction is a savepoint
+            seen.append(get_versions())
+            savepoint_commit(sid)
+
+        def change():
+            with patch.object(connection, 'savepoint_commit', side_effect=commit):
+                with bulk_updates():
+                    PackageItemFactory()
+
+        self.assertIn(ITEMS, self.bumped_by(change))
+        self.assertTrue(seen)
+        for versions in seen:
+            self.assertEqual(before, versions)
+
+    def test_signals(self):
+        self.assertIn(SHIPMENTS, self.bumped_by(lambda: ShipmentFactory()))
+        self.assertEqual({CATALOG}, self.bumped_by(lambda: DonorFactory()))
+        user = CtsUserFactory()
+        self.assertEqual({USERS}, self.bumped_by(lambda: user.save()))
+        # Logging in doesn't change anything shown
+        self.assertEqual(set(), self.bumped_by(lambda: user.save(update_fields=['last_login'])))
+        item = PackageItemFactory()
+        self.assertIn(ITEMS, self.bumped_by(lambda: item.save()))
+        self.assertIn(SCANS, self.bumped_by(lambda: PackageScanFactory(package=item.package)))
+
+    def test_bulk_edit(self):
+        item = PackageItemFactory()
+        donor = DonorFactory()
+
+        def edit():
+            items = PackageItem.objects.filter(pk=item.pk)
+            with bulk_updates():
+                note_changed_items(items)
+                items.update(donor=donor)
+                note_changed_items(items)
+
+        self.assertIn(ITEMS, self.bumped_by(edit))
+
+    def test_fast_delete(self):
+        item = PackageItemFactory()
+        PackageScanFactory(package=item.package)
+        bumped = self.bumped_by(lambda: item.package.shipment.fast_delete())
+        self.assertTrue({SHIPMENTS, PACKAGES, ITEMS, SCANS} <= bumped)
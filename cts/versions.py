@@ -0,0 +1,108 @@
+"""
+Version counters for the data, to build cache keys and ETags from.
+
+The data is split into a few domains, each with a counter in the cache
+that goes up whenever anything in the domain changes, so anything
+computed from the domain's data can be cached under its version and is
+never served stale. All the counters are read together with one cache
+get_many().
+
+Saving or deleting a model instance bumps its domain's version, by the
+signal receivers next to the models. Code that changes rows without
+sending signals (QuerySet.update(), bulk_create() or raw SQL) has to call
+bump_versions() itself. Inside deferred_version_bumps() (which
+reports.signals.bulk_updates() uses), each domain is only bumped once,
+at the end.
+
+A version mustn't move before the change is committed, or a request in
+between would cache what it read from before the change under the new
+version. So transactions that change the data are opened with
+versioned_atomic(), which holds the bumps made in them (and in any
+transactions they contain) back until the outermost of them has committed.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+SHIPMENTS = 'shipments'
+PACKAGES = 'packages'
+ITEMS = 'items'
+SCANS = 'scans'
+CATALOG = 'catalog'
+USERS = 'users'
+DOMAINS = (SHIPMENTS, PACKAGES, ITEMS, SCANS, CATALOG, USERS)
+
+_state = threading.local()
+
+
+def _key(domain):
+    return 'versions:%s' % domain
+
+
+def get_versions(domains=DOMAINS):
+    """Return a dictionary of the current versions of the domains"""
+    keys = dict((_key(domain), domain) for domain in domains)
+    values = cache.get_many(keys.keys())
+    versions = dict((keys[key], value) for key, value in values.items())
+    for domain in domains:
+        if domain not in versions:
+            # Start from the time, so if the counter is lost (e.g. memcached
+            # was restarted) we don't go back to a version we've already used
+            cache.add(_key(domain), int(time.time() * 1000), None)
+            versions[domain] = cache.get(_key(domain))
+    return versions
+
+
+def versions_tag(domains=DOMAINS):
+    """
+    Return a short string that changes whenever the data in any of the
+    domains changes, for a cache key or an ETag.
+    """
+    versions = get_versions(domains)
+    return '-'.join('%s.%s' % (domain, versions[domain]) for domain in sorted(domains))
+
+
+def bump_versions(*domains):
+    """Something in each of these domains has changed"""
+    if getattr(_state, 'domains', None) is not None:
+        _state.domains.update(domains)
+        return
+    for domain in set(domains):
+        try:
+            cache.incr(_key(domain))
+        except ValueError:
+            # Lost it; starting over is a change of version too
+            get_versions([domain])
+
+
+@contextmanager
+def deferred_version_bumps():
+    """
+    Bump each domain's version just once, at the end of the block, however
+    many times the block asks for it. May be nested.
+    """
+    outermost = getattr(_state, 'domains', None) is None
+    if outermost:
+        _state.domains = set()
+    try:
+        yield
+    finally:
+        if outermost:
+            domains, _state.domains = _state.domains, None
+            # Even if the block failed; a needless bump does no harm
+            bump_versions(*domains)
+
+
+@contextmanager
+def versioned_atomic():
+    """
+    Like transaction.atomic(), but the version bumps made in the block wait
+    until it has committed. If it's inside another of these blocks, they
+    wait until the outermost one has committed.
+    """
+    with deferred_version_bumps(), transaction.atomic():
+        yield
@@ -1,8 +1,13 @@
 from django.contrib import admin
-from ona.models import FormSubmission
+from ona.models import FormDefinition, FormSubmission
 
 
 admin.site.register(
     FormSubmission,
     list_display=['pk', 'form_id', 'uuid']
 )
+
+admin.site.register(
+    FormDefinition,
+    list_display=['pk', 'form_id', 'version', 'created']
+)
@@ -1,14 +1,82 @@
 import logging
+import random
+import threading
+import time
 
 import requests
-from requests.exceptions import SSLError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, SSLError, Timeout
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http.response import Http404
 
 
 logger = logging.getLogger(__name__)
 
+# Responses that mean the server might manage next time
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# The sessions, by domain and token, so requests reuse their connections
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Counts of requests, retries, failures and the time spent, in the cache
+STATS_NAMES = ('requests', 'retries', 'failures', 'milliseconds')
+
+
+def get_session(domain, api_key):
+    """Return the requests session for talking to this Ona domain with this token"""
+    with _sessions_lock:
+        session = _sessions.get((domain, api_key))
+        if session is None:
+            session = requests.Session()
+            session.headers.update({'Authorization': 'Token {0}'.format(api_key)})
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.ONA_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[(domain, api_key)] = session
+        return session
+
+
+def forget_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def retry_delay(attempt):
+    """
+    Return how many seconds to wait before the attempt'th retry: a random
+    time up to a limit that doubles each time, so clients that failed
+    together don't all come back together.
+    """
+    return random.uniform(0, settings.ONA_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+def _count(name, amount=1):
+    key = 'ona:api:%s' % name
+    if not cache.add(key, amount, None):
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            # Evicted since we added it
+            cache.set(key, amount, None)
+
+
+def request_stats():
+    """
+    Return how many requests we've made to Ona, how many of them were
+    retries and how many failed in the end, and the average time they took
+    in milliseconds, as a dictionary
+    """
+    values = cache.get_many(['ona:api:%s' % name for name in STATS_NAMES])
+    stats = dict((name, values.get('ona:api:%s' % name, 0)) for name in STATS_NAMES)
+    milliseconds = stats.pop('milliseconds')
+    stats['average_milliseconds'] = milliseconds / stats['requests'] if stats['requests'] else 0
+    return stats
+
 
 class OnaApiClientException(Exception):
     def __init__(self, status_code, message, url=None, *args, **kwargs):
@@ -30,30 +98,22 @@ class OnaApiClient(object):
     Simple client to access Ona API
     """
 
-    def __init__(self, domain=None, api_key=None):
+    def __init__(self, domain=None, api_key=None, scheme=None):
         self.domain = domain or settings.ONA_DOMAIN
         self.api_key = api_key or settings.ONA_API_ACCESS_TOKEN
+        self.scheme = scheme or settings.ONA_API_SCHEME
         assert self.domain is not None
         assert self.api_key is not None
 
     def session(self):
-        session = requests.Session()
-        session.headers.update({'Authorization': 'Token {0}'.format(self.api_key)})
-        return session
+        return get_session(self.domain, self.api_key)
 
     def _request(self, method, endpoint, expected_status_code=200, **kwargs):
         if method not in ['get', ]:
             raise Exception("Unsupported method: {0}".format(method))
 
-        url = 'https://{0}/api/v1/{1}.json'.format(self.domain, endpoint)
-        method = getattr(self.session(), method)
-        try:
-            response = method(url, **kwargs)
-        except SSLError as e:
-            logger.exception("Got an SSLError accessing url %s" % url)
-            for arg in e.args:
-                logger.error("SSLError arg: %s" % arg)
-            raise OnaApiClientException(0, "SSL error, see log (%s)" % e, url=url)
+        url = '{0}://{1}/api/v1/{2}.json'.format(self.scheme, self.domain, endpoint)
+        response = self._send(getattr(self.session(), method), url, **kwargs)
         if "404 Not Found" in response.text:
             raise Http404
         if not len(response.content):
@@ -76,6 +136,47 @@ class OnaApiClient(object):
 
         return data
 
+    def _send(self, method, url, **kwargs):
+        """
+        Make the request, retrying up to settings.ONA_MAX_RETRIES times if we
+        can't connect, it times out or the server has an error, and return
+        the response. All our requests are GETs, so it's safe to repeat them.
+        """
+        kwargs.setdefault('timeout', (settings.ONA_CONNECT_TIMEOUT, settings.ONA_READ_TIMEOUT))
+        attempt = 0
+        while True:
+            if attempt:
+                _count('retries')
+                time.sleep(retry_delay(attempt))
+            attempt += 1
+            start = time.time()
+            try:
+                response = method(url, **kwargs)
+            except SSLError as e:
+                # Trying again won't fix the certificates
+                _count('failures')
+                logger.exception("Got an SSLError accessing url %s" % url)
+                for arg in e.args:
+                    logger.error("SSLError arg: %s" % arg)
+                raise OnaApiClientException(0, "SSL error, see log (%s)" % e, url=url)
+            except (ConnectionError, Timeout):
+                if attempt > settings.ONA_MAX_RETRIES:
+                    _count('failures')
+                    raise
+                logger.warning("Couldn't get %s, will try again" % url, exc_info=True)
+                continue
+            finally:
+                milliseconds = int((time.time() - start) * 1000)
+                _count('requests')
+                _count('milliseconds', milliseconds)
+            logger.debug("GET %s: %d in %dms" % (url, response.status_code, milliseconds))
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if attempt > settings.ONA_MAX_RETRIES:
+                _count('failures')
+                return response
+            logger.warning("Got %d from %s, will try again" % (response.status_code, url))
+
     def get(self, endpoint, query_params=None, expected_status_code=200):
         """
         Create a GET request based on supplied endpoint and optional
@@ -92,6 +193,35 @@ class OnaApiClient(object):
             kwargs = {'query': query}
         return self.get('data/{0}'.format(form_id), query_params=kwargs)
 
+    def iter_form_submission_pages(self, form_id, since=None, page_size=None):
+        """
+        Generate the form's submissions from `since` on, in order of
+        submission time, as lists of up to `page_size` (default
+        settings.ONA_PAGE_SIZE), getting each page from Ona as it's wanted.
+
+        Unlike get_form_submissions(), this includes the submissions made at
+        `since` itself, so a caller that stopped partway through the
+        submissions of one second can start again from that second without
+        missing any. It will get some of them again.
+        """
+        page_size = page_size or settings.ONA_PAGE_SIZE
+        query_params = {
+            'sort': '{"_submission_time": 1}',
+            'limit': page_size,
+        }
+        if since:
+            query_params['query'] = '{"_submission_time": {"$gte": "%s"}}' \
+                % since.strftime("%Y-%m-%dT%H:%M:%S")
+        start = 0
+        while True:
+            query_params['start'] = start
+            page = self.get('data/{0}'.format(form_id), query_params=query_params)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            start += len(page)
+
     def get_form_definition(self, form_id):
         """
         Returns form definition if available, else None.
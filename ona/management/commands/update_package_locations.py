@@ -1,13 +1,14 @@
 """
 Manually run the task that queries Ona for new form submissions
-and processes them.
+and processes them, for each form in turn.
 """
 
 import logging
 
+from django.conf import settings
 from django.core.management.base import NoArgsCommand
 
-from ona.tasks import process_new_scans
+from ona.tasks import process_form_scans
 
 
 class Command(NoArgsCommand):
@@ -18,4 +19,5 @@ class Command(NoArgsCommand):
         logger.setLevel(logging.DEBUG)
         logger.addHandler(logging.StreamHandler())
 
-        process_new_scans()
+        for form_id in settings.ONA_FORM_IDS:
+            process_form_scans(int(form_id))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.core.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0005_lastformretrievaltimestamp'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='formsubmission',
+            name='uuid',
+            field=models.CharField(db_index=True, max_length=36, validators=[django.core.validators.RegexValidator(regex=b'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', message=b'Requires a 36 character UUID v4 formatted string', code=b'nomatch')]),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.db import models, migrations
+
+
+def move_form_definitions(apps, schema_editor):
+    """
+    Save each different form definition embedded in the submissions once,
+    and point the submissions at it instead.
+    """
+    FormDefinition = apps.get_model('ona', 'FormDefinition')
+    cursor = schema_editor.connection.cursor()
+    cursor.execute("SELECT DISTINCT form_id, data -> 'form_definition' FROM ona_formsubmission"
+                   " WHERE exist(data, 'form_definition')")
+    for form_id, embedded in cursor.fetchall():
+        try:
+            definition = json.loads(embedded)
+        except ValueError:
+            # Leave it where it is
+            continue
+        text = json.dumps(definition, sort_keys=True)
+        form_definition, created = FormDefinition.objects.get_or_create(
+            form_id=int(form_id),
+            digest=hashlib.md5(text).hexdigest(),
+            defaults={'version': unicode(definition.get('version', '')), 'definition': text},
+        )
+        cursor.execute("UPDATE ona_formsubmission"
+                       " SET form_definition_id = %s, data = delete(data, 'form_definition')"
+                       " WHERE form_id = %s AND data -> 'form_definition' = %s",
+                       [form_definition.pk, form_id, embedded])
+
+
+def restore_form_definitions(apps, schema_editor):
+    cursor = schema_editor.connection.cursor()
+    cursor.execute("UPDATE ona_formsubmission"
+                   " SET data = ona_formsubmission.data"
+                   " || hstore('form_definition', ona_formdefinition.definition)"
+                   " FROM ona_formdefinition"
+                   " WHERE ona_formsubmission.form_definition_id = ona_formdefinition.id")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0006_formsubmission_uuid_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FormDefinition',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('form_id', models.IntegerField()),
+                ('digest', models.CharField(help_text=b'MD5 of the definition', max_length=32)),
+                ('version', models.CharField(help_text=b"The form's own version, if it has one", max_length=256, blank=True)),
+                ('definition', models.TextField(help_text=b'JSON of the Ona form definition')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='formdefinition',
+            unique_together=set([('form_id', 'digest')]),
+        ),
+        migrations.AddField(
+            model_name='formsubmission',
+            name='form_definition',
+            field=models.ForeignKey(related_name='submissions', blank=True, to='ona.FormDefinition', help_text=b"The form's definition when we got the submission", null=True),
+        ),
+        migrations.RunPython(move_form_definitions, restore_form_definitions),
+    ]
@@ -1,4 +1,7 @@
+from collections import OrderedDict
 from datetime import datetime
+import hashlib
+import json
 import logging
 
 from django.conf import settings
@@ -12,20 +15,67 @@ from django.utils.timezone import make_aware, utc
 from django_hstore import hstore
 
 from accounts.models import CtsUser
-from shipments.models import PackageScan, Package, Shipment
+from shipments.models import PackageScan, Package, Shipment, status_as_string
 
-from ona.representation import OnaItemBase, PackageScanFormSubmission
+from ona.representation import LocationLabels, OnaItemBase, PackageScanFormSubmission
 
 
 logger = logging.getLogger(__name__)
 
 UUID_REGEX = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
+# The LocationLabels of each FormDefinition, by PK, compiled the first time
+# this process needs them. A FormDefinition doesn't change once it's saved.
+location_labels_cache = {}
+
+
+class FormDefinition(models.Model):
+    """
+    One version of an Ona form's definition, saved once and shared by all
+    the submissions we got while it was the current one.
+    """
+    form_id = models.IntegerField()
+    digest = models.CharField(max_length=32, help_text="MD5 of the definition")
+    version = models.CharField(max_length=256, blank=True,
+                               help_text="The form's own version, if it has one")
+    definition = models.TextField(help_text="JSON of the Ona form definition")
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('form_id', 'digest')]
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.form_id, self.version or self.digest)
+
+    @staticmethod
+    def for_definition(form_id, definition):
+        """
+        Return the FormDefinition for the definition of the form we got
+        from Ona, saving it if it's a version we haven't seen before.
+        """
+        text = json.dumps(definition, sort_keys=True)
+        obj, created = FormDefinition.objects.get_or_create(
+            form_id=form_id,
+            digest=hashlib.md5(text).hexdigest(),
+            defaults={'version': unicode(definition.get('version', '')), 'definition': text},
+        )
+        if created:
+            logger.info("New definition for form %s: %s" % (form_id, obj))
+        return obj
+
+    def get_location_labels(self):
+        """Return the LocationLabels of the definition"""
+        labels = location_labels_cache.get(self.pk)
+        if labels is None:
+            labels = location_labels_cache[self.pk] = LocationLabels(json.loads(self.definition))
+        return labels
+
 
 class FormSubmission(models.Model):
     form_id = models.CharField(max_length=256)
     uuid = models.CharField(
         max_length=36,
+        db_index=True,
         validators=[RegexValidator(
             regex=UUID_REGEX,
             message='Requires a 36 character UUID v4 formatted string',
@@ -38,27 +88,69 @@ class FormSubmission(models.Model):
 
     submission_time = models.DateTimeField(help_text="Copied from the hstore data")
 
+    form_definition = models.ForeignKey(
+        FormDefinition, null=True, blank=True, related_name='submissions',
+        help_text="The form's definition when we got the submission")
+
     objects = hstore.HStoreManager()
 
     @staticmethod
-    def from_ona_form_data(submission):
+    def from_ona_form_data(submission, form_definition=None):
         """
         Create and return a new FormSubmission based on form data received from a
         mobile form submission
         """
+        obj = FormSubmission.build_from_ona_form_data(submission, form_definition)
+        if obj:
+            obj.save()
+        return obj
+
+    @staticmethod
+    def build_from_ona_form_data(submission, form_definition=None):
+        """
+        Return a new, unsaved FormSubmission for the submission, or None if
+        it's malformed
+        """
         uuid = submission._uuid
         obj = FormSubmission(
             form_id=submission.form_id,
             uuid=uuid,
             submission_time=submission._submission_time,
             data=submission.json,
+            form_definition=form_definition,
         )
         try:
             obj.clean_fields()
         except ValidationError:
             logger.exception("FormSubmission with malformed uuid %s not imported" % uuid)
-        else:
-            obj.save()
+            return None
+        return obj
+
+    @staticmethod
+    def bulk_from_ona_form_data(submissions, form_definition=None):
+        """
+        Create FormSubmissions for those of the submissions that we don't
+        have yet, with one query to find out which and one to insert them,
+        and return them.
+
+        They're not saved one at a time, so no post_save is sent for them;
+        pass package tracking forms on to record_package_scans().
+        """
+        by_uuid = OrderedDict()
+        for submission in submissions:
+            by_uuid.setdefault(submission._uuid, submission)
+        existing = set(FormSubmission.objects.filter(uuid__in=by_uuid.keys())
+                       .values_list('uuid', flat=True))
+        objs = []
+        for uuid, submission in by_uuid.items():
+            if uuid in existing:
+                logger.debug("Form %s (%r) already existed" % (uuid, submission.form_id))
+                continue
+            obj = FormSubmission.build_from_ona_form_data(submission, form_definition)
+            if obj:
+                objs.append(obj)
+        FormSubmission.objects.bulk_create(objs)
+        return objs
 
 
 # datetime.min is too early for strftime, go figure:
@@ -91,70 +183,7 @@ def record_package_location(sender, instance, **kwargs):
         logger.debug("record_package_location...")
         form_ids = [int(x) for x in settings.ONA_FORM_IDS]
         if kwargs.get('created', False) and int(instance.data['form_id']) in form_ids:
-            submission = PackageScanFormSubmission(instance.data)
-            logger.debug("New formsubmission. %d QR codes", len(submission.get_qr_codes()))
-
-            for code in submission.get_qr_codes():
-                logger.debug("QR code: %s" % code)
-                try:
-                    pkg = Package.objects.get(code=code)
-                except Package.DoesNotExist:
-                    logger.exception("Scanned Package with code %s not found" % code)
-                else:
-                    scan_status_label = submission.get_current_packagescan_label()
-                    PackageScan.objects.create(
-                        package=pkg,
-                        longitude=submission.get_lng(),
-                        latitude=submission.get_lat(),
-                        altitude=submission.get_altitude(),
-                        accuracy=submission.get_accuracy(),
-                        when=submission._submission_time,
-                        status_label=scan_status_label
-                    )
-                    logger.debug("created location")
-                    # Update Package and Shipment Status based on selected current_location value
-                    # Values should look similar to the following samples, defined by the
-                    # Ona XLSFOrm:
-                    # STATUS_IN_TRANSIT-Zero_Point
-                    # STATUS_IN_TRANSIT-Partner_Warehouse
-                    # STATUS_IN_TRANSIT-Pre-Distribution_Point
-                    # STATUS_RECEIVED-Distribution Point
-                    # STATUS_RECEIVED-Post-Distribution Point
-                    # The prefix part (before the first -) is one of the predefined status
-                    # names that are attributes of the Shipment model.
-                    if submission.is_voucher():
-                        status = Shipment.STATUS_RECEIVED
-                    else:
-                        status = submission.current_location.split('-', 1)[0]
-                        logger.debug("status=%r" % status)
-                        if not hasattr(Shipment, status):
-                            # If no match is found, log the invalid package status as it is
-                            # indicative of the app and Ona being out of sync
-                            msg = "FormSubmission with form id of %s has invalid package status: %s" \
-                                % (instance.form_id, status)
-                            logger.error(msg)
-                            continue
-                        status = getattr(Shipment, status, None)
-                    if status:
-                        update_fields = ['last_scan_status_label']
-                        pkg.last_scan_status_label = scan_status_label
-                        if pkg.status != status:
-                            update_fields.append('status')
-                            pkg.status = status
-                        if status == Shipment.STATUS_RECEIVED and not pkg.date_received:
-                            update_fields.append('date_received')
-                            pkg.date_received = submission._submission_time
-                        elif status == Shipment.STATUS_PICKED_UP and not pkg.date_picked_up:
-                            update_fields.append('date_picked_up')
-                            pkg.date_picked_up = submission._submission_time
-                        elif status == Shipment.STATUS_IN_TRANSIT and not pkg.date_in_transit:
-                            update_fields.append('date_in_transit')
-                            pkg.date_in_transit = submission._submission_time
-                        pkg.save(update_fields=update_fields)
-                        pkg.shipment.status = status
-                        pkg.shipment.last_scan_status_label = scan_status_label
-                        pkg.shipment.save(update_fields=['status', 'last_scan_status_label'])
-                        logger.debug("set status to %s" % pkg.get_status_display())
+            record_package_scans([instance])
         else:
             logger.debug("Ignoring this FormSubmission.  kwargs[created]=%s, form_id=%s,"
                          " form_ids=%s"
@@ -164,6 +193,117 @@ def record_package_location(sender, instance, **kwargs):
         logger.exception("Something blew up in record_package_location")
 
 
+def parse_package_scan(instance):
+    """
+    Return the details of the package scan in a package tracking
+    FormSubmission that record_package_scans() needs: a dict of its QR
+    codes, new status (or None), status label, time and GPS location.
+    """
+    submission = PackageScanFormSubmission(instance.data)
+    codes = submission.get_qr_codes()
+    logger.debug("New formsubmission. %d QR codes", len(codes))
+
+    if instance.form_definition_id:
+        location_labels = instance.form_definition.get_location_labels()
+    else:
+        # From before we saved form definitions on their own
+        location_labels = None
+    scan_status_label = submission.get_current_packagescan_label(location_labels)
+    # Update Package and Shipment Status based on selected current_location value
+    # Values should look similar to the following samples, defined by the
+    # Ona XLSFOrm:
+    # STATUS_IN_TRANSIT-Zero_Point
+    # STATUS_IN_TRANSIT-Partner_Warehouse
+    # STATUS_IN_TRANSIT-Pre-Distribution_Point
+    # STATUS_RECEIVED-Distribution Point
+    # STATUS_RECEIVED-Post-Distribution Point
+    # The prefix part (before the first -) is one of the predefined status
+    # names that are attributes of the Shipment model.
+    if submission.is_voucher():
+        status = Shipment.STATUS_RECEIVED
+    else:
+        status = submission.current_location.split('-', 1)[0]
+        logger.debug("status=%r" % status)
+        if not hasattr(Shipment, status):
+            # If no match is found, log the invalid package status as it is
+            # indicative of the app and Ona being out of sync
+            msg = "FormSubmission with form id of %s has invalid package status: %s" \
+                % (instance.form_id, status)
+            logger.error(msg)
+            status = None
+        else:
+            status = getattr(Shipment, status, None)
+    return {
+        'codes': codes,
+        'status': status,
+        'status_label': scan_status_label,
+        'when': submission._submission_time,
+        'longitude': submission.get_lng(),
+        'latitude': submission.get_lat(),
+        'altitude': submission.get_altitude(),
+        'accuracy': submission.get_accuracy(),
+    }
+
+
+def record_package_scans(form_submissions):
+    """
+    Record the package scans of these new package tracking FormSubmissions,
+    and move the scanned packages and their shipments to their new
+    statuses, as if each submission was handled in turn, in order of
+    submission time. A submission we can't make sense of is logged and
+    left out.
+
+    The whole batch takes one query to find the scanned packages, a few to
+    add their scans, and one status transition for each different status,
+    label and time.
+    """
+    scanned = []
+    for instance in sorted(form_submissions, key=lambda obj: obj.submission_time):
+        try:
+            scanned.append(parse_package_scan(instance))
+        except Exception:
+            logger.exception("Couldn't read the package scan in FormSubmission %s"
+                             % instance.uuid)
+
+    codes = set(code for scan in scanned for code in scan['codes'])
+    packages = dict((code, (pk, shipment_id)) for code, pk, shipment_id in
+                    Package.objects.filter(code__in=codes).values_list('code', 'pk', 'shipment_id'))
+
+    scans = []
+    # Package PKs by (status, when, label), in order of submission time
+    transitions = OrderedDict()
+    for scan in scanned:
+        scanned_package_ids = []
+        for code in scan['codes']:
+            logger.debug("QR code: %s" % code)
+            if code not in packages:
+                logger.error("Scanned Package with code %s not found" % code)
+                continue
+            package_id, shipment_id = packages[code]
+            scans.append(PackageScan(
+                package_id=package_id,
+                shipment_id=shipment_id,
+                longitude=scan['longitude'],
+                latitude=scan['latitude'],
+                altitude=scan['altitude'],
+                accuracy=scan['accuracy'],
+                when=scan['when'],
+                status_label=scan['status_label']
+            ))
+            scanned_package_ids.append(package_id)
+        if scan['status'] and scanned_package_ids:
+            key = (scan['status'], scan['when'], scan['status_label'])
+            transitions.setdefault(key, []).extend(scanned_package_ids)
+
+    PackageScan.bulk_record(scans)
+    logger.debug("created %d locations" % len(scans))
+    for (status, when, scan_status_label), package_ids in transitions.items():
+        # Move all the scanned packages, and their shipments, at once
+        Shipment.apply_status_transition(package_ids, status, when=when,
+                                         label=scan_status_label)
+        logger.debug("set status to %s" % status_as_string(status))
+
+
 @receiver(post_save, sender=FormSubmission)
 def update_device_binding(sender, instance, **kwargs):
     # Only record package locations for package tracking forms
@@ -58,6 +58,43 @@ class OnaItemBase(object):
         return super(OnaItemBase, self).__setattr__(attr, value)
 
 
+class LocationLabels(object):
+    """
+    The English labels of the locations in a package tracking form's
+    definition, indexed by the part of each location's name after the
+    status, which is what get_current_packagescan_label() looks up.
+
+    Compile it once per form definition, rather than for every submission.
+    """
+    def __init__(self, form_definition):
+        if not isinstance(form_definition, dict):
+            form_definition = json.loads(form_definition)
+        try:
+            choices = form_definition['choices']['location_list']
+        except KeyError:
+            choices = []
+        # (name, label) of each location, in the form's order
+        self.choices = []
+        self.index = {}
+        for element in choices:
+            name = element.get('name', '')
+            label = element.get('label', {})
+            label = label.get('English', '') if isinstance(label, dict) else label
+            self.choices.append((name, label))
+            # If two locations end the same way, the first one wins
+            self.index.setdefault(name.split('-', 1)[-1], label)
+
+    def get(self, key):
+        """Return the label for the location key, or '' if there isn't one"""
+        if key in self.index:
+            return self.index[key]
+        # Not quite any of the names: try the first that has it in
+        for name, label in self.choices:
+            if key in name:
+                return label
+        return ''
+
+
 class PackageScanFormSubmission(OnaItemBase):
 
     def get_gps_data(self, index):
@@ -94,10 +131,10 @@ class PackageScanFormSubmission(OnaItemBase):
             key = 'package/qr_code'
             return set([x[key] for x in json.loads(self.package) if key in x])
 
-    def get_current_packagescan_label(self):
+    def get_current_packagescan_label(self, location_labels=None):
         """
-        Inspect the form definition and return the associated label for the
-        current location value.
+        Return the label for the current location value, from the
+        LocationLabels of the form definition.
         """
         # Return the human readable version of the status
         # Values should look similar to the following samples, defined by the Ona XLSFOrm:
@@ -112,17 +149,11 @@ class PackageScanFormSubmission(OnaItemBase):
             # If the package scan is for a voucher, set status to received
             return Shipment.STATUS_RECEIVED
         else:
-            parts = self.current_location.split('-', 1)
-            choices = json.loads(self.form_definition)['choices']['location_list']
-            if len(parts) == 2:
-                key = parts[1]
-            else:
-                key = parts[0]
-            try:
-                choice = [element for element in choices if key in element['name']][0]
-                return choice['label']['English']
-            except (IndexError, KeyError):
-                return ''
+            if location_labels is None:
+                # A submission with its form definition in it, from before
+                # the definitions were saved on their own
+                location_labels = LocationLabels(self.form_definition)
+            return location_labels.get(self.current_location.split('-', 1)[-1])
 
     def is_voucher(self):
         return hasattr(self, 'voucher_information/qr_code')
@@ -1,16 +1,22 @@
 from __future__ import absolute_import
 import logging
+import time
 
+from celery import group
 from django.conf import settings
+from django.db import connection, transaction
 from django.http import Http404
 
 from requests import ConnectionError
 
 from accounts.models import CtsUser
 from cts.celery import app
+from cts.versions import versioned_atomic
 from ona.api import OnaApiClient, OnaApiClientException
-from ona.models import FormSubmission, LastFormRetrievalTimestamp
+from ona.models import FormDefinition, FormSubmission, LastFormRetrievalTimestamp, \
+    record_package_scans
 from ona.representation import PackageScanFormSubmission, OnaItemBase
+from reports.signals import bulk_updates
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +28,24 @@ bad_form_ids = set()
 # After we've looked up a form, don't keep doing it.  Store the definitions here.
 form_defs = {}
 
+# The current FormDefinition of each package tracking form, and when we got
+# it from Ona, by form ID
+current_form_definitions = {}
+
+# How long to keep using a package tracking form's definition before asking
+# Ona for it again, in case the form has changed
+FORM_DEFINITION_MAX_AGE = 15 * 60
+
+# How many form submissions to save and process at a time
+SUBMISSION_BATCH_SIZE = 500
+
+# Like the schedule's `expires` for process_new_scans, so that if the workers
+# are held up, the forms' tasks don't pile up
+FORM_TASK_EXPIRES = 10 * 60
+
+# Tags the advisory lock that a form's task holds while it works, in the top bits
+FORM_SCANS_LOCK = 0x4f4e << 48
+
 
 def reset_bad_form_ids():
     bad_form_ids.clear()
@@ -29,88 +53,193 @@ def reset_bad_form_ids():
 
 def forget_form_definitions():
     form_defs.clear()
+    current_form_definitions.clear()
+
+
+def lock_form(form_id):
+    """
+    Take the form's advisory lock for this database session, and return
+    whether we got it. Every worker sees it, whatever the cache backend,
+    and it's let go if the worker's connection goes away.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", [FORM_SCANS_LOCK | form_id])
+    return cursor.fetchone()[0]
+
+
+def unlock_form(form_id):
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_advisory_unlock(%s)", [FORM_SCANS_LOCK | form_id])
+
+
+def get_current_form_definition(client, form_id):
+    """
+    Return the FormDefinition of the package tracking form as it is on Ona,
+    or None if Ona doesn't have the form. Asks Ona again once the one we
+    have is FORM_DEFINITION_MAX_AGE old; if the form has changed since, the
+    new version is saved and used from then on.
+    """
+    if form_id in current_form_definitions:
+        fetched, form_definition = current_form_definitions[form_id]
+        if time.time() - fetched < FORM_DEFINITION_MAX_AGE:
+            return form_definition
+    definition = client.get_form_definition(form_id)
+    if not definition:
+        return None
+    form_definition = FormDefinition.for_definition(form_id, definition)
+    current_form_definitions[form_id] = (time.time(), form_definition)
+    return form_definition
 
 
 @app.task(ignore_result=True)
 def process_new_scans():
-    """Updates the local database with new package tracking form submissions"""
+    """
+    Updates the local database with new package tracking form submissions.
+
+    Each form gets a task of its own, sent together as a group, so the
+    forms are fetched at the same time, and a problem with one of them
+    doesn't hold up the others.
+    """
     logger.debug("process_new_scans task starting...")
+    tasks = [
+        process_form_scans.si(int(form_id)).set(expires=FORM_TASK_EXPIRES)
+        for form_id in settings.ONA_FORM_IDS
+    ]
+    if tasks:
+        group(tasks).apply_async()
+    logger.debug("process_new_scans task done")
+
+
+@app.task(ignore_result=True)
+def process_form_scans(form_id):
+    """Updates the local database with new submissions of one package tracking form"""
+    logger.debug("process_form_scans task starting for %s..." % form_id)
+    if form_id in bad_form_ids:
+        return
+    # Don't start on a form while an earlier task is still working on it
+    if not lock_form(form_id):
+        logger.info("Form %s is still being processed" % form_id)
+        return
     try:
-        form_ids = [int(x) for x in settings.ONA_FORM_IDS]
-        for form_id in form_ids:
-            if form_id in bad_form_ids:
-                return
+        client = OnaApiClient()
 
-            client = OnaApiClient()
+        form_definition = get_current_form_definition(client, form_id)
+        if not form_definition:
+            # Logging an error should result in an email to the admins so they
+            # know to fix this.
+            logger.error("Bad ONA_FORM_ID: %s" % form_id)
+            # Let's not keep trying for the bad form ID. We'll have to change the
+            # settings and restart to fix it.
+            bad_form_ids.add(form_id)
+            return
 
-            if form_id in form_defs:
-                form_def = form_defs[form_id]
-            else:
-                form_def = client.get_form_definition(form_id)
-                if form_def:
-                    form_defs[form_id] = form_def
-                else:
-                    # Logging an error should result in an email to the admins so they
-                    # know to fix this.
-                    logger.error("Bad ONA_FORM_ID: %s" % form_id)
-                    # Let's not keep trying for the bad form ID. We'll have to change the
-                    # settings and restart to fix it.
-                    bad_form_ids.add(form_id)
-                    return
-
-            # What's the last submission we got (if any)
-            most_recent_submission = FormSubmission.objects.filter(form_id=form_id)\
-                .order_by('-submission_time').first()
-            if most_recent_submission:
-                # Don't re-fetch the last form
-                since = most_recent_submission.submission_time
-                logger.debug("Getting forms since %s" % since)
-            else:
-                logger.debug("No form submissions yet for %r" % form_id)
-                since = None
-
-            try:
-                submissions = client.get_form_submissions(form_id, since=since)
-            except Http404:
-                logger.error(
-                    "Got 404 getting submissions for ONA_FORM_ID = %s" % form_id)
-                return
-            except OnaApiClientException as e:
-                if e.status_code != 404:
-                    raise
-                logger.error(
-                    "Got 404 getting submissions for ONA_FORM_ID = %s" % form_id)
-                return
+        # Where we got to last time
+        checkpoint = get_checkpoint(form_id)
+        logger.debug("Getting forms since %s" % checkpoint.timestamp)
 
-            logger.debug(
-                "process_new_scans downloaded %d submitted forms" % len(submissions))
-            # add the form definition JSON to each submission
-            for data in submissions:
-                data.update({'form_id': form_id})
-                data.update({'form_definition': form_def})
-            # create a list of API repr objects and ensure they are sorted by submission date
-            objects = [PackageScanFormSubmission(x) for x in submissions]
-            objects.sort(key=lambda x: x._submission_time)
-            logger.debug("There are %d objects to look at" % len(objects))
-            for submission in objects:
-                existing = FormSubmission.objects.filter(uuid=submission._uuid).first()
-                if not existing:
-                    logger.debug("Got new form, creating new record")
-                    try:
-                        FormSubmission.from_ona_form_data(submission)
-                    except Exception:
-                        logger.exception("HEY got exception creating new FormSubmission")
-                else:
-                    logger.debug("Form %s (%r, %s) already existed" % (submission._uuid,
-                                                                       submission.form_id,
-                                                                       existing.submission_time))
+        try:
+            for submissions in client.iter_form_submission_pages(
+                    form_id, since=checkpoint.timestamp):
+                save_scans_page(form_id, form_definition, submissions, checkpoint)
+        except Http404:
+            logger.error(
+                "Got 404 getting submissions for ONA_FORM_ID = %s" % form_id)
+            return
+        except OnaApiClientException as e:
+            if e.status_code != 404:
+                raise
+            logger.error(
+                "Got 404 getting submissions for ONA_FORM_ID = %s" % form_id)
+            return
     except ConnectionError:
         logger.exception("Error connecting to Ona server")
     except OnaApiClientException:
         logger.exception("Error communicating with Ona server")
     except Exception:
-        logger.exception("Something blew up in process_new_scans")
-    logger.debug("process_new_scans task done")
+        logger.exception("Something blew up in process_form_scans")
+    finally:
+        unlock_form(form_id)
+    logger.debug("process_form_scans task done for %s" % form_id)
+
+
+def get_checkpoint(form_id):
+    """
+    Return the form's LastFormRetrievalTimestamp, starting it from the
+    newest submission we have if there isn't one yet.
+    """
+    checkpoint, created = LastFormRetrievalTimestamp.objects.get_or_create(form_id=form_id)
+    if created:
+        newest = FormSubmission.objects.filter(form_id=form_id)\
+            .order_by('-submission_time').first()
+        if newest:
+            checkpoint.timestamp = newest.submission_time
+            checkpoint.save()
+    return checkpoint
+
+
+def save_scans_page(form_id, form_definition, submissions, checkpoint):
+    """
+    Save a page of the package tracking form's submissions, made with the
+    FormDefinition, and move the form's checkpoint on to the last of them,
+    in one transaction. So if we stop partway through, we start again after
+    the last page we finished.
+    """
+    logger.debug(
+        "process_new_scans downloaded %d submitted forms" % len(submissions))
+    # add the form ID to each submission
+    for data in submissions:
+        data.update({'form_id': form_id})
+    # create a list of API repr objects and ensure they are sorted by submission date
+    objects = [PackageScanFormSubmission(x) for x in submissions]
+    objects.sort(key=lambda x: x._submission_time)
+    logger.debug("There are %d objects to look at" % len(objects))
+    with versioned_atomic():
+        for start in range(0, len(objects), SUBMISSION_BATCH_SIZE):
+            save_new_scans(objects[start:start + SUBMISSION_BATCH_SIZE], form_definition)
+        if objects and objects[-1]._submission_time > checkpoint.timestamp:
+            checkpoint.timestamp = objects[-1]._submission_time
+            checkpoint.save()
+
+
+def save_new_scans(submissions, form_definition=None):
+    """
+    Save those of these package tracking form submissions that we don't
+    have yet, and record their package scans, together and in one
+    transaction. Updates the shipments and reports for all of them at the end.
+    """
+    with bulk_updates():
+        try:
+            with transaction.atomic():
+                new_submissions = FormSubmission.bulk_from_ona_form_data(submissions,
+                                                                         form_definition)
+        except Exception:
+            logger.exception("Couldn't save a batch of %d submissions, trying them one at a time"
+                             % len(submissions))
+            new_submissions = []
+            for submission in submissions:
+                try:
+                    # Don't let one bad submission spoil the rest
+                    with transaction.atomic():
+                        new_submissions.extend(
+                            FormSubmission.bulk_from_ona_form_data([submission],
+                                                                   form_definition))
+                except Exception:
+                    logger.exception("HEY got exception creating new FormSubmission")
+        logger.debug("Got %d new forms" % len(new_submissions))
+        try:
+            with transaction.atomic():
+                record_package_scans(new_submissions)
+        except Exception:
+            logger.exception("Couldn't record the package scans of a batch of %d submissions,"
+                             " trying them one at a time" % len(new_submissions))
+            for form_submission in new_submissions:
+                try:
+                    # Don't let one bad submission spoil the rest
+                    with transaction.atomic():
+                        record_package_scans([form_submission])
+                except Exception:
+                    logger.exception("Something blew up recording the package scans of %s"
+                                     % form_submission.uuid)
 
 
 @app.task(ignore_result=True)
@@ -0,0 +1,96 @@
+"""
+A stand-in for the Ona API, served locally, for testing the client and the
+tasks against real HTTP requests.
+"""
+import BaseHTTPServer
+import json
+import re
+import threading
+from urlparse import parse_qs, urlparse
+
+
+class FakeOnaServer(object):
+    """
+    Serves the form definitions and submissions it's given, the way the
+    parts of the Ona API that OnaApiClient uses do, from a thread.
+
+    Use it as a context manager, with settings ONA_API_SCHEME='http' and
+    ONA_DOMAIN set to its `domain`. `forms` maps form IDs to their
+    definitions, and `submissions` maps form IDs to lists of submissions.
+    Every request's path and query parameters are added to `requests`. The
+    requests whose numbers (from 1) are in `failures` get a server error.
+    """
+    def __init__(self, forms=None, submissions=None):
+        self.forms = forms or {}
+        self.submissions = submissions or {}
+        self.requests = []
+        self.failures = set()
+
+    def __enter__(self):
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), self.make_handler())
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def domain(self):
+        return '127.0.0.1:%d' % self.httpd.server_port
+
+    def data_requests(self):
+        """The query parameters of each request for submissions"""
+        return [params for path, params in self.requests if path.startswith('/api/v1/data/')]
+
+    def respond(self, path, params):
+        """Return the status code and data for a request"""
+        self.requests.append((path, params))
+        if len(self.requests) in self.failures:
+            return 500, {'detail': "Something went wrong"}
+        match = re.match(r'^/api/v1/forms/(\d+)/form\.json$', path)
+        if match and int(match.group(1)) in self.forms:
+            return 200, self.forms[int(match.group(1))]
+        match = re.match(r'^/api/v1/data/(\d+)\.json$', path)
+        if match and int(match.group(1)) in self.submissions:
+            return 200, self.get_submissions(int(match.group(1)), params)
+        return 404, {'detail': "404 Not Found"}
+
+    def get_submissions(self, form_id, params):
+        submissions = sorted(self.submissions[form_id], key=lambda data: data['_submission_time'])
+        if 'query' in params:
+            # Only the queries OnaApiClient makes; the times compare as strings
+            condition = json.loads(params['query'])['_submission_time']
+            for operator, value in condition.items():
+                if operator == '$gt':
+                    submissions = [data for data in submissions
+                                   if data['_submission_time'] > value]
+                elif operator == '$gte':
+                    submissions = [data for data in submissions
+                                   if data['_submission_time'] >= value]
+        start = int(params.get('start', 0))
+        if 'limit' in params:
+            return submissions[start:start + int(params['limit'])]
+        return submissions[start:]
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+                status, data = server.respond(url.path, params)
+                content = json.dumps(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
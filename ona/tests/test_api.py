@@ -1,17 +1,25 @@
+from datetime import datetime
+import socket
+
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import patch, MagicMock
-from requests.exceptions import SSLError
+from requests.exceptions import ConnectionError, SSLError
 from ona import OnaApiClient
-from ona.api import OnaApiClientException
+from ona.api import OnaApiClientException, get_session, request_stats
+from ona.tests.fake_ona import FakeOnaServer
 
 
 class TestClientRequest(TestCase):
     def test_ssl_error(self):
         client = OnaApiClient('example.com', '2384729347234')
-        with patch('requests.sessions.Session') as mock_session:
-            mock_session.get.side_effect = SSLError
+        with patch.object(client, 'session') as mock_session_method:
+            mock_session_method.return_value.get.side_effect = SSLError
             with self.assertRaises(OnaApiClientException):
                 client.get('foo')
+        # Not worth trying again
+        self.assertEqual(1, mock_session_method.return_value.get.call_count)
 
     def test_json_parsing_error(self):
         # Make sure if the json parsing fails, we get a useful exception
@@ -65,3 +73,119 @@ class TestClientRequest(TestCase):
                 self.assertIn('foo', s)
             else:
                 self.fail("Expected OnaApiClientException")
+
+
+class TestFormSubmissionPages(TestCase):
+    def setUp(self):
+        super(TestFormSubmissionPages, self).setUp()
+        self.submissions = [
+            {'_uuid': str(i), '_submission_time': '2014-07-25T17:19:%02d' % i}
+            for i in range(5)
+        ]
+
+    def get_pages(self, server, **kwargs):
+        client = OnaApiClient(server.domain, 'token', scheme='http')
+        return [[data['_uuid'] for data in page]
+                for page in client.iter_form_submission_pages(123, **kwargs)]
+
+    def test_pages(self):
+        with FakeOnaServer(submissions={123: self.submissions}) as server:
+            self.assertEqual([['0', '1'], ['2', '3'], ['4']], self.get_pages(server, page_size=2))
+            self.assertEqual(['0', '2', '4'],
+                             [params['start'] for params in server.data_requests()])
+
+    def test_since(self):
+        with FakeOnaServer(submissions={123: self.submissions}) as server:
+            # Including the submissions made at that time
+            self.assertEqual([['2', '3', '4']],
+                             self.get_pages(server, since=datetime(2014, 7, 25, 17, 19, 2)))
+
+    def test_last_page_full(self):
+        with FakeOnaServer(submissions={123: self.submissions[:4]}) as server:
+            self.assertEqual([['0', '1'], ['2', '3']], self.get_pages(server, page_size=2))
+            # It takes another request to find there are no more
+            self.assertEqual(3, len(server.data_requests()))
+
+    def test_lazy(self):
+        with FakeOnaServer(submissions={123: self.submissions}) as server:
+            client = OnaApiClient(server.domain, 'token', scheme='http')
+            pages = client.iter_form_submission_pages(123, page_size=2)
+            next(pages)
+            self.assertEqual(1, len(server.data_requests()))
+
+    def test_error(self):
+        with FakeOnaServer(submissions={123: self.submissions}) as server:
+            server.failures.add(2)
+            client = OnaApiClient(server.domain, 'token', scheme='http')
+            pages = client.iter_form_submission_pages(123, page_size=2)
+            next(pages)
+            with self.assertRaises(OnaApiClientException):
+                next(pages)
+
+
+@override_settings(ONA_MAX_RETRIES=2, ONA_CONNECT_TIMEOUT=1, ONA_READ_TIMEOUT=2)
+@patch('ona.api.time.sleep')
+class TestRetries(TestCase):
+    def setUp(self):
+        super(TestRetries, self).setUp()
+        cache.clear()
+
+    def get_client(self, server):
+        return OnaApiClient(server.domain, 'token', scheme='http')
+
+    def test_pooled_session(self, mock_sleep):
+        self.assertIs(get_session('ona.io', 'token'), get_session('ona.io', 'token'))
+        self.assertIsNot(get_session('ona.io', 'token'), get_session('ona.io', 'other'))
+        client = OnaApiClient('ona.io', 'token')
+        self.assertIs(client.session(), OnaApiClient('ona.io', 'token').session())
+
+    def test_timeouts(self, mock_sleep):
+        client = OnaApiClient('example.com', 'token')
+        with patch.object(client, 'session') as mock_session_method:
+            mock_response = mock_session_method.return_value.get.return_value
+            mock_response.text = '{}'
+            mock_response.content = mock_response.text.encode('utf-8')
+            mock_response.status_code = 200
+            client.get('foo')
+        self.assertEqual((1, 2), mock_session_method.return_value.get.call_args[1]['timeout'])
+
+    def test_server_error_retried(self, mock_sleep):
+        with FakeOnaServer(forms={123: {'name': 'form'}}) as server:
+            server.failures.update([1, 2])
+            self.assertEqual({'name': 'form'}, self.get_client(server).get_form_definition(123))
+            self.assertEqual(3, len(server.requests))
+        self.assertEqual(2, mock_sleep.call_count)
+        stats = request_stats()
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(2, stats['retries'])
+        self.assertEqual(0, stats['failures'])
+
+    def test_gives_up(self, mock_sleep):
+        with FakeOnaServer(forms={123: {'name': 'form'}}) as server:
+            server.failures.update([1, 2, 3])
+            with self.assertRaises(OnaApiClientException) as cm:
+                self.get_client(server).get_form_definition(123)
+            self.assertEqual(500, cm.exception.status_code)
+            self.assertEqual(3, len(server.requests))
+        self.assertEqual(1, request_stats()['failures'])
+
+    def test_not_found_not_retried(self, mock_sleep):
+        with FakeOnaServer() as server:
+            self.assertIsNone(self.get_client(server).get_form_definition(123))
+            self.assertEqual(1, len(server.requests))
+        self.assertFalse(mock_sleep.called)
+
+    def test_connection_error_retried(self, mock_sleep):
+        # A port nobody's listening on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = OnaApiClient('127.0.0.1:%d' % port, 'token', scheme='http')
+        with self.assertRaises(ConnectionError):
+            client.get('foo')
+        self.assertEqual(2, mock_sleep.call_count)
+        # Waiting a random time, up to twice as long as before
+        delays = [args[0] for args, kwargs in mock_sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 0.5)
+        self.assertTrue(0 <= delays[1] <= 1)
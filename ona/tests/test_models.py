@@ -9,7 +9,7 @@ from django.utils.timezone import now
 
 from shipments.models import PackageScan, Shipment, PackageDBView
 from shipments.tests.factories import PackageFactory
-from ona.models import FormSubmission
+from ona.models import FormDefinition, FormSubmission
 from ona.representation import PackageScanFormSubmission
 
 
@@ -172,7 +172,7 @@ class FormSubmissionTestCase(TestCase):
         form_data = PackageScanFormSubmission(json.loads(PACKAGE_DATA))
         FormSubmission.from_ona_form_data(form_data)
         self.assertFalse(PackageScan.objects.all())
-        self.assertTrue(mock_logging.exception.called)
+        self.assertTrue(mock_logging.error.called)
 
     @patch('ona.models.logger')
     def test_record_package_location_malformed_uuid(self, mock_logging):
@@ -249,3 +249,37 @@ class FormSubmissionTestCase(TestCase):
         form_data = PackageScanFormSubmission(data)
         FormSubmission.from_ona_form_data(form_data)
         self.assertTrue(mock_logging.error.called)
+
+
+class FormDefinitionTestCase(TestCase):
+    def setUp(self):
+        self.definition = json.loads(PACKAGE_DATA)['form_definition']
+
+    def test_saved_once(self):
+        form_definition = FormDefinition.for_definition(123, self.definition)
+        self.assertEqual(form_definition, FormDefinition.for_definition(123, self.definition))
+        # Another form
+        self.assertNotEqual(form_definition, FormDefinition.for_definition(456, self.definition))
+        # A new version of the form
+        self.definition['version'] = '201407251719'
+        new_definition = FormDefinition.for_definition(123, self.definition)
+        self.assertNotEqual(form_definition, new_definition)
+        self.assertEqual('201407251719', new_definition.version)
+        self.assertEqual(3, FormDefinition.objects.count())
+
+    def test_location_labels(self):
+        form_definition = FormDefinition.for_definition(123, self.definition)
+        labels = form_definition.get_location_labels()
+        self.assertEqual('English Zero_Point', labels.get('Zero_Point'))
+        # Only parsed the once
+        self.assertIs(labels, FormDefinition.objects.get().get_location_labels())
+
+    @override_settings(ONA_FORM_IDS=[123])
+    def test_record_package_location(self):
+        # The label comes from the submission's form definition
+        PackageFactory(code=QR_CODE)
+        data = json.loads(PACKAGE_DATA)
+        form_definition = FormDefinition.for_definition(123, data.pop('form_definition'))
+        obj = FormSubmission.from_ona_form_data(PackageScanFormSubmission(data), form_definition)
+        self.assertNotIn('form_definition', FormSubmission.objects.get(pk=obj.pk).data)
+        self.assertEqual('English Zero_Point', PackageScan.objects.get().status_label)
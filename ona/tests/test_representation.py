@@ -1,9 +1,10 @@
+import json
 import pytz
 import unittest
 
 from datetime import datetime
 
-from ona.representation import OnaItemBase, PackageScanFormSubmission
+from ona.representation import LocationLabels, OnaItemBase, PackageScanFormSubmission
 
 
 SUBMITTED_AT_FORMAT = '%Y-%m-%dT%H:%M:%S'
@@ -19,6 +20,19 @@ PACKAGE_JSON = {
     u'[{"package/qr_code": "test", "package/position": "1"}]'
 }
 
+FORM_DEFINITION = {
+    'choices': {
+        'location_list': [
+            {'name': 'STATUS_IN_TRANSIT-Pre-Distribution_Point',
+             'label': {'Arabic': 'Arabic Pre', 'English': 'English Pre'}},
+            {'name': 'STATUS_RECEIVED-Distribution_Point',
+             'label': {'Arabic': 'Arabic Distribution', 'English': 'English Distribution'}},
+            {'name': 'STATUS_RECEIVED',
+             'label': {'Arabic': 'Arabic Received'}},
+        ]
+    }
+}
+
 
 class TestOnaItem(unittest.TestCase):
 
@@ -103,3 +117,40 @@ class ProductTestCase(unittest.TestCase):
 
     def test_get_gps_data_out_of_range(self):
         self.assertIsNone(self.form_submission.get_gps_data(100))
+
+
+class LocationLabelsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = LocationLabels(FORM_DEFINITION)
+
+    def test_suffix(self):
+        self.assertEqual('English Pre', self.labels.get('Pre-Distribution_Point'))
+        # Not the first name with it in
+        self.assertEqual('English Distribution', self.labels.get('Distribution_Point'))
+
+    def test_no_suffix(self):
+        # No English label
+        self.assertEqual('', self.labels.get('STATUS_RECEIVED'))
+
+    def test_part_of_name(self):
+        self.assertEqual('English Pre', self.labels.get('Pre-Distribution'))
+
+    def test_unknown(self):
+        self.assertEqual('', self.labels.get('Nowhere'))
+
+    def test_json(self):
+        labels = LocationLabels(json.dumps(FORM_DEFINITION))
+        self.assertEqual('English Pre', labels.get('Pre-Distribution_Point'))
+
+    def test_no_locations(self):
+        self.assertEqual('', LocationLabels({}).get('Pre-Distribution_Point'))
+
+    def test_packagescan_label(self):
+        data = dict(PACKAGE_JSON, current_location='STATUS_RECEIVED-Distribution_Point')
+        submission = PackageScanFormSubmission(data)
+        self.assertEqual('English Distribution',
+                         submission.get_current_packagescan_label(self.labels))
+        # From a definition in the submission
+        data['form_definition'] = json.dumps(FORM_DEFINITION)
+        self.assertEqual('English Distribution', submission.get_current_packagescan_label())
@@ -2,19 +2,25 @@ import json
 
 from copy import deepcopy
 from mock import patch, ANY
+import threading
+from uuid import uuid4
 from django.conf import settings
+from django.db import connection
 
 from django.test import TestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from accounts.models import CtsUser
 from accounts.tests.factories import CtsUserFactory
-from ona.representation import OnaItemBase
-from shipments.models import PackageScan, Shipment
+from ona.representation import OnaItemBase, PackageScanFormSubmission
+from shipments.models import Package, PackageScan, Shipment
 from shipments.tests.factories import PackageFactory
-from ona.models import FormSubmission, minimum_aware_datetime
+from ona.models import FormDefinition, FormSubmission, LastFormRetrievalTimestamp, \
+    minimum_aware_datetime, record_package_scans
+from ona.api import OnaApiClientException
 from ona.tasks import process_new_scans, verify_deviceid, reset_bad_form_ids, bad_form_ids, \
-    forget_form_definitions
+    forget_form_definitions, lock_form, unlock_form
+from ona.tests.fake_ona import FakeOnaServer
 from ona.tests.test_models import PACKAGE_DATA, USER_CODE_DATA, QR_CODE
 
 
@@ -24,7 +30,7 @@ from ona.tests.test_models import PACKAGE_DATA, USER_CODE_DATA, QR_CODE
     ONA_FORM_IDS=[123, 456],
     ONA_DOMAIN='ona.io'
 )
-@patch('ona.tasks.OnaApiClient.get_form_submissions')
+@patch('ona.tasks.OnaApiClient.iter_form_submission_pages')
 @patch('ona.tasks.OnaApiClient.get_form_definition')
 class ProcessNewPackageScansTestCase(TestCase):
     def setUp(self):
@@ -36,7 +42,7 @@ class ProcessNewPackageScansTestCase(TestCase):
         # The test DATA fixture already contains the form def json
         submission = json.loads(PACKAGE_DATA)
         mock_ona_form_def.return_value = submission['form_definition']
-        mock_ona_form_submissions.return_value = [submission]
+        mock_ona_form_submissions.return_value = [[submission]]
         process_new_scans.run()
         self.assertEqual(1, FormSubmission.objects.count())
         # Only add the record once
@@ -46,16 +52,16 @@ class ProcessNewPackageScansTestCase(TestCase):
     def test_update_package_multiple_locations(self, mock_ona_form_def, mock_ona_form_submissions):
         PackageFactory(code=QR_CODE)
         self.assertFalse(FormSubmission.objects.all())
-        # The test DATA fixture already contains the form def json
+        # The labels come from the form definition, not the submissions
         submission = json.loads(PACKAGE_DATA)
+        mock_ona_form_def.return_value = submission.pop('form_definition')
         other_submission = deepcopy(submission)
         other_submission.update(
             _uuid="2a11435f-8eaf-44f9-bd75-00a4bac8fbce",
             current_location="STATUS_RECEIVED",
             _submission_time="2014-07-25T17:19:16",
         )
-        mock_ona_form_def.return_value = submission['form_definition']
-        mock_ona_form_submissions.return_value = [submission, other_submission]
+        mock_ona_form_submissions.return_value = [[submission, other_submission]]
         process_new_scans.run()
         self.assertEqual(2, FormSubmission.objects.count())
         loc = PackageScan.objects.all().order_by('when')[0]
@@ -67,6 +73,105 @@ class ProcessNewPackageScansTestCase(TestCase):
         self.assertEqual(loc.package.status, Shipment.STATUS_RECEIVED)
         self.assertEqual(loc.package.shipment.status, Shipment.STATUS_RECEIVED)
 
+    def make_submissions(self, count):
+        """Return `count` new submissions, each scanning a new package"""
+        submissions = []
+        for i in range(count):
+            package = PackageFactory()
+            submission = json.loads(PACKAGE_DATA)
+            del submission['form_definition']
+            submission.update(
+                _uuid=str(uuid4()),
+                package=[{"package/qr_code": package.code, "package/position": "1"}],
+            )
+            submissions.append(submission)
+        return submissions
+
+    def test_form_definition_saved_once(self, mock_ona_form_def, mock_ona_form_submissions):
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        mock_ona_form_submissions.side_effect = lambda form_id, since: [self.make_submissions(2)]
+        process_new_scans.run()
+        process_new_scans.run()
+        # One for each form, fetched from Ona the once
+        self.assertEqual(2, FormDefinition.objects.count())
+        self.assertEqual(2, mock_ona_form_def.call_count)
+        for form_definition in FormDefinition.objects.all():
+            self.assertEqual(4, form_definition.submissions.count())
+        for submission in FormSubmission.objects.all():
+            self.assertNotIn('form_definition', submission.data)
+        self.assertEqual({'English Zero_Point'},
+                         set(PackageScan.objects.values_list('status_label', flat=True)))
+
+    @patch('ona.tasks.FORM_DEFINITION_MAX_AGE', 0)
+    def test_form_definition_changed(self, mock_ona_form_def, mock_ona_form_submissions):
+        form_def = json.loads(PACKAGE_DATA)['form_definition']
+        mock_ona_form_def.return_value = form_def
+        mock_ona_form_submissions.side_effect = lambda form_id, since: [self.make_submissions(1)]
+        process_new_scans.run()
+        # Someone renames a location on Ona
+        form_def = deepcopy(form_def)
+        form_def['choices']['location_list'][1]['label']['English'] = 'English Zero Point'
+        mock_ona_form_def.return_value = form_def
+        process_new_scans.run()
+        self.assertEqual(2 * 2, FormDefinition.objects.count())
+        self.assertEqual(['English Zero_Point'] * 2 + ['English Zero Point'] * 2,
+                         list(PackageScan.objects.order_by('pk')
+                              .values_list('status_label', flat=True)))
+
+    def test_batch_queries(self, mock_ona_form_def, mock_ona_form_submissions):
+        # Saving a batch of submissions takes the same queries however big it is
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        # Get the checkpoints started
+        mock_ona_form_submissions.return_value = []
+        process_new_scans.run()
+        counts = []
+        for count in [2, 10]:
+            mock_ona_form_submissions.return_value = [self.make_submissions(count)]
+            with CaptureQueriesContext(connection) as queries:
+                process_new_scans.run()
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(12, FormSubmission.objects.count())
+        self.assertEqual(12, PackageScan.objects.count())
+        for package in Package.objects.all():
+            self.assertEqual(Shipment.STATUS_IN_TRANSIT, package.status)
+            self.assertEqual(package.scans.get(), package.last_scan)
+        self.assertEqual(12, Shipment.objects.filter(status=Shipment.STATUS_IN_TRANSIT).count())
+
+    def test_duplicates_in_batch(self, mock_ona_form_def, mock_ona_form_submissions):
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        submissions = self.make_submissions(2)
+        mock_ona_form_submissions.return_value = [submissions, [deepcopy(submissions[0])]]
+        process_new_scans.run()
+        self.assertEqual(2, FormSubmission.objects.count())
+        self.assertEqual(2, PackageScan.objects.count())
+
+    def test_malformed_in_batch(self, mock_ona_form_def, mock_ona_form_submissions):
+        # One bad submission doesn't lose the scans of the rest of its batch
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        submissions = self.make_submissions(4)
+        del submissions[1]['current_location']
+        submissions[2]['gps'] = 'north south'
+        mock_ona_form_submissions.return_value = [submissions]
+        process_new_scans.run()
+        self.assertEqual(4, FormSubmission.objects.count())
+        self.assertEqual(2, PackageScan.objects.count())
+        self.assertEqual(2, Package.objects.filter(status=Shipment.STATUS_IN_TRANSIT).count())
+
+    def test_batch_scans_fail(self, mock_ona_form_def, mock_ona_form_submissions):
+        # If the batch's scans can't be recorded together, they're tried one at a time
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        mock_ona_form_submissions.return_value = [self.make_submissions(3)]
+
+        def record_alone(form_submissions):
+            if len(form_submissions) > 1:
+                raise ValueError("Too many")
+            record_package_scans(form_submissions)
+
+        with patch('ona.tasks.record_package_scans', side_effect=record_alone):
+            process_new_scans.run()
+        self.assertEqual(3, PackageScan.objects.count())
+
     @patch('ona.tasks.logger')
     def test_bad_form_id(self, mock_logger, mock_ona_form_def, mock_ona_form_submissions):
         mock_ona_form_def.return_value = None
@@ -76,11 +181,134 @@ class ProcessNewPackageScansTestCase(TestCase):
 
     @patch('ona.tasks.logger')
     def test_skip_next_bad_form_id(self, mock_logger, mock_ona_form_def, mock_ona_form_submissions):
-        mock_ona_form_def.return_value = None
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        mock_ona_form_submissions.return_value = []
         bad_form_ids.add(settings.ONA_FORM_IDS[0])
         process_new_scans.run()
         # no error logged because we just skip the bad form id
         self.assertFalse(mock_logger.error.called)
+        # but the other form is still looked at
+        mock_ona_form_def.assert_called_once_with(settings.ONA_FORM_IDS[1])
+
+    def test_bad_form_id_isolated(self, mock_ona_form_def, mock_ona_form_submissions):
+        form_def = json.loads(PACKAGE_DATA)['form_definition']
+        mock_ona_form_def.side_effect = lambda form_id: None if form_id == 123 else form_def
+        mock_ona_form_submissions.return_value = [[json.loads(PACKAGE_DATA)]]
+        process_new_scans.run()
+        self.assertEqual({123}, bad_form_ids)
+        self.assertEqual(1, FormSubmission.objects.count())
+
+    def test_error_isolated(self, mock_ona_form_def, mock_ona_form_submissions):
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+
+        def pages(form_id, since):
+            if form_id == 123:
+                raise OnaApiClientException(500, "Server error")
+            return [[json.loads(PACKAGE_DATA)]]
+
+        mock_ona_form_submissions.side_effect = pages
+        process_new_scans.run()
+        self.assertEqual(1, FormSubmission.objects.count())
+        # Each form has its own checkpoint
+        self.assertEqual(minimum_aware_datetime(),
+                         LastFormRetrievalTimestamp.objects.get(form_id=123).timestamp)
+        self.assertLess(minimum_aware_datetime(),
+                        LastFormRetrievalTimestamp.objects.get(form_id=456).timestamp)
+
+    def test_form_still_being_processed(self, mock_ona_form_def, mock_ona_form_submissions):
+        mock_ona_form_def.return_value = json.loads(PACKAGE_DATA)['form_definition']
+        mock_ona_form_submissions.return_value = []
+        locked = threading.Event()
+        done = threading.Event()
+
+        def hold_lock():
+            # In another worker, as far as the database can tell
+            try:
+                lock_form(123)
+                locked.set()
+                done.wait()
+                unlock_form(123)
+            finally:
+                locked.set()
+                connection.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        try:
+            process_new_scans.run()
+        finally:
+            done.set()
+            thread.join()
+        mock_ona_form_def.assert_called_once_with(456)
+        # And it lets go when it's done
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM pg_locks WHERE locktype = 'advisory'")
+        self.assertEqual(0, cursor.fetchone()[0])
+
+
+@override_settings(
+    ONA_API_ACCESS_TOKEN='foo',
+    ONA_API_SCHEME='http',
+    ONA_FORM_IDS=[123],
+    ONA_PAGE_SIZE=2,
+)
+class ProcessNewScansFromServerTestCase(TestCase):
+    def setUp(self):
+        reset_bad_form_ids()
+        forget_form_definitions()
+        data = json.loads(PACKAGE_DATA)
+        self.submissions = []
+        for i in range(5):
+            submission = deepcopy(data)
+            del submission['form_definition']
+            submission.update(
+                _uuid=str(uuid4()),
+                _submission_time='2014-07-25T17:19:%02d' % i,
+            )
+            self.submissions.append(submission)
+        self.server = FakeOnaServer(forms={123: data['form_definition']},
+                                    submissions={123: self.submissions})
+
+    def run_task(self):
+        with self.server, self.settings(ONA_DOMAIN=self.server.domain):
+            process_new_scans.run()
+
+    def test_pages(self):
+        self.run_task()
+        self.assertEqual(5, FormSubmission.objects.count())
+        self.assertEqual(3, len(self.server.data_requests()))
+        checkpoint = LastFormRetrievalTimestamp.objects.get(form_id=123)
+        self.assertEqual(OnaItemBase.parse_form_datetime(self.submissions[-1]['_submission_time']),
+                         checkpoint.timestamp)
+
+    def test_resume(self):
+        # The form, the first page, and then the second page fails
+        self.server.failures.add(3)
+        self.run_task()
+        # The first page was kept
+        self.assertEqual(2, FormSubmission.objects.count())
+        checkpoint = LastFormRetrievalTimestamp.objects.get(form_id=123)
+        self.assertEqual(OnaItemBase.parse_form_datetime(self.submissions[1]['_submission_time']),
+                         checkpoint.timestamp)
+
+        self.server.failures.clear()
+        self.server.requests = []
+        self.run_task()
+        self.assertEqual(5, FormSubmission.objects.count())
+        # Starting from the end of the first page
+        query = json.loads(self.server.data_requests()[0]['query'])
+        self.assertEqual({'$gte': self.submissions[1]['_submission_time']},
+                         query['_submission_time'])
+
+    def test_starts_from_newest_submission(self):
+        # Before there were checkpoints for these forms
+        FormSubmission.from_ona_form_data(PackageScanFormSubmission(self.submissions[2]))
+        self.run_task()
+        query = json.loads(self.server.data_requests()[0]['query'])
+        self.assertEqual({'$gte': self.submissions[2]['_submission_time']},
+                         query['_submission_time'])
+        self.assertEqual(5 - 2, FormSubmission.objects.count())
 
 
 @override_settings(
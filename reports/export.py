@@ -0,0 +1,241 @@
+"""
+Streaming report downloads, and export jobs.
+
+django-tables2-reports renders a whole report into memory before sending
+any of it, which for years of items is more than a worker has time or
+memory for. Instead, these read the report's queryset a chunk at a time
+and send each row as soon as it's rendered.
+
+Reports with async_exports also let the page ask for a download to be
+made by a Celery task (reports.tasks.export_report), which saves it in the
+default storage, and then poll until it's ready. Each export is keyed by
+the report, its normalized filters, who's asking and the reports' data
+version, so asking again for the same thing gets the same file until the
+data changes.
+"""
+import csv
+from datetime import datetime, timedelta
+import tempfile
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.http import Http404, StreamingHttpResponse
+from django.utils.crypto import salted_hmac
+from django.utils.html import strip_tags
+from django_tables2.rows import BoundRow
+from django_tables2_reports.utils import REPORT_CONTENT_TYPES
+
+from .signals import get_data_version
+from .xlsx import xlsx_stream
+
+
+# How many records to have in memory at a time
+EXPORT_CHUNK_SIZE = 2000
+
+XLSX_CONTENT_TYPE = REPORT_CONTENT_TYPES['xlsx']
+
+# The formats we stream, with a label for the links to them
+STREAMING_FORMATS = [
+    ('CSV Report', 'csv'),
+    ('XLSX Report', 'xlsx'),
+]
+
+# Where export jobs save their files, in the default (MEDIA) storage
+EXPORT_DIRECTORY = 'report_exports'
+# How long a finished export can be downloaded
+EXPORT_MAX_AGE = 24 * 60 * 60
+# How long to wait for an export job before starting it again
+EXPORT_JOB_TIMEOUT = 60 * 60
+# How long to remember that an export job failed
+EXPORT_FAILURE_TIMEOUT = 5 * 60
+
+JOB_PENDING = 'pending'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+def iterate_in_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Iterate over the records of the queryset, in order, with no more than
+    `chunk_size` of them in memory at a time.
+
+    The PKs of the records are read from a server-side cursor, and each
+    chunk of records is then fetched by PK (with the queryset's
+    prefetch_related(), so one query per chunk per relation rather than
+    per record). Anything that isn't a queryset of model instances, like
+    the small values() querysets of summary reports, is just iterated.
+    """
+    if not isinstance(queryset, QuerySet):
+        for record in queryset:
+            yield record
+        return
+    if isinstance(queryset, ValuesQuerySet):
+        for record in queryset.iterator():
+            yield record
+        return
+
+    sql, params = queryset.values_list('pk', flat=True).query.sql_with_params()
+    connection.ensure_connection()
+    if connection.vendor == 'postgresql':
+        # WITH HOLD, so it works outside of a transaction too
+        cursor = connection.connection.cursor('export_%s' % uuid4().hex, withhold=True)
+    else:
+        cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        unordered = queryset.order_by()
+        while True:
+            pks = [row[0] for row in cursor.fetchmany(chunk_size)]
+            if not pks:
+                break
+            records = unordered.in_bulk(pks)
+            for pk in pks:
+                # Skip any that were deleted since the cursor read them
+                record = records.get(pk)
+                if record is not None:
+                    yield record
+    finally:
+        cursor.close()
+
+
+def table_rows(table, records):
+    """
+    Yield the header of the report table and then the cells for each of
+    the records, as TableReport.as_csv() would write them.
+    """
+    table.exclude = table.exclude_from_report
+    columns = list(table.columns)
+    yield [column.header for column in columns]
+    for record in records:
+        row = BoundRow(record, table)
+        cells = []
+        for column in columns:
+            cell = row[column.name]
+            if isinstance(cell, basestring):
+                cell = strip_tags(cell)
+            cells.append(cell)
+        yield cells
+
+
+class Echo(object):
+    """Just returns what's written to it, so csv.writer() can make lines for us"""
+    def write(self, value):
+        return value
+
+
+def csv_stream(rows):
+    """Yield the rows as lines of CSV, in the encoding our downloads use"""
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow([
+            unicode(cell).encode(settings.DEFAULT_CHARSET) for cell in row
+        ])
+
+
+def content_type(report_format):
+    if report_format == 'csv':
+        return REPORT_CONTENT_TYPES['csv']
+    elif report_format == 'xlsx':
+        return XLSX_CONTENT_TYPE
+    raise Http404("This format %s is not accepted" % report_format)
+
+
+def report_content(table, report_format):
+    """
+    Return an iterator over the bytes of the table's data as a CSV or XLSX
+    file, which reads and renders it a chunk at a time.
+    """
+    rows = table_rows(table, iterate_in_chunks(table.data.data))
+    if report_format == 'csv':
+        return csv_stream(rows)
+    elif report_format == 'xlsx':
+        return xlsx_stream(rows, sheet_name=table.data.verbose_name_plural.title())
+    raise Http404("This format %s is not accepted" % report_format)
+
+
+def streaming_report_response(table, report_format, filename):
+    """
+    Return a StreamingHttpResponse downloading the table's data as CSV or
+    XLSX, as it's read.
+    """
+    response = StreamingHttpResponse(report_content(table, report_format),
+                                     content_type=content_type(report_format))
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, report_format)
+    return response
+
+
+def export_job_key(report_name, params, scope, report_format):
+    """
+    Return the key of the export of the named report with the given
+    normalized filter and sort parameters, for users who can see `scope`,
+    as of the current data version.
+    """
+    value = repr((report_name, params, scope, report_format, get_data_version()))
+    # Keyed with the secret key, so the file names can't be guessed
+    return salted_hmac('reports.export', value).hexdigest()
+
+
+def _job_cache_key(job_key):
+    return 'reports:export:%s' % job_key
+
+
+def get_export_job(job_key):
+    """
+    Return a dictionary with the `status` of the export job, and once it's
+    done, the `name` of its file in the default storage; or None if
+    there's no such job.
+    """
+    job = cache.get(_job_cache_key(job_key))
+    if job and job['status'] == JOB_DONE and not default_storage.exists(job['name']):
+        # Its file has been cleaned up
+        cache.delete(_job_cache_key(job_key))
+        return None
+    return job
+
+
+def claim_export_job(job_key):
+    """
+    Mark the export job pending, unless there's already a job with that
+    key. Returns whether it did, and so the caller should start the job.
+    """
+    return cache.add(_job_cache_key(job_key), {'status': JOB_PENDING}, EXPORT_JOB_TIMEOUT)
+
+
+def save_export(job_key, table, report_format):
+    """Save the table's data to a file in the default storage, and mark the job done"""
+    with tempfile.TemporaryFile() as f:
+        for data in report_content(table, report_format):
+            f.write(data)
+        f.seek(0)
+        name = default_storage.save(
+            '%s/%s.%s' % (EXPORT_DIRECTORY, job_key, report_format), File(f))
+    cache.set(_job_cache_key(job_key), {'status': JOB_DONE, 'name': name}, EXPORT_MAX_AGE)
+
+
+def fail_export(job_key):
+    cache.set(_job_cache_key(job_key), {'status': JOB_FAILED}, EXPORT_FAILURE_TIMEOUT)
+
+
+def delete_old_exports():
+    """
+    Delete the export files that are too old for any job to refer to.
+    Returns how many it deleted.
+    """
+    try:
+        directories, filenames = default_storage.listdir(EXPORT_DIRECTORY)
+    except OSError:
+        # Nothing has been exported yet
+        return 0
+    cutoff = datetime.now() - timedelta(seconds=EXPORT_MAX_AGE + EXPORT_JOB_TIMEOUT)
+    count = 0
+    for filename in filenames:
+        name = '%s/%s' % (EXPORT_DIRECTORY, filename)
+        if default_storage.modified_time(name) < cutoff:
+            default_storage.delete(name)
+            count += 1
+    return count
@@ -1,12 +1,13 @@
 import datetime
-from operator import methodcaller
 
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
 from django.forms import CheckboxSelectMultiple
 
 import django_filters
 
 from accounts.models import ROLE_PARTNER, CtsUser
-from reports.models import DonorCategoryData, DonorShipmentData
+from reports.models import DonorCategoryData, DonorShipmentData, ShipmentMonthlyData
 from shipments.models import PackageDBView, ShipmentDBView, PackageItemDBView, Shipment
 
 
@@ -20,6 +21,48 @@ THIS_YEAR = datetime.date.today().year
 DATE_INPUT_FORMATS = ['%m/%d/%Y']
 DATE_INPUT_HELP = "(M/D/Y)"
 
+SHIPMENT_CHOICES_KEY = 'reports:shipment_choices'
+
+
+def get_shipment_choices():
+    """
+    Return a list of (pk, label, partner_id) for all the shipments, sorted
+    on the label, for choosing a shipment to filter by. It's cached until a
+    shipment or user (whose name can be in the labels) is saved or deleted,
+    or a shipment is soft-deleted. Shipments changed with update() otherwise
+    only have their status, donor or scan label changed, which aren't in
+    the labels.
+    """
+    choices = cache.get(SHIPMENT_CHOICES_KEY)
+    if choices is None:
+        shipments = ShipmentDBView.objects.select_related('partner')
+        choices = sorted(((shipment.pk, unicode(shipment), shipment.partner_id)
+                          for shipment in shipments),
+                         key=lambda choice: choice[1])
+        cache.set(SHIPMENT_CHOICES_KEY, choices, None)
+    return choices
+
+
+def invalidate_shipment_choices():
+    cache.delete(SHIPMENT_CHOICES_KEY)
+
+
+def get_user_shipment_choices(user, data):
+    """
+    Return the (pk, label, partner_id) of the shipments the user can choose
+    from, limited to those of the partner chosen in the filter form data,
+    if any.
+    """
+    if user.has_perm('reports.view_all_partners'):
+        try:
+            partner_id = int(data.get('partner'))
+        except (TypeError, ValueError):
+            partner_id = None
+    else:
+        partner_id = user.pk
+    return [choice for choice in get_shipment_choices()
+            if partner_id is None or choice[2] == partner_id]
+
 
 class ReportFilter(django_filters.FilterSet):
 
@@ -29,16 +72,17 @@ class ReportFilter(django_filters.FilterSet):
         super(ReportFilter, self).__init__(*args, **kwargs)
         for fltr in self.filters.values():
             if 'shipment' == fltr.name:
-                # override the options; sort on unicode of each Shipment
-                qs = fltr.field.choices.queryset
-                sorted_shipments = sorted(qs, key=methodcaller('__unicode__'))
-                # If they specified a partner, limit by that
-                if self.data.get('partner', False) is not False:
-                    partner_id = int(self.data['partner'])
-                    sorted_shipments = [shipment for shipment in sorted_shipments
-                                        if shipment.partner_id == partner_id]
-                fltr.field.choices = [(x.pk, x) for x in sorted_shipments]
-                fltr.field.choices.insert(0, (None, EMPTY_LABEL))
+                # There can be a lot of shipments, so only the chosen one is
+                # rendered, and the page looks the others up as they type
+                # (see ShipmentChoices)
+                fltr.field.widget.attrs['data-autocomplete-url'] = \
+                    reverse('report_shipment_choices')
+                chosen = (self.data or {}).get('shipment')
+                fltr.field.choices = [(None, EMPTY_LABEL)] + [
+                    (pk, label) for pk, label, partner_id
+                    in get_user_shipment_choices(self.user, self.data or {})
+                    if unicode(pk) == chosen
+                ]
             if isinstance(fltr, django_filters.ChoiceFilter):
                 fltr.field.choices.insert(0, (None, EMPTY_LABEL))
         if not self.user.has_perm('reports.view_all_partners') and 'partner' in self.filters:
@@ -62,6 +106,7 @@ class PackageReportFilter(ReportFilter):
         queryset=CtsUser.objects.filter(role=ROLE_PARTNER).order_by('name')
     )
     status = django_filters.MultipleChoiceFilter(
+        name='effective_status',
         choices=Shipment.SHIPMENT_STATUS_CHOICES,
         widget=CheckboxSelectMultiple,
         label="Shipment status",
@@ -144,7 +189,7 @@ class ItemReportFilter(ReportFilter):
         queryset=CtsUser.objects.filter(role=ROLE_PARTNER).order_by('name')
     )
     status = django_filters.MultipleChoiceFilter(
-        name='package__status',
+        name='package__effective_status',
         choices=Shipment.SHIPMENT_STATUS_CHOICES,
         widget=CheckboxSelectMultiple,
         label='Package status'
@@ -239,5 +284,5 @@ class ShipmentMonthlySummaryReportFilter(ReportFilter):
     )
 
     class Meta:
-        model = ShipmentDBView
-        fields = ('partner', )
+        model = ShipmentMonthlyData
+        fields = ('partner', 'donor')
@@ -0,0 +1,80 @@
+"""
+A cache of the reports' rendered AJAX tables.
+
+Many people look at the same reports, often without any filters, and the
+data only changes now and then. So the HTML of each report table is kept,
+keyed by the report, the request's parameters, whose data the user can see
+and the reports' data version, and served again from there without
+querying the report data at all until something changes.
+
+The cache used is the one named by the REPORT_FRAGMENT_CACHE setting, or
+if there's no such cache configured, one in local memory (which is fine
+for tests and development, but isn't shared between processes).
+
+Hits and misses are counted, in the same cache; see fragment_cache_stats().
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from .signals import get_data_version
+
+
+FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
+HITS_KEY = 'reports:fragments:hits'
+MISSES_KEY = 'reports:fragments:misses'
+
+_local_cache = None
+
+
+def get_fragment_cache():
+    global _local_cache
+    alias = getattr(settings, 'REPORT_FRAGMENT_CACHE', None)
+    if alias in settings.CACHES:
+        return caches[alias]
+    if _local_cache is None:
+        _local_cache = LocMemCache('reports-fragments', {})
+    return _local_cache
+
+
+def fragment_key(report_name, params, scope):
+    """
+    Return the key of the rendered table of the named report with the
+    given normalized request parameters, for users who can see `scope`, as
+    of the current data version.
+    """
+    value = repr((report_name, params, scope, get_data_version()))
+    return 'reports:fragment:%s' % hashlib.md5(value).hexdigest()
+
+
+def get_fragment(key):
+    """Return the cached HTML for the key, or None, and count the hit or miss"""
+    content = get_fragment_cache().get(key)
+    _count(MISSES_KEY if content is None else HITS_KEY)
+    return content
+
+
+def set_fragment(key, content):
+    get_fragment_cache().set(key, content, FRAGMENT_CACHE_TIMEOUT)
+
+
+def _count(key):
+    cache = get_fragment_cache()
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted since we added it
+            cache.set(key, 1, None)
+
+
+def fragment_cache_stats():
+    """Return how many hits and misses there have been, as a dictionary"""
+    values = get_fragment_cache().get_many([HITS_KEY, MISSES_KEY])
+    return {
+        'hits': values.get(HITS_KEY, 0),
+        'misses': values.get(MISSES_KEY, 0),
+    }
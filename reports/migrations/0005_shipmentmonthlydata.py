@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models, migrations
+import django.core.validators
+
+import cts.utils
+
+
+def rebuild(apps, schema_editor):
+    from reports.signals import rebuild_shipment_monthly_data
+    rebuild_shipment_monthly_data()
+
+
+def do_nothing(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0008_auto_20151211_0743'),
+        ('shipments', '0029_package_effective_status'),
+        ('reports', '0004_auto_20141023_1542'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShipmentMonthlyData',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('month', models.DateField(help_text=b'First day of the month the Shipments were shipped.', db_index=True)),
+                ('status', models.IntegerField(help_text=b'Status of the Shipments.')),
+                ('all_donors', models.BooleanField(default=False, help_text=b"Whether this row totals the Shipments' items from all donors, rather than just this donor's.")),
+                ('shipment_count', models.PositiveIntegerField(default=0, help_text=b'Number of Shipments (containing at least one PackageItem that was given by this donor, unless all_donors).')),
+                ('package_count', models.PositiveIntegerField(default=0, help_text=b'Number of Packages in the Shipments (containing at least one PackageItem that was given by this donor, unless all_donors).')),
+                ('item_count', models.PositiveIntegerField(default=0, help_text=b'Number of PackageItems in the Shipments.')),
+                ('quantity', models.PositiveIntegerField(default=0, help_text=b'Total quantity of PackageItems in the Shipments.')),
+                ('price_local', models.DecimalField(default=Decimal('0.0000'), help_text=b'Total extended local price of the PackageItems.', verbose_name=b'Total Price (Local)', max_digits=16, decimal_places=4)),
+                ('price_usd', cts.utils.USDCurrencyField(decimal_places=3, default=Decimal('0.00'), max_digits=16, validators=[django.core.validators.MinValueValidator(0.0)], help_text=b'Total extended US price of the PackageItems.', verbose_name=b'Total Price (USD)')),
+                ('donor', models.ForeignKey(blank=True, to='catalog.Donor', null=True)),
+                ('partner', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='shipmentmonthlydata',
+            index_together=set([('month', 'partner')]),
+        ),
+        migrations.RunPython(rebuild, do_nothing),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def rebuild(apps, schema_editor):
+    # Concurrent refreshes might have left duplicate rows
+    from reports.signals import rebuild_shipment_monthly_data
+    rebuild_shipment_monthly_data()
+
+
+def do_nothing(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0005_shipmentmonthlydata'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild, do_nothing),
+        migrations.RunSQL(
+            """
+            CREATE UNIQUE INDEX reports_shipmentmonthlydata_unique
+            ON reports_shipmentmonthlydata (month, partner_id, COALESCE(donor_id, 0), status,
+                                            all_donors)
+            """,
+            "DROP INDEX reports_shipmentmonthlydata_unique",
+        ),
+    ]
@@ -85,3 +85,59 @@ class DonorCategoryData(models.Model):
 
     class Meta:
         unique_together = [('donor', 'category')]
+
+
+class ShipmentMonthlyData(models.Model):
+    """Aggregates data about Shipments grouped by month shipped, partner,
+    donor and status.
+
+    For each month, partner and status, there's a row with
+    all_donors=True and no donor, totalling whole shipments (including
+    ones with no items yet), and a row with all_donors=False for each
+    donor (or no donor) of their items, totalling just those items.
+
+    Signals are used to update this table automatically when Shipments,
+    Packages or PackageItems are saved or deleted.
+
+    """
+    month = models.DateField(
+        db_index=True,
+        help_text="First day of the month the Shipments were shipped.")
+    partner = models.ForeignKey('accounts.CtsUser')
+    donor = models.ForeignKey('catalog.Donor', null=True, blank=True)
+    status = models.IntegerField(
+        help_text="Status of the Shipments.")
+    all_donors = models.BooleanField(
+        default=False,
+        help_text="Whether this row totals the Shipments' items from all "
+                  "donors, rather than just this donor's.")
+
+    shipment_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of Shipments (containing at least one PackageItem "
+                  "that was given by this donor, unless all_donors).")
+    package_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of Packages in the Shipments (containing at least "
+                  "one PackageItem that was given by this donor, unless "
+                  "all_donors).")
+    item_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of PackageItems in the Shipments.")
+    quantity = models.PositiveIntegerField(
+        default=0,
+        help_text="Total quantity of PackageItems in the Shipments.")
+    price_local = models.DecimalField(
+        default=Decimal('0.0000'), max_digits=16, decimal_places=4,
+        verbose_name="Total Price (Local)",
+        help_text="Total extended local price of the PackageItems.")
+    price_usd = USDCurrencyField(
+        max_digits=16,
+        verbose_name="Total Price (USD)",
+        help_text="Total extended US price of the PackageItems.")
+
+    class Meta:
+        index_together = [('month', 'partner')]
+        # Migration 0006 also adds a unique index on (month, partner,
+        # donor, status, all_donors), counting no donor as donor 0, which
+        # Django can't express.
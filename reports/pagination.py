@@ -0,0 +1,364 @@
+"""
+Keyset ("seek") pagination for the report tables.
+
+OFFSET/LIMIT makes the database produce and throw away every row before
+the page, so deep pages of a report cost more and more. Instead, each page
+is found by filtering for the rows that come after (or before) the last
+(or first) row of the page we came from, in the table's ordering, plus the
+PK to make the ordering total. Page N then costs the same as page 1.
+
+The position is passed around as an opaque cursor token, signed so it
+can't be tampered with, in the table's page parameter. django-tables2's
+templates link to the previous and next pages with the page's
+previous_page_number() and next_page_number(), so KeysetPage returns the
+cursors from those.
+
+The total number of rows is only needed for the "Page N of M" and row
+count, so the paginator takes a function to get it (which the reports
+cache) rather than counting on every page.
+
+Tables with footer totals can have the paginator work them out along with
+the page: the page's query then also selects SUM() OVER () of the columns
+and COUNT(*) OVER (), which PostgreSQL computes over all the rows that
+match the filters, before the LIMIT. That's only right for the first page,
+which has no keyset condition; other pages are left to the caller.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+import hashlib
+from math import ceil
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.functional import cached_property
+from django_tables2.rows import BoundRow
+
+
+CURSOR_SALT = 'reports.pagination'
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+# Names of the window aggregates' annotations
+WINDOW_PREFIX = 'window_'
+WINDOW_COUNT = WINDOW_PREFIX + 'count'
+
+
+def keyset_ordering(queryset):
+    """
+    Return the ordering of the queryset as a list of (lookup, descending,
+    nullable) keys on concrete columns, ending with the PK, so that it's
+    total; or None if it can't be paginated by keyset (e.g. it's not a
+    queryset of model instances, or orders randomly or by raw SQL).
+
+    Ordering by a relation orders by the related model's ordering, as the
+    ORM does, so the keys name the columns that really decide the order.
+    """
+    if not isinstance(queryset, QuerySet) or isinstance(queryset, ValuesQuerySet):
+        return None
+    query = queryset.query
+    if query.extra_order_by:
+        return None
+    if query.order_by:
+        ordering = query.order_by
+    elif query.default_ordering:
+        ordering = query.get_meta().ordering
+    else:
+        ordering = []
+
+    model = queryset.model
+    keys = []
+    for name in ordering:
+        expanded = _expand(model, name, query.annotations)
+        if expanded is None:
+            return None
+        keys.extend(expanded)
+    pk_name = model._meta.pk.name
+    if not any(lookup == pk_name for lookup, descending, nullable in keys):
+        keys.append((pk_name, False, False))
+    return keys
+
+
+def _expand(model, name, annotations=(), descending=False, nullable=False, seen=()):
+    if not isinstance(name, basestring) or name == '?':
+        return None
+    if name.startswith('-'):
+        descending = not descending
+        name = name[1:]
+    if name in annotations:
+        return [(name, descending, True)]
+    opts = model._meta
+    path = []
+    parts = name.split(LOOKUP_SEP)
+    for i, part in enumerate(parts):
+        if part == 'pk':
+            part = opts.pk.name
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete:
+            return None
+        path.append(part)
+        nullable = nullable or field.null
+        last = i == len(parts) - 1
+        if not field.is_relation:
+            if not last:
+                return None
+            continue
+        if not (field.many_to_one or field.one_to_one):
+            return None
+        related = field.related_model
+        if not last:
+            opts = related._meta
+            continue
+        if part == field.attname:
+            # The FK column itself, e.g. 'shipment_id'
+            continue
+        # Ordering by the relation orders by the related model's ordering
+        if related in seen:
+            return None
+        keys = []
+        prefix = LOOKUP_SEP.join(path) + LOOKUP_SEP
+        for related_name in related._meta.ordering or [related._meta.pk.name]:
+            expanded = _expand(related, related_name, (), descending, nullable,
+                               seen + (related,))
+            if expanded is None:
+                return None
+            keys.extend((prefix + lookup, desc, null) for lookup, desc, null in expanded)
+        return keys
+    return [(LOOKUP_SEP.join(path), descending, nullable)]
+
+
+def _after(keys, values):
+    """
+    Return a Q for the rows that come after the given values of the keys,
+    in the order of the keys. PostgreSQL puts NULLs last in ascending
+    order and first in descending order.
+    """
+    conditions = []
+    equal = Q()
+    for (lookup, descending, nullable), value in zip(keys, values):
+        if value is None:
+            if descending:
+                conditions.append(equal & Q(**{lookup + '__isnull': False}))
+            # else nothing comes after NULL
+            equal &= Q(**{lookup + '__isnull': True})
+        else:
+            if descending:
+                condition = Q(**{lookup + '__lt': value})
+            else:
+                condition = Q(**{lookup + '__gt': value})
+                if nullable:
+                    condition |= Q(**{lookup + '__isnull': True})
+            conditions.append(equal & condition)
+            equal &= Q(**{lookup: value})
+    if not conditions:
+        return None
+    result = conditions[0]
+    for condition in conditions[1:]:
+        result |= condition
+    return result
+
+
+def with_window_totals(queryset, totals):
+    """
+    Annotate the rows of the queryset with the sums over all of its rows
+    of the fields in `totals` (a dictionary of names to field names), and
+    with the number of rows.
+    """
+    opts = queryset.model._meta
+    qn = connection.ops.quote_name
+    annotations = {WINDOW_COUNT: RawSQL('COUNT(*) OVER ()', ())}
+    for name, field_name in totals.items():
+        column = '%s.%s' % (qn(opts.db_table), qn(opts.get_field(field_name).column))
+        annotations[WINDOW_PREFIX + name] = RawSQL('SUM(%s) OVER ()' % column, ())
+    return queryset.annotate(**annotations)
+
+
+def _reverse(keys):
+    return [(lookup, not descending, nullable) for lookup, descending, nullable in keys]
+
+
+def _order_by(keys):
+    return ['-' + lookup if descending else lookup for lookup, descending, nullable in keys]
+
+
+def _encode(value):
+    """Make a key value JSON serializable, so it can be decoded exactly"""
+    if isinstance(value, datetime):
+        return ['datetime', value.isoformat()]
+    if isinstance(value, date):
+        return ['date', value.isoformat()]
+    if isinstance(value, Decimal):
+        return ['decimal', str(value)]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        kind, text = value
+        if kind == 'datetime':
+            return parse_datetime(text)
+        if kind == 'date':
+            return parse_date(text)
+        if kind == 'decimal':
+            return Decimal(text)
+        raise ValueError("Unknown kind of value %r" % kind)
+    return value
+
+
+def _fingerprint(keys):
+    """Identify the ordering, so a cursor for another ordering is ignored"""
+    return hashlib.md5(u','.join(_order_by(keys)).encode('utf-8')).hexdigest()[:8]
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a table's queryset by keyset. Like Django's Paginator, but
+    pages are asked for by cursor rather than number.
+    """
+    def __init__(self, table, keys, per_page, count, totals=None):
+        """
+        `keys` are from keyset_ordering() of the table's queryset, and
+        `count` is a function returning how many rows there are.
+
+        If `totals` (a dictionary of names to field names) is given, the
+        first page's query works out the sums of those fields over all the
+        rows too, and they're left in `window_totals`.
+        """
+        self.table = table
+        self.queryset = table.data.queryset
+        self.keys = keys
+        self.per_page = per_page
+        self._count = count
+        self.totals = totals
+        self.window_count = None
+        self.window_totals = None
+        self.fingerprint = _fingerprint(keys)
+
+    @cached_property
+    def count(self):
+        if self.window_count is not None:
+            return self.window_count
+        return self._count()
+
+    @property
+    def num_pages(self):
+        return max(1, int(ceil(float(self.count) / self.per_page)))
+
+    def page(self, cursor=None):
+        """
+        Return the page the cursor leads to, or the first page if there's
+        no cursor or it's not valid for this ordering.
+        """
+        position = self.decode_cursor(cursor) if cursor else None
+        if position is None:
+            direction, values, number = NEXT, None, 1
+        else:
+            direction, values, number = position
+
+        keys = self.keys if direction == NEXT else _reverse(self.keys)
+        queryset = self.queryset
+        if values is not None:
+            condition = _after(keys, values)
+            queryset = queryset.none() if condition is None else queryset.filter(condition)
+        elif self.totals:
+            queryset = with_window_totals(queryset, self.totals)
+        records = list(queryset.order_by(*_order_by(keys))[:self.per_page + 1])
+        if values is None and self.totals:
+            self._set_window_totals(records)
+        more = len(records) > self.per_page
+        records = records[:self.per_page]
+
+        if direction == NEXT:
+            return KeysetPage(self, records, number, values is not None, more)
+        if not more:
+            # Back at the start, so show a whole first page
+            return self.page()
+        records.reverse()
+        return KeysetPage(self, records, max(2, number), True, True)
+
+    def _set_window_totals(self, records):
+        if records:
+            record = records[0]
+            self.window_count = getattr(record, WINDOW_COUNT)
+            self.window_totals = dict((name, getattr(record, WINDOW_PREFIX + name))
+                                      for name in self.totals)
+        else:
+            # Like aggregate() over no rows
+            self.window_count = 0
+            self.window_totals = dict((name, None) for name in self.totals)
+
+    def key_values(self, records):
+        """Return {pk: [values of the keys]} for the given records"""
+        lookups = [lookup for lookup, descending, nullable in self.keys]
+        rows = self.queryset.order_by().filter(pk__in=[record.pk for record in records])\
+            .values_list('pk', *lookups)
+        return dict((row[0], list(row[1:])) for row in rows)
+
+    def encode_cursor(self, direction, values, number):
+        return signing.dumps(
+            [self.fingerprint, direction, [_encode(value) for value in values], number],
+            salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, cursor):
+        """
+        Return the (direction, values, page number) of the cursor, or None if
+        it's not a valid cursor for this ordering.
+        """
+        try:
+            fingerprint, direction, values, number = signing.loads(cursor, salt=CURSOR_SALT)
+            values = [_decode(value) for value in values]
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+        if fingerprint != self.fingerprint or direction not in (NEXT, PREVIOUS) \
+                or len(values) != len(self.keys) or not isinstance(number, int):
+            return None
+        return direction, values, number
+
+
+class KeysetPage(object):
+    """
+    A page of a KeysetPaginator, with what django-tables2's templates use
+    from a Page. object_list holds the table's rows for the records.
+    """
+    def __init__(self, paginator, records, number, has_previous, has_next):
+        self.paginator = paginator
+        self.records = records
+        self.number = number
+        self._has_previous = has_previous
+        self._has_next = has_next
+        self.object_list = [BoundRow(record, paginator.table) for record in records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.records)
+
+    def has_next(self):
+        return self._has_next and bool(self.records)
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    @cached_property
+    def _boundary_values(self):
+        return self.paginator.key_values([self.records[0], self.records[-1]])
+
+    def previous_page_number(self):
+        """The cursor for the previous page"""
+        values = self._boundary_values[self.records[0].pk]
+        return self.paginator.encode_cursor(PREVIOUS, values, self.number - 1)
+
+    def next_page_number(self):
+        """The cursor for the next page"""
+        values = self._boundary_values[self.records[-1].pk]
+        return self.paginator.encode_cursor(NEXT, values, self.number + 1)
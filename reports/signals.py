@@ -1,9 +1,150 @@
+from contextlib import contextmanager
+from datetime import date
+import threading
+
 from django.dispatch import receiver
-from django.db.models.signals import post_delete, post_save
+from django.db import connection
+from django.db.models import Case, Count, DecimalField, ExpressionWrapper, F, IntegerField, \
+    Max, Min, Q, Sum, Value, When
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from accounts.models import CtsUser
+from cts.versions import ITEMS, PACKAGES, SHIPMENTS, bump_versions, deferred_version_bumps, \
+    versioned_atomic, versions_tag
+from shipments.deferred import deferred_shipment_updates
+from shipments.models import Package, PackageItem, Shipment
+
+from .filters import invalidate_shipment_choices
+from .models import DonorCategoryData, DonorShipmentData, ShipmentMonthlyData
+
+
+_state = threading.local()
+
+
+def get_data_version():
+    """
+    Return a value that changes whenever anything the reports show might
+    have changed, so things computed from the reports can be cached under it.
+    """
+    return versions_tag()
+
 
-from shipments.models import PackageItem, Shipment
+def _in_bulk_updates():
+    return getattr(_state, 'depth', 0) > 0
 
-from .models import DonorCategoryData, DonorShipmentData
+
+@contextmanager
+def bulk_updates():
+    """
+    Run the block in a transaction with the per-item report updates
+    suspended. The report rows for every (donor, shipment) and
+    (donor, category) touched in the block are recomputed together at the
+    end of it, with one statement per table.
+
+    Items written with bulk_create(), update() or raw SQL don't send
+    signals, so code doing that should pass them to note_changed_items().
+    Likewise shipments and packages, to note_changed_shipments().
+    """
+    with deferred_version_bumps(), deferred_shipment_updates():
+        if not _in_bulk_updates():
+            _state.depth = 0
+            _state.donor_shipments = set()
+            _state.donor_categories = set()
+            _state.shipment_ids = set()
+            _state.monthly_keys = set()
+        _state.depth += 1
+        try:
+            yield
+            if _state.depth == 1:
+                donor_shipments, _state.donor_shipments = _state.donor_shipments, set()
+                donor_categories, _state.donor_categories = _state.donor_categories, set()
+                shipment_ids, _state.shipment_ids = _state.shipment_ids, set()
+                monthly_keys, _state.monthly_keys = _state.monthly_keys, set()
+                shipment_ids.update(shipment_id for donor_id, shipment_id in donor_shipments)
+                monthly_keys.update(monthly_keys_of_shipments(shipment_ids))
+                refresh_donor_shipment_data(donor_shipments)
+                refresh_donor_category_data(donor_categories)
+                refresh_shipment_monthly_data(monthly_keys)
+        finally:
+            _state.depth -= 1
+
+
+def note_changed_items(items, categories=True):
+    """
+    The items in this PackageItem queryset have been (or are about to be)
+    added, changed or deleted, so update the report data for their donors,
+    shipments and categories. Pass categories=False if nothing that affects
+    DonorCategoryData has changed (e.g. only the package status).
+    """
+    donor_shipments, donor_categories = report_keys(items)
+    note_report_keys(donor_shipments, donor_categories if categories else ())
+
+
+def report_keys(items):
+    """
+    Return the (donor_id, shipment_id) and (donor_id, category_id) pairs
+    of the items in this PackageItem queryset, as two sets.
+    """
+    rows = items.values_list('donor_id', 'package__shipment_id', 'item_category_id').distinct()
+    donor_shipments = set()
+    donor_categories = set()
+    for donor_id, shipment_id, category_id in rows:
+        donor_shipments.add((donor_id, shipment_id))
+        donor_categories.add((donor_id, category_id))
+    return donor_shipments, donor_categories
+
+
+def note_report_keys(donor_shipments, donor_categories):
+    """Update the report data for these pairs, now or at the end of bulk_updates()"""
+    bump_versions(ITEMS)
+    if _in_bulk_updates():
+        _state.donor_shipments.update(donor_shipments)
+        _state.donor_categories.update(donor_categories)
+    else:
+        refresh_donor_shipment_data(donor_shipments)
+        refresh_donor_category_data(donor_categories)
+        refresh_shipment_monthly_data(monthly_keys_of_shipments(
+            shipment_id for donor_id, shipment_id in donor_shipments))
+
+
+def month_start(day):
+    """Return the first day of the month of the date (or datetime)"""
+    return date(day.year, day.month, 1)
+
+
+def monthly_keys_of_shipments(shipment_ids):
+    """
+    Return the (month, partner_id) pairs of the ShipmentMonthlyData rows
+    that the shipments with these PKs are counted in, as a set.
+    """
+    shipment_ids = set(shipment_ids)
+    if not shipment_ids:
+        return set()
+    rows = Shipment.all_objects.filter(pk__in=shipment_ids)\
+        .values_list('shipment_date', 'partner_id').distinct()
+    return set((month_start(shipment_date), partner_id) for shipment_date, partner_id in rows)
+
+
+def note_changed_shipments(shipment_ids):
+    """
+    The shipments with these PKs have been changed without being saved
+    (e.g. their status, with update()), or had packages added or removed, so
+    update the monthly report data for them, now or at the end of
+    bulk_updates().
+    """
+    bump_versions(SHIPMENTS, PACKAGES)
+    if _in_bulk_updates():
+        _state.shipment_ids.update(shipment_ids)
+    else:
+        refresh_shipment_monthly_data(monthly_keys_of_shipments(shipment_ids))
+
+
+def note_monthly_keys(monthly_keys):
+    """Update the monthly report data for these (month, partner_id) pairs"""
+    if _in_bulk_updates():
+        _state.monthly_keys.update(monthly_keys)
+    else:
+        refresh_shipment_monthly_data(monthly_keys)
 
 
 @receiver(post_save, sender=PackageItem)
@@ -12,44 +153,338 @@ def update_reports_from_item_signal(instance, **kwargs):
     donor_id = instance.donor_id
     category_id = instance.item_category_id
     shipment_id = instance.package.shipment_id
+    if _in_bulk_updates():
+        note_report_keys([(donor_id, shipment_id)], [(donor_id, category_id)])
+        return
     _update_donor_shipment_data(donor_id, shipment_id)
     _update_donor_category_data(donor_id, category_id)
+    refresh_shipment_monthly_data(monthly_keys_of_shipments([shipment_id]))
+
+
+@receiver(pre_save, sender=Shipment)
+def note_old_shipment_month(instance, **kwargs):
+    # If the shipment is moving to another month or partner, its old
+    # monthly data has to be updated too
+    instance._old_monthly_keys = set()
+    if not instance._state.adding:
+        instance._old_monthly_keys = monthly_keys_of_shipments([instance.pk])
+
+
+@receiver(post_save, sender=Shipment)
+@receiver(post_delete, sender=Shipment)
+def update_monthly_data_from_shipment_signal(instance, **kwargs):
+    monthly_keys = getattr(instance, '_old_monthly_keys', set())
+    monthly_keys.add((month_start(instance.shipment_date), instance.partner_id))
+    instance._old_monthly_keys = set()
+    note_monthly_keys(monthly_keys)
+
+
+@receiver(post_save, sender=Package)
+@receiver(post_delete, sender=Package)
+def update_monthly_data_from_package_signal(instance, created=True, **kwargs):
+    # Only adding or removing a package changes the package counts; the
+    # items in it are noted when they're saved.
+    if created:
+        note_changed_shipments([instance.shipment_id])
+
+
+@receiver(post_save, sender=Shipment)
+@receiver(post_delete, sender=Shipment)
+@receiver(post_save, sender=CtsUser)
+@receiver(post_delete, sender=CtsUser)
+def invalidate_shipment_choices_from_signal(update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    invalidate_shipment_choices()
+
+
+def _price_total(price_field_name, condition=None):
+    """Sum of quantity * price over the items, optionally only those matching a Q"""
+    extended_price = ExpressionWrapper(F('quantity') * F(price_field_name),
+                                       output_field=DecimalField())
+    if condition is not None:
+        extended_price = Case(When(condition, then=extended_price), default=Value(0),
+                              output_field=DecimalField())
+    return Sum(extended_price)
 
 
 def _update_donor_category_data(donor_id, category_id):
-    items = PackageItem.objects.filter(donor_id=donor_id, item_category_id=category_id)
-    if not items:
+    items = PackageItem.objects.filter(donor_id=donor_id, item_category_id=category_id,
+                                       package__shipment__deleted=False)
+    totals = items.aggregate(
+        item_count=Count('pk'),
+        total_quantity=Sum('quantity'),
+        price_local=_price_total('price_local'),
+        price_usd=_price_total('price_usd'),
+        first_date_shipped=Min('package__shipment__shipment_date'),
+        last_date_shipped=Max('package__shipment__shipment_date'),
+    )
+    if not totals['item_count']:
         DonorCategoryData.objects.filter(donor_id=donor_id, category_id=category_id).delete()
     else:
-        data, _ = DonorCategoryData.objects.get_or_create(donor_id=donor_id,
-                                                          category_id=category_id)
-        data.item_count = len(items)
-        data.total_quantity = sum(i.quantity for i in items)
-        data.price_local = sum(i.extended_price_local for i in items)
-        data.price_usd = sum(i.extended_price_usd for i in items)
-        shipments = Shipment.objects.filter(packages__items__in=items)
-        data.first_date_shipped = shipments.order_by('shipment_date').first().shipment_date
-        data.last_date_shipped = shipments.order_by('-shipment_date').first().shipment_date
-        data.save()
+        DonorCategoryData.objects.update_or_create(donor_id=donor_id, category_id=category_id,
+                                                   defaults=totals)
 
 
 def _update_donor_shipment_data(donor_id, shipment_id):
-    items = PackageItem.objects.filter(donor_id=donor_id, package__shipment_id=shipment_id)
-    if not items.exists():
+    # Aggregate over all the items in the shipment, so we get the totals for
+    # the donor's items and the shipment's item count in one query.
+    donor_items = Q(donor=None) if donor_id is None else Q(donor_id=donor_id)
+    received = Q(package__status=Shipment.STATUS_RECEIVED)
+    totals = PackageItem.objects.filter(package__shipment_id=shipment_id,
+                                        package__shipment__deleted=False).aggregate(
+        all_shipment_items_count=Count('pk'),
+        item_count=Sum(Case(When(donor_items, then=Value(1)), default=Value(0),
+                            output_field=IntegerField())),
+        delivered_count=Sum(Case(When(donor_items & received, then=Value(1)), default=Value(0),
+                                 output_field=IntegerField())),
+        package_count=Count(Case(When(donor_items, then=F('package')),
+                                 output_field=IntegerField()),
+                            distinct=True),
+        price_local=_price_total('price_local', donor_items),
+        price_usd=_price_total('price_usd', donor_items),
+    )
+    all_shipment_items_count = totals.pop('all_shipment_items_count')
+    if not totals['item_count']:
         DonorShipmentData.objects.filter(donor_id=donor_id, shipment_id=shipment_id).delete()
     else:
-        num_items = len(items)
-        all_shipment_items = PackageItem.objects.filter(package__shipment_id=shipment_id)
-        all_shipment_items_count = all_shipment_items.count()
-        data, _ = DonorShipmentData.objects.get_or_create(donor_id=donor_id,
-                                                          shipment_id=shipment_id)
-        data.item_count = num_items
-        data.delivered_count = items.filter(package__status=Shipment.STATUS_RECEIVED).count()
-        data.package_count = len(set(i.package_id for i in items))
-        if all_shipment_items_count:
-            data.percentage_of_shipment = float(num_items) / all_shipment_items_count
-        else:
-            data.percentage_of_shipment = 0.0
-        data.price_local = sum(i.extended_price_local for i in items)
-        data.price_usd = sum(i.extended_price_usd for i in items)
-        data.save()
+        totals['percentage_of_shipment'] = float(totals['item_count']) / all_shipment_items_count
+        DonorShipmentData.objects.update_or_create(donor_id=donor_id, shipment_id=shipment_id,
+                                                   defaults=totals)
+
+
+# Set-based versions of the updaters above, for many keys at once.
+#
+# The donor and category can be NULL, which a unique constraint (and so
+# INSERT ... ON CONFLICT) treats as distinct from every other NULL. So
+# instead of upserting we delete the rows for the keys and insert them
+# again from one GROUP BY query, matching keys with IS NOT DISTINCT FROM.
+# Like the updaters above, they leave out soft-deleted shipments.
+
+def _keys_cte(keys, columns, types=None):
+    """
+    Return SQL for a `keys` CTE with the given rows, and its parameters.
+    The columns are integers unless their `types` are given.
+    """
+    types = types or ['integer'] * len(columns)
+    row = '(%s)' % ', '.join('%%s::%s' % column_type for column_type in types)
+    sql = 'keys (%s) AS (VALUES %s)' % (', '.join(columns), ', '.join([row] * len(keys)))
+    params = [value for key in keys for value in key]
+    return sql, params
+
+
+# Tag the advisory locks on each table's keys, in the top bits
+DONOR_SHIPMENT_DATA_LOCK = 0x4453 << 48
+DONOR_CATEGORY_DATA_LOCK = 0x4443 << 48
+MONTHLY_DATA_LOCK = 0x4d4f << 48
+
+
+def id_pair_lock_id(tag, first_id, second_id):
+    """
+    Return the advisory lock ID for a pair of IDs, either of which can be
+    None. IDs past 24 bits can share a lock with other pairs, which only
+    means refreshes that needn't take turns do.
+    """
+    return tag | ((first_id or 0) & 0xffffff) << 24 | ((second_id or 0) & 0xffffff)
+
+
+def monthly_data_lock_id(month, partner_id):
+    """Return the advisory lock ID for a (month, partner_id) pair"""
+    return MONTHLY_DATA_LOCK | (partner_id << 16) | (month.year * 12 + month.month - 1)
+
+
+def lock_report_keys(cursor, lock_ids):
+    """
+    Take these advisory locks until the end of the transaction.
+
+    Transactions refreshing the same keys have to take turns, or they'd
+    both delete the old rows and then both insert new ones.
+    """
+    # Always in the same order, so two refreshes can't deadlock
+    cursor.execute("SELECT COUNT(pg_advisory_xact_lock(lock_id))"
+                   " FROM unnest(%s::bigint[]) AS lock_id", [sorted(set(lock_ids))])
+
+
+def refresh_donor_shipment_data(keys):
+    """Recompute DonorShipmentData for these (donor_id, shipment_id) pairs"""
+    if not keys:
+        return
+    lock_ids = [id_pair_lock_id(DONOR_SHIPMENT_DATA_LOCK, donor_id, shipment_id)
+                for donor_id, shipment_id in keys]
+    keys_sql, params = _keys_cte(list(keys), ['donor_id', 'shipment_id'])
+    context = {
+        'keys': keys_sql,
+        'data': DonorShipmentData._meta.db_table,
+        'shipment': Shipment._meta.db_table,
+        'package': Package._meta.db_table,
+        'item': PackageItem._meta.db_table,
+        'received': Shipment.STATUS_RECEIVED,
+    }
+    with versioned_atomic():
+        cursor = connection.cursor()
+        lock_report_keys(cursor, lock_ids)
+        cursor.execute("""
+        WITH %(keys)s
+        DELETE FROM %(data)s AS data USING keys
+        WHERE data.donor_id IS NOT DISTINCT FROM keys.donor_id
+          AND data.shipment_id = keys.shipment_id
+        """ % context, params)
+        cursor.execute("""
+        WITH %(keys)s,
+        shipment_totals AS (
+          SELECT pkg.shipment_id, COUNT(*) AS item_count
+          FROM %(item)s AS item
+          JOIN %(package)s AS pkg ON pkg.id = item.package_id
+          WHERE pkg.shipment_id IN (SELECT shipment_id FROM keys)
+          GROUP BY pkg.shipment_id
+        )
+        INSERT INTO %(data)s (donor_id, shipment_id, package_count, item_count,
+                              delivered_count, percentage_of_shipment, price_local, price_usd)
+        SELECT
+          keys.donor_id,
+          keys.shipment_id,
+          COUNT(DISTINCT item.package_id),
+          COUNT(*),
+          COUNT(CASE WHEN pkg.status = %(received)s THEN 1 END),
+          COUNT(*)::numeric / MAX(totals.item_count),
+          SUM(item.quantity * item.price_local),
+          SUM(item.quantity * item.price_usd)
+        FROM keys
+        JOIN %(shipment)s AS shipment ON shipment.id = keys.shipment_id
+          AND NOT shipment.deleted
+        JOIN %(package)s AS pkg ON pkg.shipment_id = keys.shipment_id
+        JOIN %(item)s AS item ON item.package_id = pkg.id
+          AND item.donor_id IS NOT DISTINCT FROM keys.donor_id
+        JOIN shipment_totals AS totals ON totals.shipment_id = keys.shipment_id
+        GROUP BY keys.donor_id, keys.shipment_id
+        """ % context, params)
+        # Once it's committed
+        bump_versions(ITEMS)
+
+
+def refresh_donor_category_data(keys):
+    """Recompute DonorCategoryData for these (donor_id, category_id) pairs"""
+    if not keys:
+        return
+    lock_ids = [id_pair_lock_id(DONOR_CATEGORY_DATA_LOCK, donor_id, category_id)
+                for donor_id, category_id in keys]
+    keys_sql, params = _keys_cte(list(keys), ['donor_id', 'category_id'])
+    context = {
+        'keys': keys_sql,
+        'data': DonorCategoryData._meta.db_table,
+        'shipment': Shipment._meta.db_table,
+        'package': Package._meta.db_table,
+        'item': PackageItem._meta.db_table,
+        'category': PackageItem._meta.get_field('item_category').column,
+    }
+    with versioned_atomic():
+        cursor = connection.cursor()
+        lock_report_keys(cursor, lock_ids)
+        cursor.execute("""
+        WITH %(keys)s
+        DELETE FROM %(data)s AS data USING keys
+        WHERE data.donor_id IS NOT DISTINCT FROM keys.donor_id
+          AND data.category_id IS NOT DISTINCT FROM keys.category_id
+        """ % context, params)
+        cursor.execute("""
+        WITH %(keys)s
+        INSERT INTO %(data)s (donor_id, category_id, item_count, total_quantity,
+                              price_local, price_usd, first_date_shipped, last_date_shipped)
+        SELECT
+          keys.donor_id,
+          keys.category_id,
+          COUNT(*),
+          SUM(item.quantity),
+          SUM(item.quantity * item.price_local),
+          SUM(item.quantity * item.price_usd),
+          MIN(shipment.shipment_date),
+          MAX(shipment.shipment_date)
+        FROM keys
+        JOIN %(item)s AS item ON item.donor_id IS NOT DISTINCT FROM keys.donor_id
+          AND item.%(category)s IS NOT DISTINCT FROM keys.category_id
+        JOIN %(package)s AS pkg ON pkg.id = item.package_id
+        JOIN %(shipment)s AS shipment ON shipment.id = pkg.shipment_id
+          AND NOT shipment.deleted
+        GROUP BY keys.donor_id, keys.category_id
+        """ % context, params)
+        bump_versions(ITEMS)
+
+
+def refresh_shipment_monthly_data(keys):
+    """Recompute ShipmentMonthlyData for these (month, partner_id) pairs"""
+    if not keys:
+        return
+    lock_ids = [monthly_data_lock_id(month, partner_id) for month, partner_id in keys]
+    keys_sql, params = _keys_cte(list(keys), ['month', 'partner_id'], ['date', 'integer'])
+    context = {
+        'keys': keys_sql,
+        'data': ShipmentMonthlyData._meta.db_table,
+        'shipment': Shipment._meta.db_table,
+        'package': Package._meta.db_table,
+        'item': PackageItem._meta.db_table,
+    }
+    with versioned_atomic():
+        cursor = connection.cursor()
+        lock_report_keys(cursor, lock_ids)
+        cursor.execute("""
+        WITH %(keys)s
+        DELETE FROM %(data)s AS data USING keys
+        WHERE data.month = keys.month
+          AND data.partner_id = keys.partner_id
+        """ % context, params)
+        cursor.execute("""
+        WITH %(keys)s,
+        shipment AS (
+          SELECT keys.month, shipment.partner_id, shipment.status, shipment.id
+          FROM keys
+          JOIN %(shipment)s AS shipment ON shipment.partner_id = keys.partner_id
+            AND shipment.shipment_date >= keys.month
+            AND shipment.shipment_date < keys.month + INTERVAL '1 month'
+          WHERE NOT shipment.deleted
+        )
+        INSERT INTO %(data)s (month, partner_id, donor_id, status, all_donors,
+                              shipment_count, package_count, item_count, quantity,
+                              price_local, price_usd)
+        SELECT
+          shipment.month,
+          shipment.partner_id,
+          item.donor_id,
+          shipment.status,
+          FALSE,
+          COUNT(DISTINCT shipment.id),
+          COUNT(DISTINCT pkg.id),
+          COUNT(*),
+          SUM(item.quantity),
+          SUM(item.quantity * item.price_local),
+          SUM(item.quantity * item.price_usd)
+        FROM shipment
+        JOIN %(package)s AS pkg ON pkg.shipment_id = shipment.id
+        JOIN %(item)s AS item ON item.package_id = pkg.id
+        GROUP BY shipment.month, shipment.partner_id, item.donor_id, shipment.status
+        UNION ALL
+        SELECT
+          shipment.month,
+          shipment.partner_id,
+          NULL,
+          shipment.status,
+          TRUE,
+          COUNT(DISTINCT shipment.id),
+          COUNT(DISTINCT pkg.id),
+          COUNT(item.id),
+          COALESCE(SUM(item.quantity), 0),
+          COALESCE(SUM(item.quantity * item.price_local), 0),
+          COALESCE(SUM(item.quantity * item.price_usd), 0)
+        FROM shipment
+        LEFT JOIN %(package)s AS pkg ON pkg.shipment_id = shipment.id
+        LEFT JOIN %(item)s AS item ON item.package_id = pkg.id
+        GROUP BY shipment.month, shipment.partner_id, shipment.status
+        """ % context, params)
+        bump_versions(SHIPMENTS)
+
+
+def rebuild_shipment_monthly_data():
+    """Recompute all of ShipmentMonthlyData"""
+    ShipmentMonthlyData.objects.all().delete()
+    rows = Shipment.objects.values_list('shipment_date', 'partner_id').distinct()
+    refresh_shipment_monthly_data(
+        set((month_start(shipment_date), partner_id) for shipment_date, partner_id in rows))
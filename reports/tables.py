@@ -11,7 +11,29 @@ from .columns import (
     LocalCurrencyDownloadColumn)
 
 
-class PackageReportTable(TableReport):
+class FooterTotalsMixin(object):
+    """
+    For tables whose footer shows totals of some of their columns.
+    `footer_totals` maps the name of each total in the template context to
+    the field it sums.
+    """
+    footer_totals = {}
+
+    def get_table_footer(self, queryset):
+        """Return a dictionary to add to the template context containing
+        the table footer values"""
+        return queryset.aggregate(**dict(
+            (name, Sum(field_name)) for name, field_name in self.footer_totals.items()
+        ))
+
+
+class PackageReportTable(FooterTotalsMixin, TableReport):
+
+    footer_totals = {
+        'total_quantity': 'num_items',
+        'total_local': 'price_local',
+        'total_usd': 'price_usd',
+    }
 
     number_in_shipment = NumberColumn(verbose_name="ID in Shipment")
     num_items = NumberColumn(verbose_name="# Items")
@@ -23,7 +45,7 @@ class PackageReportTable(TableReport):
         fields = ('shipment.partner.name', 'shipment.shipment_date',
                   'shipment.description', 'number_in_shipment', 'name',
                   'last_scan.country', 'last_scan.when',
-                  'get_status_display', 'num_items', 'price_local',
+                  'effective_status', 'num_items', 'price_local',
                   'price_usd')
 
     def __init__(self, *args, **kwargs):
@@ -34,19 +56,10 @@ class PackageReportTable(TableReport):
         self.columns['shipment.partner.name'].column.verbose_name = "Partner"
         self.columns['shipment.description'].column.verbose_name = "Shipment"
         self.columns['name'].column.verbose_name = "Description"
-        self.columns['get_status_display'].column.verbose_name = "Status"
+        self.columns['effective_status'].column.verbose_name = "Status"
         self.columns['last_scan.country'].column.verbose_name = "Last Scan Location"
         self.columns['last_scan.when'].column.verbose_name = "Last Scanned"
 
-    def get_table_footer(self, queryset):
-        """Return a dictionary to add to the template context containing
-        the table footer values"""
-        return queryset.aggregate(
-            total_quantity=Sum('num_items'),
-            total_local=Sum('price_local'),
-            total_usd=Sum('price_usd'),
-        )
-
 
 class PackageDownloadableTable(PackageReportTable):
 
@@ -54,7 +67,14 @@ class PackageDownloadableTable(PackageReportTable):
     price_usd = NumberColumn(verbose_name="Total Price (USD)")
 
 
-class DonorByShipmentReportTable(TableReport):
+class DonorByShipmentReportTable(FooterTotalsMixin, TableReport):
+
+    footer_totals = {
+        'total_package_count': 'package_count',
+        'total_item_count': 'item_count',
+        'total_local': 'price_local',
+        'total_usd': 'price_usd',
+    }
 
     package_count = NumberColumn()
     item_count = NumberColumn()
@@ -79,16 +99,6 @@ class DonorByShipmentReportTable(TableReport):
         self.columns['shipment.description'].column.verbose_name = 'Shipment'
         self.columns['shipment.status'].column.verbose_name = 'Shipment Status'
 
-    def get_table_footer(self, queryset):
-        """Return a dictionary to add to the template context containing
-        the table footer values"""
-        return queryset.aggregate(
-            total_package_count=Sum('package_count'),
-            total_item_count=Sum('item_count'),
-            total_local=Sum('price_local'),
-            total_usd=Sum('price_usd'),
-        )
-
 
 class DonorByShipmentDownloadableTable(DonorByShipmentReportTable):
 
@@ -96,7 +106,14 @@ class DonorByShipmentDownloadableTable(DonorByShipmentReportTable):
     price_usd = NumberColumn()
 
 
-class DonorByCategoryReportTable(TableReport):
+class DonorByCategoryReportTable(FooterTotalsMixin, TableReport):
+
+    footer_totals = {
+        'total_item_count': 'item_count',
+        'total_quantity': 'total_quantity',
+        'total_local': 'price_local',
+        'total_usd': 'price_usd',
+    }
 
     item_count = NumberColumn()
     total_quantity = NumberColumn()
@@ -117,16 +134,6 @@ class DonorByCategoryReportTable(TableReport):
         self.columns['donor.name'].column.verbose_name = "Donor"
         self.columns['category.name'].column.verbose_name = "Category"
 
-    def get_table_footer(self, queryset):
-        """Return a dictionary to add to the template context containing
-        the table footer values"""
-        return queryset.aggregate(
-            total_item_count=Sum('item_count'),
-            total_quantity=Sum('total_quantity'),
-            total_local=Sum('price_local'),
-            total_usd=Sum('price_usd'),
-        )
-
 
 class DonorByCategoryDownloadableTable(DonorByCategoryReportTable):
 
@@ -134,7 +141,13 @@ class DonorByCategoryDownloadableTable(DonorByCategoryReportTable):
     price_usd = NumberColumn()
 
 
-class ItemReportTable(TableReport):
+class ItemReportTable(FooterTotalsMixin, TableReport):
+
+    footer_totals = {
+        'total_quantity': 'quantity',
+        'total_local': 'extended_price_local',
+        'total_usd': 'extended_price_usd',
+    }
 
     quantity = NumberColumn()
     extended_price_local = LocalCurrencyColumn(verbose_name="Total Price (Local)")
@@ -144,7 +157,7 @@ class ItemReportTable(TableReport):
         model = PackageItemDBView
         fields = ('package.shipment',
                   'package.shipment.partner.name', 'donor', 'item_category',
-                  'description', 'quantity', 'package.get_status_display',
+                  'description', 'quantity', 'package.effective_status',
                   'extended_price_local', 'extended_price_usd')
 
     def __init__(self, *args, **kwargs):
@@ -152,17 +165,7 @@ class ItemReportTable(TableReport):
         self.columns['package.shipment.partner.name'].column.verbose_name = "Partner"
         self.columns['item_category'].column.verbose_name = "Category"
         self.columns['description'].column.verbose_name = "Item"
-        self.columns['package.get_status_display'].column.verbose_name = "Package Status"
-        self.columns['package.get_status_display'].column.order_by = 'status'
-
-    def get_table_footer(self, queryset):
-        """Return a dictionary to add to the template context containing
-        the table footer values"""
-        return queryset.aggregate(
-            total_quantity=Sum('quantity'),
-            total_local=Sum('extended_price_local'),
-            total_usd=Sum('extended_price_usd'),
-        )
+        self.columns['package.effective_status'].column.verbose_name = "Package Status"
 
 
 class ItemDownloadableTable(ItemReportTable):
@@ -221,7 +224,7 @@ class ReceivedItemsByDonorOrPartnerReportTable(TableReport):
 
 class ShipmentMonthlySummaryReportTable(TableReport):
     month = DateColumn(format='m/Y')
-    pk__count = NumberColumn()
+    shipments = NumberColumn()
 
     def __init__(self, *args, **kwargs):
         super(ShipmentMonthlySummaryReportTable, self).__init__(*args, **kwargs)
@@ -229,4 +232,4 @@ class ShipmentMonthlySummaryReportTable(TableReport):
         self.data.verbose_name_plural = 'items'
 
         self.columns['month'].column.verbose_name = "Month Shipped"
-        self.columns['pk__count'].column.verbose_name = 'Shipments'
+        self.columns['shipments'].column.verbose_name = 'Shipments'
@@ -0,0 +1,32 @@
+import logging
+
+from celery.task import task
+
+from accounts.models import CtsUser
+from reports import export
+
+
+logger = logging.getLogger(__name__)
+
+
+@task
+def export_report(report_name, params, user_id, report_format, job_key):
+    """
+    Save a download of a report, for the page that asked for it to fetch
+    once it's ready. See ReportBase.export_response().
+    """
+    from reports.views import get_report_class
+
+    try:
+        user = CtsUser.objects.get(pk=user_id)
+        view = get_report_class(report_name).for_export(params, user)
+        export.save_export(job_key, view.get_download_table(), report_format)
+    except Exception:
+        logger.exception("Error exporting the %s report" % report_name)
+        export.fail_export(job_key)
+
+
+@task
+def delete_old_exports():
+    count = export.delete_old_exports()
+    logger.info("Deleted %d old report exports" % count)
@@ -0,0 +1,94 @@
+"""
+Query budgets for the reports, and helpers to measure them.
+
+Every report is rendered as its page, as its AJAX table and as a CSV
+download. Each of those must use no more than the report's budget of
+queries, whatever the amount of data: anything a table's columns look up
+for each row has to come from the queryset's prefetch_related() (one query
+per relation per page) rather than from a query per row.
+
+Downloads read the report a chunk of rows at a time (see
+reports.export.iterate_in_chunks), and each chunk after the first may use
+up to DOWNLOAD_QUERIES_PER_CHUNK more queries.
+"""
+from math import ceil
+import time
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_tables2_reports.utils import DEFAULT_PARAM_PREFIX
+
+from reports.export import EXPORT_CHUNK_SIZE
+from reports.fragments import get_fragment_cache
+from reports.views import ReportBase
+
+
+HTML = 'html'
+AJAX = 'ajax'
+DOWNLOAD = 'download'
+MODES = (HTML, AJAX, DOWNLOAD)
+
+# Queries per request, by report name and then mode. Every request has
+# the session, the user and their permissions to load first.
+QUERY_BUDGETS = {
+    'package': {HTML: 12, AJAX: 13, DOWNLOAD: 13},
+    'donor_by_shipment': {HTML: 12, AJAX: 13, DOWNLOAD: 13},
+    'donor_by_category': {HTML: 12, AJAX: 12, DOWNLOAD: 12},
+    'item': {HTML: 12, AJAX: 15, DOWNLOAD: 15},
+    'shipment': {HTML: 12, AJAX: 12, DOWNLOAD: 12},
+    'received_items_by_shipment': {HTML: 12, AJAX: 10, DOWNLOAD: 10},
+    'received_items_by_donor_or_partner': {HTML: 12, AJAX: 13, DOWNLOAD: 13},
+    'shipment_monthly_summary': {HTML: 12, AJAX: 10, DOWNLOAD: 10},
+}
+# For any report not listed
+DEFAULT_QUERY_BUDGET = 15
+
+# A query for the chunk's rows, and one per prefetched relation
+DOWNLOAD_QUERIES_PER_CHUNK = 6
+
+
+def report_classes():
+    """The reports, leaving out any incomplete ones that tests define"""
+    return sorted([cls for cls in ReportBase.__subclasses__() if cls.table_class],
+                  key=lambda cls: cls.get_report_url_name())
+
+
+def query_budget(report_class, mode, num_rows=0):
+    """
+    Return how many queries the report may use in the mode, for a
+    download of `num_rows` rows.
+    """
+    budget = QUERY_BUDGETS.get(report_class.get_report_url_name(), {})\
+        .get(mode, DEFAULT_QUERY_BUDGET)
+    if mode == DOWNLOAD:
+        chunks = max(1, int(ceil(float(num_rows) / EXPORT_CHUNK_SIZE)))
+        budget += (chunks - 1) * DOWNLOAD_QUERIES_PER_CHUNK
+    return budget
+
+
+def render_report(client, report_class, mode):
+    """
+    Have the (logged in) test client get the report in the mode, starting
+    with nothing cached, and return the number of queries it took and the
+    time in seconds.
+    """
+    url = reverse(report_class.get_report_url_name())
+    kwargs = {}
+    if mode == AJAX:
+        kwargs['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    elif mode == DOWNLOAD:
+        param_report = "%s-%s" % (DEFAULT_PARAM_PREFIX, report_class.table_class.__name__.lower())
+        url += '?%s=csv' % param_report
+    cache.clear()
+    get_fragment_cache().clear()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        rsp = client.get(url, **kwargs)
+        if rsp.streaming:
+            b''.join(rsp.streaming_content)
+        seconds = time.time() - start
+    assert rsp.status_code == 200, \
+        "%s %s: status %d" % (report_class.__name__, mode, rsp.status_code)
+    return len(queries), seconds
@@ -0,0 +1,128 @@
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from accounts.tests.factories import CtsUserFactory, PartnerFactory
+from accounts.utils import bootstrap_permissions
+from catalog.tests.factories import CatalogItemFactory, DonorFactory, ItemCategoryFactory
+from cts.tests.benchmark import benchmark, best_time
+from reports.tests.query_budgets import DOWNLOAD, MODES, query_budget, render_report, \
+    report_classes
+from shipments.forms import create_packages_and_items
+from shipments.models import Package, PackageItem, Shipment
+from shipments.tests.factories import KitFactory, KitItemFactory, PackageFactory, \
+    ShipmentFactory
+
+
+@benchmark
+class TestReportUpdateBenchmark(TestCase):
+    """
+    The cost of updating the report data when an item is saved should
+    depend on the donor's items, not on how many items there are overall.
+    """
+    sizes = [1000, 10000, 100000, 1000000]
+
+    def setUp(self):
+        super(TestReportUpdateBenchmark, self).setUp()
+        self.category = ItemCategoryFactory()
+        self.other_package = PackageFactory()
+        self.other_donor = DonorFactory()
+        self.package = PackageFactory()
+        self.item = PackageItem.objects.create(
+            package=self.package, donor=DonorFactory(), item_category=self.category,
+            quantity=1, price_usd=Decimal('1.00'), price_local=Decimal('1.00'))
+        self.num_items = 0
+
+    def add_other_items(self, total):
+        """Add items from another donor until there are `total` of them"""
+        cursor = connection.cursor()
+        cursor.execute("""
+        INSERT INTO shipments_packageitem
+          (description, unit, price_usd, price_local, quantity, package_id, donor_id, item_category)
+        SELECT '', '', 1, 1, 1, %s, %s, %s FROM generate_series(1, %s)
+        """, [self.other_package.pk, self.other_donor.pk, self.category.pk,
+              total - self.num_items])
+        cursor.execute("ANALYZE shipments_packageitem")
+        self.num_items = total
+
+    def save_item(self):
+        self.item.quantity += 1
+        self.item.save()
+
+    def test_save_cost_is_flat(self):
+        results = []
+        for size in self.sizes:
+            self.add_other_items(size)
+            with CaptureQueriesContext(connection) as queries:
+                self.save_item()
+            results.append((size, len(queries), best_time(self.save_item)))
+        for size, num_queries, seconds in results:
+            print("%8d items: %d queries, %.2f ms per save" % (size, num_queries, 1000 * seconds))
+        smallest, largest = results[0], results[-1]
+        self.assertEqual(smallest[1], largest[1])
+        # Allow for noise, but not for growing with the number of items
+        self.assertLess(largest[2], 3 * smallest[2] + 0.005)
+
+
+@benchmark
+class TestReportQueryBudgetBenchmark(TestCase):
+    """
+    Every report should stay within its query budget with a realistic
+    amount of data too. Prints how long each took.
+    """
+    num_shipments = 10000
+    packages_per_shipment = 10
+    items_per_kit = 10
+    num_partners = 20
+    num_donors = 20
+    num_categories = 20
+    num_kits = 10
+
+    def setUp(self):
+        super(TestReportQueryBudgetBenchmark, self).setUp()
+        bootstrap_permissions()
+        self.user = CtsUserFactory(email="sam@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        assert self.client.login(email="sam@example.com", password="password")
+
+        partners = [PartnerFactory() for i in range(self.num_partners)]
+        donors = [DonorFactory() for i in range(self.num_donors)]
+        categories = [ItemCategoryFactory() for i in range(self.num_categories)]
+        kits = [KitFactory() for i in range(self.num_kits)]
+        for i, kit in enumerate(kits):
+            for j in range(self.items_per_kit):
+                n = i * self.items_per_kit + j
+                KitItemFactory(kit=kit, catalog_item=CatalogItemFactory(
+                    donor=donors[n % len(donors)], item_category=categories[n % len(categories)],
+                    price_usd=Decimal('1.50'), price_local=Decimal('2.00')))
+
+        # Two years of shipments, with 100 items in each
+        start = date(2014, 1, 1)
+        for n in range(self.num_shipments):
+            shipment = ShipmentFactory(partner=partners[n % len(partners)],
+                                       shipment_date=start + timedelta(days=n % 730))
+            create_packages_and_items(shipment, 'Package', 'Description',
+                                      self.packages_per_shipment, {kits[n % len(kits)]: 1})
+        # Half of them delivered
+        Shipment.apply_status_transition(
+            Package.objects.filter(shipment__pk__in=Shipment.objects.filter(
+                shipment_date__lt=start + timedelta(days=365)).values('pk')).values('pk'),
+            Shipment.STATUS_RECEIVED)
+
+    def test_query_budgets(self):
+        failures = []
+        for report_class in report_classes():
+            num_rows = report_class.for_export([], self.user).get_filter().qs.count()
+            for mode in MODES:
+                num_queries, seconds = render_report(self.client, report_class, mode)
+                budget = query_budget(report_class, mode, num_rows if mode == DOWNLOAD else 0)
+                print("%-36s %-8s %8d rows: %5d queries (budget %d), %.2f s"
+                      % (report_class.__name__, mode, num_rows, num_queries, budget, seconds))
+                if num_queries > budget:
+                    failures.append("%s (%s): %d queries, over its budget of %d"
+                                    % (report_class.__name__, mode, num_queries, budget))
+        self.assertFalse(failures, '\n'.join(failures))
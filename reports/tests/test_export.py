@@ -0,0 +1,57 @@
+from io import BytesIO
+from zipfile import ZipFile
+
+from django.test import TestCase
+
+from reports.export import iterate_in_chunks
+from reports.xlsx import xlsx_stream
+from shipments.models import PackageDBView
+from shipments.tests.factories import PackageFactory, ShipmentFactory
+
+
+class TestIterateInChunks(TestCase):
+    def setUp(self):
+        super(TestIterateInChunks, self).setUp()
+        shipment = ShipmentFactory()
+        self.packages = [PackageFactory(shipment=shipment) for i in range(5)]
+
+    def test_order_and_prefetch(self):
+        queryset = PackageDBView.objects.order_by('-number_in_shipment')\
+            .prefetch_related('shipment')
+        # One query for each chunk and one for its shipments (plus the
+        # server-side cursor's query, which Django doesn't see)
+        with self.assertNumQueries(3 * 2):
+            records = list(iterate_in_chunks(queryset, chunk_size=2))
+            self.assertEqual(
+                [pkg.pk for pkg in reversed(self.packages)],
+                [record.pk for record in records])
+            for record in records:
+                record.shipment.partner_id
+
+    def test_deleted_while_iterating(self):
+        queryset = PackageDBView.objects.order_by('pk')
+        records = iterate_in_chunks(queryset, chunk_size=2)
+        self.assertEqual(self.packages[0].pk, next(records).pk)
+        # The cursor still has its pk, but it's gone by the time its chunk is loaded
+        self.packages[3].delete()
+        self.assertEqual(
+            [pkg.pk for pkg in self.packages[1:3] + self.packages[4:]],
+            [record.pk for record in records])
+
+    def test_values(self):
+        queryset = PackageDBView.objects.values('pk').order_by('pk')
+        self.assertEqual(
+            [{'pk': pkg.pk} for pkg in self.packages],
+            list(iterate_in_chunks(queryset, chunk_size=2)))
+
+
+class TestXlsxStream(TestCase):
+    def test_contents(self):
+        rows = [[u'Name', u'Quantity'], [u'Caf\xe9 <1>', 3], [None, 2.5]]
+        archive = ZipFile(BytesIO(b''.join(xlsx_stream(iter(rows), u'Items: 1/2'))))
+        self.assertIsNone(archive.testzip())
+        self.assertIn(b'name="Items 12"', archive.read('xl/workbook.xml'))
+        sheet = archive.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertIn(u'<t xml:space="preserve">Caf\xe9 &lt;1&gt;</t>', sheet)
+        self.assertIn(u'<c><v>3</v></c>', sheet)
+        self.assertIn(u'<row><c/><c><v>2.5</v></c></row>', sheet)
@@ -5,7 +5,8 @@ from accounts.models import ROLE_PARTNER, ROLE_MANAGER
 from accounts.tests.factories import CtsUserFactory
 from catalog.tests.factories import DonorFactory
 from reports.filters import PackageReportFilter, DonorByShipmentReportFilter, \
-    DonorByCategoryReportFilter, ItemReportFilter, ShipmentReportFilter
+    DonorByCategoryReportFilter, ItemReportFilter, ShipmentReportFilter, get_shipment_choices, \
+    get_user_shipment_choices
 from reports.tests.factories import DonorShipmentDataFactory, DonorCategoryDataFactory
 from shipments.tests.factories import ShipmentFactory, PackageFactory, PackageItemFactory
 
@@ -152,3 +153,63 @@ class ShipmentReportFilterTest(ReportFilterMixin, TestCase):
 
     def item_for_partner(self, user):
         return ShipmentFactory(partner=user)
+
+
+class TestShipmentChoices(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestShipmentChoices, cls).setUpClass()
+        bootstrap_permissions()
+
+    def setUp(self):
+        super(TestShipmentChoices, self).setUp()
+        self.partner1 = CtsUserFactory(role=ROLE_PARTNER, name='Partner 1')
+        self.partner2 = CtsUserFactory(role=ROLE_PARTNER, name='Partner 2')
+        self.shipment1 = ShipmentFactory(partner=self.partner1, description='B shipment')
+        self.shipment2 = ShipmentFactory(partner=self.partner2, description='A shipment')
+        self.manager = CtsUserFactory(role=ROLE_MANAGER)
+
+    def test_sorted_and_cached(self):
+        self.assertEqual(
+            [(self.shipment2.pk, 'A shipment', self.partner2.pk),
+             (self.shipment1.pk, 'B shipment', self.partner1.pk)],
+            get_shipment_choices())
+        with self.assertNumQueries(0):
+            get_shipment_choices()
+
+    def test_invalidated(self):
+        get_shipment_choices()
+        self.shipment1.description = 'C shipment'
+        self.shipment1.save()
+        self.assertEqual('C shipment', get_shipment_choices()[-1][1])
+        # Labels of shipments without a description have the partner's name
+        self.shipment1.description = ''
+        self.shipment1.save()
+        get_shipment_choices()
+        self.partner1.name = 'Renamed'
+        self.partner1.save()
+        self.assertIn('Renamed', dict((pk, label) for pk, label, partner_id
+                                      in get_shipment_choices())[self.shipment1.pk])
+        # Soft-deleting saves nothing, but the shipment is no longer a choice
+        self.shipment2.soft_delete()
+        self.assertEqual([self.shipment1.pk], [pk for pk, label, partner_id
+                                               in get_shipment_choices()])
+
+    def test_user_choices(self):
+        pks = [pk for pk, label, partner_id
+               in get_user_shipment_choices(self.manager, {})]
+        self.assertEqual([self.shipment2.pk, self.shipment1.pk], pks)
+        pks = [pk for pk, label, partner_id
+               in get_user_shipment_choices(self.manager, {'partner': str(self.partner1.pk)})]
+        self.assertEqual([self.shipment1.pk], pks)
+        # Partners only see their own
+        pks = [pk for pk, label, partner_id
+               in get_user_shipment_choices(self.partner2, {'partner': str(self.partner1.pk)})]
+        self.assertEqual([self.shipment2.pk], pks)
+
+    def test_only_chosen_shipment_rendered(self):
+        queryset = PackageReportFilter._meta.model.objects.all()
+        fltr = PackageReportFilter(data={'shipment': str(self.shipment1.pk)}, queryset=queryset,
+                                   user=self.manager)
+        self.assertEqual([(None, '---------'), (self.shipment1.pk, 'B shipment')],
+                         list(fltr.form.fields['shipment'].choices))
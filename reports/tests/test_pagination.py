@@ -0,0 +1,112 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils.timezone import now
+from django_tables2 import Column, Table
+
+from reports.pagination import KeysetPaginator, keyset_ordering
+from shipments.models import Package
+from shipments.tests.factories import PackageFactory, ShipmentFactory
+
+
+class PackageTable(Table):
+    name = Column()
+
+
+class TestKeysetOrdering(TestCase):
+    def test_relations_expand(self):
+        keys = keyset_ordering(Package.objects.order_by('shipment__partner', '-name'))
+        self.assertEqual(
+            [('shipment__partner__id', False), ('name', True), ('id', False)],
+            [(lookup, descending) for lookup, descending, nullable in keys])
+
+    def test_related_ordering(self):
+        keys = keyset_ordering(Package.objects.order_by('-kit'))
+        # Kits are ordered by name
+        self.assertEqual(
+            [('kit__name', True, True), ('id', False, False)],
+            keys)
+
+    def test_not_supported(self):
+        self.assertIsNone(keyset_ordering(Package.objects.order_by('?')))
+        self.assertIsNone(keyset_ordering(Package.objects.values('name').order_by('name')))
+        self.assertIsNone(keyset_ordering([]))
+
+
+class TestKeysetPaginator(TestCase):
+    def setUp(self):
+        super(TestKeysetPaginator, self).setUp()
+        shipment = ShipmentFactory()
+        when = now()
+        # Some ties and some NULLs
+        for date_received in [None, when, None, when + timedelta(days=1), when, None, when]:
+            PackageFactory(shipment=shipment, date_received=date_received, name='Same')
+        self.count_calls = 0
+
+    def count(self):
+        self.count_calls += 1
+        return Package.objects.count()
+
+    def get_paginator(self, queryset):
+        table = PackageTable(queryset)
+        return KeysetPaginator(table, keyset_ordering(queryset), 2, self.count)
+
+    def assert_pages(self, queryset):
+        expected = [package.pk for package in queryset.order_by(*(
+            list(queryset.query.order_by) + ['pk']))]
+        paginator = self.get_paginator(queryset)
+        page = paginator.page()
+        pages = [page]
+        while page.has_next():
+            page = paginator.page(page.next_page_number())
+            pages.append(page)
+        self.assertEqual(expected, [record.pk for each in pages for record in each.records])
+        self.assertEqual(range(1, len(pages) + 1), [each.number for each in pages])
+        self.assertEqual(len(pages), paginator.num_pages)
+        self.assertEqual(1, self.count_calls)
+
+        # And back again
+        backwards = [page]
+        while page.has_previous():
+            page = paginator.page(page.previous_page_number())
+            backwards.append(page)
+        self.assertEqual([each.records for each in pages],
+                         [each.records for each in reversed(backwards)])
+        self.assertEqual(1, backwards[-1].number)
+
+    def test_ascending(self):
+        self.assert_pages(Package.objects.order_by('date_received'))
+
+    def test_descending(self):
+        self.assert_pages(Package.objects.order_by('name', '-date_received'))
+
+    def test_same_cost(self):
+        paginator = self.get_paginator(Package.objects.order_by('date_received'))
+        page = paginator.page()
+        cursor = page.next_page_number()
+        # One query for the page; the count isn't needed
+        with self.assertNumQueries(1):
+            paginator.page(cursor)
+
+    def test_bad_cursor(self):
+        paginator = self.get_paginator(Package.objects.order_by('date_received'))
+        first = paginator.page()
+        self.assertEqual(first.records, paginator.page('not a cursor').records)
+        # A cursor for another ordering starts over too
+        other = self.get_paginator(Package.objects.order_by('-date_received'))
+        cursor = other.page().next_page_number()
+        self.assertEqual(first.records, paginator.page(cursor).records)
+
+    def test_window_totals(self):
+        queryset = Package.objects.order_by('date_received')
+        table = PackageTable(queryset)
+        paginator = KeysetPaginator(table, keyset_ordering(queryset), 2, self.count,
+                                    totals={'total_number': 'number_in_shipment'})
+        # The totals and the count come with the first page
+        with self.assertNumQueries(1):
+            page = paginator.page()
+            self.assertEqual(7, paginator.count)
+        self.assertEqual(sum(package.number_in_shipment for package in Package.objects.all()),
+                         paginator.window_totals['total_number'])
+        self.assertEqual(0, self.count_calls)
+        self.assertEqual(2, len(page.records))
@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.test import TestCase
+
+from accounts.tests.factories import CtsUserFactory, PartnerFactory
+from catalog.tests.factories import DonorFactory, ItemCategoryFactory
+from accounts.utils import bootstrap_permissions
+from reports.tests.query_budgets import MODES, query_budget, render_report, report_classes
+from shipments.models import Shipment, WorldBorder
+from shipments.tests.factories import PackageFactory, PackageItemFactory, \
+    PackageScanFactory, ShipmentFactory
+
+
+def add_report_data(count):
+    """
+    Add `count` shipments, each of their own partner and with a package of
+    items from their own donors and categories, so every report gets more
+    rows. Every other one has been received.
+    """
+    for i in range(count):
+        status = Shipment.STATUS_RECEIVED if i % 2 else Shipment.STATUS_IN_TRANSIT
+        shipment = ShipmentFactory(partner=PartnerFactory(), status=status,
+                                   shipment_date=date(2015, 1, 1) + timedelta(days=40 * i))
+        package = PackageFactory(shipment=shipment, status=status)
+        # Scanned where the scans' country will be found
+        PackageScanFactory(package=package)
+        for j in range(2):
+            PackageItemFactory(package=package, donor=DonorFactory(),
+                               item_category=ItemCategoryFactory(), quantity=j + 1)
+
+
+class TestQueryBudgets(TestCase):
+    """
+    Each report should take the same number of queries however many rows it
+    has, and no more than its budget.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TestQueryBudgets, cls).setUpClass()
+        bootstrap_permissions()
+
+    def setUp(self):
+        super(TestQueryBudgets, self).setUp()
+        WorldBorder.objects.create(
+            name='Turkey', area=0, pop2005=0, fips='TU', iso2='TR', iso3='TUR', un=792,
+            region=142, subregion=145, lon=35.0, lat=39.0,
+            mpoly=MultiPolygon(Polygon.from_bbox((26, 36, 45, 42))))
+        self.user = CtsUserFactory(email="sam@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        assert self.client.login(email="sam@example.com", password="password")
+
+    def measure(self):
+        return dict(
+            ((report_class, mode), render_report(self.client, report_class, mode)[0])
+            for report_class in report_classes()
+            for mode in MODES
+        )
+
+    def test_query_budgets(self):
+        add_report_data(2)
+        few = self.measure()
+        add_report_data(6)
+        more = self.measure()
+
+        failures = []
+        for (report_class, mode), num_queries in sorted(more.items()):
+            name = '%s (%s)' % (report_class.__name__, mode)
+            if num_queries != few[report_class, mode]:
+                failures.append("%s: %d queries for a few rows, but %d for more"
+                                % (name, few[report_class, mode], num_queries))
+            budget = query_budget(report_class, mode)
+            if num_queries > budget:
+                failures.append("%s: %d queries, over its budget of %d"
+                                % (name, num_queries, budget))
+        self.assertFalse(failures, '\n'.join(failures))
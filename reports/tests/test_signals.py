@@ -0,0 +1,213 @@
+from datetime import date
+from decimal import Decimal
+import threading
+
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+
+from catalog.tests.factories import DonorFactory, ItemCategoryFactory
+from reports.models import DonorCategoryData, DonorShipmentData, ShipmentMonthlyData
+from reports.signals import bulk_updates, note_changed_items, rebuild_shipment_monthly_data, \
+    refresh_donor_category_data, refresh_donor_shipment_data
+from shipments.models import PackageItem, Shipment
+from shipments.tests.factories import PackageFactory, PackageItemFactory, ShipmentFactory
+
+
+def donor_shipment_rows():
+    return sorted(DonorShipmentData.objects.values_list(
+        'donor_id', 'shipment_id', 'package_count', 'item_count', 'delivered_count',
+        'percentage_of_shipment', 'price_local', 'price_usd'))
+
+
+def monthly_rows():
+    return sorted(ShipmentMonthlyData.objects.values_list(
+        'month', 'partner_id', 'donor_id', 'status', 'all_donors', 'shipment_count',
+        'package_count', 'item_count', 'quantity', 'price_local', 'price_usd'))
+
+
+def donor_category_rows():
+    return sorted(DonorCategoryData.objects.values_list(
+        'donor_id', 'category_id', 'item_count', 'total_quantity', 'price_local', 'price_usd',
+        'first_date_shipped', 'last_date_shipped'))
+
+
+class TestBulkUpdates(TestCase):
+    def setUp(self):
+        super(TestBulkUpdates, self).setUp()
+        self.donor = DonorFactory()
+        self.category = ItemCategoryFactory()
+        self.shipment = ShipmentFactory()
+        self.package1 = PackageFactory(shipment=self.shipment)
+        self.package2 = PackageFactory(shipment=self.shipment, status=Shipment.STATUS_RECEIVED)
+
+    def make_items(self):
+        PackageItemFactory(package=self.package1, donor=self.donor, item_category=self.category,
+                           quantity=2, price_usd=Decimal('1.50'), price_local=Decimal('2.0'))
+        PackageItemFactory(package=self.package2, donor=self.donor, item_category=self.category,
+                           quantity=3, price_usd=Decimal('1.00'), price_local=Decimal('1.0'))
+        PackageItemFactory(package=self.package2, donor=None, item_category=None, quantity=1)
+
+    def test_same_results_as_per_item_updates(self):
+        self.make_items()
+        expected_shipments = donor_shipment_rows()
+        expected_categories = donor_category_rows()
+        self.assertEqual(2, len(expected_shipments))
+        DonorShipmentData.objects.all().delete()
+        DonorCategoryData.objects.all().delete()
+
+        with bulk_updates():
+            note_changed_items(PackageItem.objects.all())
+            self.assertFalse(DonorShipmentData.objects.exists())
+        self.assertEqual(expected_shipments, donor_shipment_rows())
+        self.assertEqual(expected_categories, donor_category_rows())
+
+    def test_saves_suspended_until_end(self):
+        with bulk_updates():
+            self.make_items()
+            self.assertFalse(DonorShipmentData.objects.exists())
+            self.assertFalse(DonorCategoryData.objects.exists())
+        data = DonorShipmentData.objects.get(donor=self.donor, shipment=self.shipment)
+        self.assertEqual(2, data.item_count)
+        self.assertEqual(1, data.delivered_count)
+        self.assertEqual(2, data.package_count)
+        self.assertEqual(Decimal('6.0'), data.price_usd)
+        self.assertTrue(DonorShipmentData.objects.filter(donor=None).exists())
+        data = DonorCategoryData.objects.get(donor=self.donor, category=self.category)
+        self.assertEqual(5, data.total_quantity)
+        self.assertEqual(self.shipment.shipment_date, data.first_date_shipped)
+
+    def test_deleted_items(self):
+        self.make_items()
+        with bulk_updates():
+            items = PackageItem.objects.filter(donor=self.donor)
+            note_changed_items(items)
+            items.delete()
+        self.assertFalse(DonorShipmentData.objects.filter(donor=self.donor).exists())
+        self.assertFalse(DonorCategoryData.objects.filter(donor=self.donor).exists())
+        self.assertTrue(DonorShipmentData.objects.filter(donor=None).exists())
+
+    def test_fast_delete(self):
+        self.make_items()
+        self.shipment.fast_delete()
+        self.assertFalse(DonorShipmentData.objects.exists())
+        self.assertFalse(DonorCategoryData.objects.exists())
+
+
+class TestShipmentMonthlyData(TestCase):
+    def setUp(self):
+        super(TestShipmentMonthlyData, self).setUp()
+        self.donor = DonorFactory()
+        self.shipment = ShipmentFactory(shipment_date=date(2015, 3, 10))
+        self.package = PackageFactory(shipment=self.shipment)
+        PackageItemFactory(package=self.package, donor=self.donor, quantity=2,
+                           price_usd=Decimal('1.50'), price_local=Decimal('2.0'))
+        PackageItemFactory(package=self.package, donor=None, quantity=1,
+                           price_usd=Decimal('1.00'), price_local=Decimal('1.0'))
+        self.empty_shipment = ShipmentFactory(partner=self.shipment.partner,
+                                              shipment_date=date(2015, 3, 20))
+
+    def assert_up_to_date(self):
+        rows = monthly_rows()
+        rebuild_shipment_monthly_data()
+        self.assertEqual(monthly_rows(), rows)
+
+    def test_totals(self):
+        data = ShipmentMonthlyData.objects.get(all_donors=True)
+        self.assertEqual(date(2015, 3, 1), data.month)
+        self.assertEqual(self.shipment.partner, data.partner)
+        self.assertEqual(2, data.shipment_count)
+        self.assertEqual(1, data.package_count)
+        self.assertEqual(2, data.item_count)
+        self.assertEqual(3, data.quantity)
+        self.assertEqual(Decimal('4.0'), data.price_usd)
+        data = ShipmentMonthlyData.objects.get(all_donors=False, donor=self.donor)
+        self.assertEqual(1, data.shipment_count)
+        self.assertEqual(2, data.quantity)
+        self.assertEqual(Decimal('3.0'), data.price_usd)
+        self.assertTrue(ShipmentMonthlyData.objects.filter(all_donors=False, donor=None).exists())
+        self.assert_up_to_date()
+
+    def test_moved_shipment(self):
+        self.shipment.shipment_date = date(2015, 4, 1)
+        self.shipment.save()
+        self.assertEqual([date(2015, 3, 1), date(2015, 4, 1)], sorted(
+            ShipmentMonthlyData.objects.filter(all_donors=True).values_list('month', flat=True)))
+        self.assert_up_to_date()
+
+    def test_status_transition(self):
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_RECEIVED)
+        data = ShipmentMonthlyData.objects.get(all_donors=True, status=Shipment.STATUS_RECEIVED)
+        self.assertEqual(1, data.shipment_count)
+        self.assert_up_to_date()
+
+    def test_new_packages(self):
+        with bulk_updates():
+            PackageFactory(shipment=self.empty_shipment)
+            PackageItemFactory(package=self.package, donor=self.donor)
+        data = ShipmentMonthlyData.objects.get(all_donors=True)
+        self.assertEqual(2, data.package_count)
+        self.assertEqual(3, data.item_count)
+        self.assert_up_to_date()
+
+    def test_soft_delete(self):
+        self.shipment.soft_delete()
+        data = ShipmentMonthlyData.objects.get(all_donors=True)
+        self.assertEqual(1, data.shipment_count)
+        self.assertEqual(0, data.package_count)
+        self.assertFalse(ShipmentMonthlyData.objects.filter(all_donors=False).exists())
+        self.assert_up_to_date()
+
+    def test_no_duplicates(self):
+        # Even with no donor, a second row for the same key is refused
+        data = ShipmentMonthlyData.objects.get(all_donors=False, donor=None)
+        data.pk = None
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                data.save()
+
+
+class TestConcurrentRefreshes(TransactionTestCase):
+    def setUp(self):
+        super(TestConcurrentRefreshes, self).setUp()
+        self.donor = DonorFactory()
+        self.category = ItemCategoryFactory()
+        self.shipment = ShipmentFactory()
+        package = PackageFactory(shipment=self.shipment)
+        PackageItemFactory(package=package, donor=self.donor, item_category=self.category)
+        PackageItemFactory(package=package, donor=None, item_category=None)
+
+    def refresh_at_once(self, refresh, keys):
+        """Refresh the keys in this transaction and another one at the same time"""
+        errors = []
+
+        def refresh_in_thread():
+            try:
+                refresh(keys)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=refresh_in_thread)
+        with transaction.atomic():
+            refresh(keys)
+            thread.start()
+            # It waits for this transaction to end
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual([], errors)
+
+    def test_donor_shipment_data(self):
+        rows = donor_shipment_rows()
+        self.assertEqual(2, len(rows))
+        self.refresh_at_once(refresh_donor_shipment_data,
+                             {(self.donor.pk, self.shipment.pk), (None, self.shipment.pk)})
+        self.assertEqual(rows, donor_shipment_rows())
+
+    def test_donor_category_data(self):
+        rows = donor_category_rows()
+        self.assertEqual(2, len(rows))
+        self.refresh_at_once(refresh_donor_category_data,
+                             {(self.donor.pk, self.category.pk), (None, None)})
+        self.assertEqual(rows, donor_category_rows())
@@ -1,18 +1,29 @@
 from StringIO import StringIO
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from io import BytesIO
+import json
+import shutil
+from tempfile import mkdtemp
+from zipfile import ZipFile
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
 from django_tables2_reports.utils import DEFAULT_PARAM_PREFIX
+from mock import patch
 from accounts.models import CtsUser
 
 from accounts.tests.factories import CtsUserFactory, PartnerFactory
 from accounts.utils import bootstrap_permissions
 from catalog.models import ItemCategory, Donor, CatalogItem
 from catalog.tests.factories import DonorFactory, ItemCategoryFactory
+from reports.export import XLSX_CONTENT_TYPE, delete_old_exports
+from reports.fragments import fragment_cache_stats
+from reports.tables import ItemReportTable
 from reports.views import PackageReport, DonorByShipmentReport, DonorByCategoryReport, ItemReport, \
     ShipmentReport, ReportBase, ReceivedItemsByShipmentReport, ReceivedItemsByDonorOrPartnerReport, \
-    ShipmentMonthlySummaryReport
+    ShipmentMonthlySummaryReport, FRAGMENT_CACHE_HEADER
 from shipments.models import Shipment, PackageItem, Package
 from shipments.tests.factories import ShipmentFactory, PackageFactory, PackageItemFactory
 
@@ -99,7 +110,8 @@ class ReportTestMixin(object):
                                         status=Shipment.STATUS_IN_TRANSIT)
 
         cls.package1 = PackageFactory(shipment=cls.shipment1,
-                                      status=Shipment.STATUS_IN_TRANSIT)
+                                      status=Shipment.STATUS_IN_TRANSIT,
+                                      date_in_transit=now())
         cls.item1 = PackageItemFactory(package=cls.package1, donor=cls.donor1,
                                        item_category=cls.category1)
 
@@ -107,7 +119,8 @@ class ReportTestMixin(object):
                                         shipment_date=cls.important_date,
                                         status=Shipment.STATUS_RECEIVED)
         cls.package2 = PackageFactory(shipment=cls.shipment2,
-                                      status=Shipment.STATUS_RECEIVED)
+                                      status=Shipment.STATUS_RECEIVED,
+                                      date_received=now())
         cls.item2 = PackageItemFactory(package=cls.package2, donor=cls.donor2,
                                        item_category=cls.category2)
 
@@ -137,12 +150,16 @@ class ReportTestMixin(object):
 
     def csv_get(self, url, *args, **kwargs):
         """Like self.client.get, but asks for response as CSV"""
+        return self.report_get(url, 'csv', *args, **kwargs)
+
+    def report_get(self, url, report_format, *args, **kwargs):
+        """Like self.client.get, but asks for response in the given format"""
         parm_name = "%s-%s" % (DEFAULT_PARAM_PREFIX,
                                self.report_class.table_class.__name__.lower())
         if "?" in url:
-            url = url + "&" + parm_name + "=csv"
+            url = url + "&" + parm_name + "=" + report_format
         else:
-            url = url + "?" + parm_name + "=csv"
+            url = url + "?" + parm_name + "=" + report_format
         return self.client.get(url, *args, **kwargs)
 
     def test_200(self):
@@ -163,6 +180,14 @@ class ReportTestMixin(object):
         rsp = self.csv_get(self.url)
         self.assertEqual(200, rsp.status_code)
         self.assertEqual(rsp['content-type'], 'text/csv; charset=utf-8')
+        self.assertTrue(b''.join(rsp.streaming_content))
+
+    def test_xlsx_200(self):
+        rsp = self.report_get(self.url, 'xlsx')
+        self.assertEqual(200, rsp.status_code)
+        self.assertEqual(rsp['content-type'], XLSX_CONTENT_TYPE)
+        archive = ZipFile(BytesIO(b''.join(rsp.streaming_content)))
+        self.assertIsNone(archive.testzip())
 
 
 class PackageReportTest(ReportTestMixin, TestCase):
@@ -180,13 +205,18 @@ class PackageReportTest(ReportTestMixin, TestCase):
         self.assertIn(self.package1.pk, pks)
         self.assertIn(self.package2.pk, pks)
 
+    def test_soft_deleted_shipment(self):
+        Shipment.objects.get(pk=self.shipment1.pk).soft_delete()
+        pks = [o.pk for o in self.report_class().get_queryset()]
+        self.assertEqual(set([self.package2.pk, self.package3.pk]), set(pks))
+
     def test_get_table(self):
         rsp = self.ajax_get(self.url)
         self.assertContains(rsp, "<table")
 
     def test_csv_table(self):
         rsp = self.csv_get(self.url)
-        body = rsp.content.decode('utf-8')
+        body = b''.join(rsp.streaming_content).decode('utf-8')
         lines = StringIO(body).readlines()
         self.assertEqual(4, len(lines))
 
@@ -238,6 +268,12 @@ class DonorByShipmentReportTest(ReportTestMixin, TestCase):
         self.assertEqual(set([self.donor1.pk, self.donor2.pk, self.donor3.pk]),
                          set([line.donor.pk for line in qs]))
 
+    def test_soft_deleted_shipment(self):
+        Shipment.objects.get(pk=self.shipment1.pk).soft_delete()
+        qs = self.report_class().get_queryset()
+        self.assertEqual(set([self.donor2.pk, self.donor3.pk]),
+                         set([line.donor.pk for line in qs]))
+
     def test_donor_filtering(self):
         rsp = self.ajax_get(self.url + "?donor=%d" % self.donor2.pk)
         qs = rsp.context['queryset']
@@ -299,6 +335,12 @@ class DonorByCategoryReportTest(ReportTestMixin, TestCase):
         self.assertEqual(set([self.donor1.pk, self.donor2.pk, self.donor3.pk]),
                          set([line.donor.pk for line in qs]))
 
+    def test_soft_deleted_shipment(self):
+        Shipment.objects.get(pk=self.shipment1.pk).soft_delete()
+        qs = self.report_class().get_queryset()
+        self.assertEqual(set([self.donor2.pk, self.donor3.pk]),
+                         set([line.donor.pk for line in qs]))
+
     def test_donor_filtering(self):
         rsp = self.ajax_get(self.url + "?donor=%d" % self.donor2.pk)
         qs = rsp.context['queryset']
@@ -347,6 +389,11 @@ class ItemReportTest(ReportTestMixin, TestCase):
         qs = view.get_queryset()
         self.assertEqual(3, len(qs))
 
+    def test_soft_deleted_shipment(self):
+        Shipment.objects.get(pk=self.shipment1.pk).soft_delete()
+        items = self.report_class().get_queryset()
+        self.assertEqual(set([self.item2.pk, self.item3.pk]), set(item.pk for item in items))
+
     def test_partner_filter(self):
         rsp = self.ajax_get(self.url + "?partner=%d" % self.partner1.pk)
         qs = rsp.context['queryset']
@@ -406,6 +453,77 @@ class ItemReportTest(ReportTestMixin, TestCase):
         self.assertIn(self.item2.pk, pks)
         self.assertNotIn(self.item3.pk, pks)
 
+    def test_keyset_pages(self):
+        rsp = self.ajax_get(self.url + "?page_size=2")
+        page = rsp.context['report'].page
+        self.assertEqual(2, len(page.object_list))
+        self.assertEqual(2, page.paginator.num_pages)
+        self.assertContains(rsp, "Page 1 of 2")
+        rsp = self.ajax_get(self.url + "?page_size=2&cursor=" + page.next_page_number())
+        page = rsp.context['report'].page
+        self.assertEqual(1, len(page.object_list))
+        self.assertContains(rsp, "Page 2 of 2")
+
+    def test_footer(self):
+        rsp = self.ajax_get(self.url + "?page_size=2")
+        self.assertEqual(
+            sum(item.quantity for item in PackageItem.objects.all()),
+            rsp.context['total_quantity'])
+        # The totals are remembered for the next page
+        cursor = rsp.context['report'].page.next_page_number()
+        with patch.object(ItemReportTable, 'get_table_footer') as get_table_footer:
+            rsp = self.ajax_get(self.url + "?page_size=2&cursor=" + cursor)
+            self.assertFalse(get_table_footer.called)
+        self.assertEqual(
+            sum(item.quantity for item in PackageItem.objects.all()),
+            rsp.context['total_quantity'])
+
+    def test_export(self):
+        media_root = mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        url = self.url + "?donor=%d&export=status" % self.donor1.pk
+        with override_settings(MEDIA_ROOT=media_root):
+            # Celery runs the job right away in tests
+            rsp = self.csv_get(url)
+            self.assertEqual(200, rsp.status_code)
+            job = json.loads(rsp.content)
+            self.assertEqual('done', job['status'])
+            rsp = self.client.get(job['url'])
+            self.assertEqual(200, rsp.status_code)
+            lines = b''.join(rsp.streaming_content).splitlines()
+            # Header and item1
+            self.assertEqual(2, len(lines))
+
+            # Asking again gets the same file
+            with patch('reports.views.export_report') as export_report:
+                rsp = self.csv_get(url)
+                self.assertEqual(job, json.loads(rsp.content))
+                self.assertFalse(export_report.delay.called)
+
+                # Until the data changes
+                self.item1.quantity += 1
+                self.item1.save()
+                rsp = self.csv_get(url)
+                self.assertEqual('pending', json.loads(rsp.content)['status'])
+                self.assertTrue(export_report.delay.called)
+
+    def test_export_not_done(self):
+        with patch('reports.views.export_report'):
+            rsp = self.csv_get(self.url + "?export=download")
+        self.assertEqual(404, rsp.status_code)
+
+    def test_delete_old_exports(self):
+        media_root = mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with override_settings(MEDIA_ROOT=media_root):
+            self.assertEqual(0, delete_old_exports())
+            self.csv_get(self.url + "?export=status")
+            self.assertEqual(0, delete_old_exports())
+            later = datetime.now() + timedelta(days=2)
+            with patch('reports.export.datetime') as mock_datetime:
+                mock_datetime.now.return_value = later
+                self.assertEqual(1, delete_old_exports())
+
 
 class ShipmentReportTest(ReportTestMixin, TestCase):
     report_class = ShipmentReport
@@ -433,6 +551,46 @@ class ShipmentReportTest(ReportTestMixin, TestCase):
         self.assertIn(self.shipment1.pk, pks)
         self.assertNotIn(self.shipment2.pk, pks)
 
+    def test_no_export(self):
+        # Small reports are just downloaded
+        rsp = self.csv_get(self.url + "?export=status")
+        self.assertEqual(404, rsp.status_code)
+
+    def test_fragment_cache(self):
+        rsp = self.ajax_get(self.url + "?status=%d" % Shipment.STATUS_IN_TRANSIT)
+        self.assertEqual('miss', rsp[FRAGMENT_CACHE_HEADER])
+        hits = fragment_cache_stats()['hits']
+        with patch.object(ShipmentReport, 'get_ajax_context_data') as get_ajax_context_data:
+            cached = self.ajax_get(self.url + "?status=%d" % Shipment.STATUS_IN_TRANSIT)
+        self.assertFalse(get_ajax_context_data.called)
+        self.assertEqual('hit', cached[FRAGMENT_CACHE_HEADER])
+        self.assertEqual(rsp.content, cached.content)
+        self.assertEqual(hits + 1, fragment_cache_stats()['hits'])
+
+        # Not for other parameters, or once the data has changed
+        rsp = self.ajax_get(self.url + "?status=%d" % Shipment.STATUS_RECEIVED)
+        self.assertEqual('miss', rsp[FRAGMENT_CACHE_HEADER])
+        self.shipment1.save()
+        rsp = self.ajax_get(self.url + "?status=%d" % Shipment.STATUS_IN_TRANSIT)
+        self.assertEqual('miss', rsp[FRAGMENT_CACHE_HEADER])
+
+        rsp = self.client.get(reverse('report_cache_stats'))
+        self.assertEqual(fragment_cache_stats(), json.loads(rsp.content))
+
+    def test_not_modified(self):
+        url = self.url + "?status=%d" % Shipment.STATUS_IN_TRANSIT
+        etag = self.ajax_get(url)['ETag']
+        with patch.object(ShipmentReport, 'render_ajax') as render_ajax:
+            rsp = self.ajax_get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, rsp.status_code)
+        self.assertFalse(render_ajax.called)
+        # The whole page isn't the same as its table
+        rsp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, rsp.status_code)
+        self.shipment1.save()
+        rsp = self.ajax_get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, rsp.status_code)
+
 
 class ReceivedItemsByShipmentReportTest(ReportTestMixin, TestCase):
     report_class = ReceivedItemsByShipmentReport
@@ -489,6 +647,10 @@ class ReceivedItemsByDonorOrPartnerReportTest(ReportTestMixin, TestCase):
         self.assertEqual(set([self.donor2.pk]),
                          set([line.donor.pk for line in qs]))
 
+    def test_soft_deleted_shipment(self):
+        Shipment.objects.get(pk=self.shipment2.pk).soft_delete()
+        self.assertEqual(0, self.report_class().get_queryset().count())
+
     def test_donor_filtering(self):
         rsp = self.ajax_get(self.url + "?donor=%d" % self.donor2.pk)
         qs = rsp.context['queryset']
@@ -540,7 +702,7 @@ class ShipmentMonthlySummaryReportTest(ReportTestMixin, TestCase):
         qs = rsp.context['queryset']
         self.assertEqual(1, len(qs))
         self.assertEqual(self.day_before.month, qs[0]['month'].month)
-        self.assertEqual(1, qs[0]['pk__count'])
+        self.assertEqual(1, qs[0]['shipments'])
         last_month = self.day_before - timedelta(days=30)
         ShipmentFactory(
             partner=self.partner1,
@@ -551,7 +713,17 @@ class ShipmentMonthlySummaryReportTest(ReportTestMixin, TestCase):
         # 2 records
         self.assertEqual(2, len(qs))
         self.assertEqual(last_month.month, qs[1]['month'].month)
-        self.assertEqual(1, qs[1]['pk__count'])
+        self.assertEqual(1, qs[1]['shipments'])
+
+    def test_donor_filter(self):
+        # Another shipment that month, without any of donor1's items
+        ShipmentFactory(partner=self.partner2, shipment_date=self.day_before)
+        rsp = self.ajax_get(self.url + "?donor=%d" % self.donor1.pk)
+        qs = rsp.context['queryset']
+        self.assertEqual(1, len(qs))
+        self.assertEqual(1, qs[0]['shipments'])
+        rsp = self.ajax_get(self.url)
+        self.assertEqual(4, rsp.context['queryset'][0]['shipments'])
 
     def test_get_queryset(self):
         view = self.report_class()
@@ -559,7 +731,7 @@ class ShipmentMonthlySummaryReportTest(ReportTestMixin, TestCase):
         # all shipped within same month
         self.assertEqual(1, len(qs))
         self.assertEqual(self.day_before.month, qs[0]['month'].month)
-        self.assertEqual(3, qs[0]['pk__count'])
+        self.assertEqual(3, qs[0]['shipments'])
 
         last_month = self.day_before - timedelta(days=30)
         ShipmentFactory(
@@ -570,7 +742,7 @@ class ShipmentMonthlySummaryReportTest(ReportTestMixin, TestCase):
         # 2 records
         self.assertEqual(2, len(qs))
         self.assertEqual(last_month.month, qs[1]['month'].month)
-        self.assertEqual(1, qs[1]['pk__count'])
+        self.assertEqual(1, qs[1]['shipments'])
 
 
 class BadReportClassForTesting(ReportBase):
@@ -592,3 +764,25 @@ class TestBadReportClass(TestCase):
         view = BadReportClassForTesting()
         with self.assertRaises(ImproperlyConfigured):
             view.get_table(None)
+
+
+class ShipmentChoicesTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(ShipmentChoicesTest, cls).setUpClass()
+        bootstrap_permissions()
+
+    def setUp(self):
+        super(ShipmentChoicesTest, self).setUp()
+        self.user = CtsUserFactory(email="sam@example.com")
+        self.user.set_password("password")
+        self.user.save()
+        assert self.client.login(email="sam@example.com", password="password")
+        self.shipment1 = ShipmentFactory(description='Blankets')
+        self.shipment2 = ShipmentFactory(description='Tents')
+
+    def test_term(self):
+        rsp = self.client.get(reverse('report_shipment_choices') + '?term=tent')
+        self.assertEqual(200, rsp.status_code)
+        self.assertEqual([{'value': self.shipment2.pk, 'label': 'Tents'}],
+                         json.loads(rsp.content))
@@ -6,6 +6,10 @@ from . import views
 urlpatterns = [
     url(r'^$',
         views.ReportList.as_view(), name='reports_list'),
+    url(r'^shipment_choices/$',
+        views.ShipmentChoices.as_view(), name='report_shipment_choices'),
+    url(r'^cache_stats/$',
+        views.ReportCacheStats.as_view(), name='report_cache_stats'),
 ]
 
 # Add a URL pattern for each report that extends from ReportBase.
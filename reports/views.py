@@ -1,29 +1,48 @@
-from braces.views import LoginRequiredMixin, AjaxResponseMixin
+import hashlib
+
+from braces.views import LoginRequiredMixin, AjaxResponseMixin, JSONResponseMixin
 from django.conf import settings
 from django_tables2_reports.config import RequestConfigReport as RequestConfig
 from django_tables2_reports.utils import DEFAULT_PARAM_PREFIX, create_report_http_response, \
     REPORT_CONTENT_TYPES
 
 from django.conf.urls import url
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured, PermissionDenied
-from django.db import connection
-from django.db.models import Count
+from django.core.files.storage import default_storage
+from django.db.models import Sum
+from django.http import FileResponse, Http404, HttpRequest, HttpResponse, QueryDict
 from django.shortcuts import render
-from django.views.generic import TemplateView
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
+from django.views.generic import TemplateView, View
 
 from accounts.models import ROLE_PARTNER
+from cts.conditional import conditional_on_versions
 from cts.utils import camel_to_space, camel_to_underscore
 
 from shipments.models import PackageDBView, ShipmentDBView, PackageItemDBView, Shipment
 
+from . import export
 from . import filters
+from . import fragments
+from . import pagination
 from . import tables
-from .models import DonorCategoryData, DonorShipmentData
+from .models import DonorCategoryData, DonorShipmentData, ShipmentMonthlyData
+from .signals import get_data_version
+from .tasks import export_report
 
 
 # Flag our CSV downloads with the encoding that django-tables2-reports uses for them
 REPORT_CONTENT_TYPES['csv'] = 'text/csv; charset=%s' % settings.DEFAULT_CHARSET
 
+# How long to remember a report's row count and footer totals (they're also
+# forgotten when the reports' data changes)
+COUNT_CACHE_TIMEOUT = 60 * 60
+
+# Tells whether a report table came from the fragment cache
+FRAGMENT_CACHE_HEADER = 'X-Report-Cache'
+
 
 class ReportList(LoginRequiredMixin, TemplateView):
     template_name = 'reports/reports_list.html'
@@ -34,10 +53,60 @@ class ReportList(LoginRequiredMixin, TemplateView):
         return super(ReportList, self).get_context_data(**kwargs)
 
 
-class ReportBase(LoginRequiredMixin, AjaxResponseMixin, TemplateView):
+class ShipmentChoices(LoginRequiredMixin, JSONResponseMixin, View):
+    """
+    Look up the shipments the user can filter a report by, for the shipment
+    field's autocomplete: those whose label contains `term`, of the
+    `partner`, if given.
+    """
+    max_choices = 20
+
+    def get(self, request, *args, **kwargs):
+        term = request.GET.get('term', '').strip().lower()
+        shipments = filters.get_user_shipment_choices(request.user, request.GET)
+        choices = [
+            {'value': pk, 'label': label}
+            for pk, label, partner_id in shipments
+            if term in label.lower()
+        ]
+        return self.render_json_response(choices[:self.max_choices])
+
+
+class ReportCacheStats(LoginRequiredMixin, JSONResponseMixin, View):
+    """How often report tables have been served from the fragment cache"""
+
+    def get(self, request, *args, **kwargs):
+        return self.render_json_response(fragments.fragment_cache_stats())
+
+
+def get_report_class(report_name):
+    for report_class in ReportBase.__subclasses__():
+        if report_class.get_report_url_name() == report_name:
+            return report_class
+    raise ValueError("No report named %r" % report_name)
+
+
+class ReportBase(LoginRequiredMixin, AjaxResponseMixin, JSONResponseMixin, TemplateView):
     filter_class = None
     table_class = None
     partners_may_access = True
+    # Send CSV and XLSX downloads as they're generated, reading the data a
+    # chunk at a time, rather than building the whole file in memory first
+    streaming_downloads = True
+    # Make CSV and XLSX downloads in the background while the page waits,
+    # for reports that can take longer to download than a request may take
+    async_exports = False
+
+    # django-tables2's parameter for sorting the table
+    sort_param = 'sort'
+    # Page through the table by keyset, when its ordering allows, rather
+    # than by page number
+    keyset_pagination = True
+    # The parameter for the cursor of the page, with keyset pagination
+    cursor_param = 'cursor'
+    # Keep the rendered tables in a cache until the data changes (see
+    # reports.fragments)
+    cache_fragments = True
 
     # Default options for the report table.
     default_page_size = 1000
@@ -64,19 +133,41 @@ class ReportBase(LoginRequiredMixin, AjaxResponseMixin, TemplateView):
 
     def get(self, request, *args, **kwargs):
         param_report = "%s-%s" % (DEFAULT_PARAM_PREFIX, self.table_class.__name__.lower())
-        if self.request.GET.get(param_report, ''):
+        report_format = self.request.GET.get(param_report, '')
+        if report_format and self.request.GET.get('export'):
+            return self.export_response(report_format, param_report)
+        if report_format and self.streams_format(report_format):
+            return export.streaming_report_response(self.get_download_table(), report_format,
+                                                    param_report)
+        if report_format:
             # create the table; middleware will generate the CSV response
             queryset = self.get_filter().qs
-            table = self.get_table(queryset, downloadable=True)
+            table = self.get_table(queryset, downloadable=True, paginate=False)
             table.param_report = param_report
             return create_report_http_response(table, request)
         context = self.get_context_data(**kwargs)
         return self.render_to_response(context)
 
+    @method_decorator(conditional_on_versions())
     def get_ajax(self, request, *args, **kwargs):
         """Load the report table via AJAX after the initial page load."""
+        if not self.cache_fragments:
+            return self.render_ajax()
+        key = fragments.fragment_key(self.get_report_url_name(), self.get_fragment_params(),
+                                     self.get_export_scope())
+        content = fragments.get_fragment(key)
+        if content is None:
+            response = self.render_ajax()
+            fragments.set_fragment(key, response.content)
+            response[FRAGMENT_CACHE_HEADER] = 'miss'
+        else:
+            response = HttpResponse(content)
+            response[FRAGMENT_CACHE_HEADER] = 'hit'
+        return response
+
+    def render_ajax(self):
         context = self.get_ajax_context_data()
-        return render(request, self.get_ajax_template_names(), context)
+        return render(self.request, self.get_ajax_template_names(), context)
 
     def get_ajax_context_data(self, **kwargs):
         queryset = self.get_filter().qs
@@ -85,9 +176,24 @@ class ReportBase(LoginRequiredMixin, AjaxResponseMixin, TemplateView):
             'queryset': queryset,
             'report': report,
         }
+        if getattr(report, 'footer_totals', None):
+            context.update(self.get_footer(report, queryset))
         context.update(**kwargs)
         return context
 
+    def get_footer(self, table, queryset):
+        """
+        Return the table's footer totals. They're cached like the row count,
+        and usually worked out along with the first page of the table (see
+        paginate_table()), so this only has to aggregate them on a miss.
+        """
+        key = self.get_cache_key('footer')
+        footer = cache.get(key)
+        if footer is None:
+            footer = table.get_table_footer(queryset)
+            cache.set(key, footer, COUNT_CACHE_TIMEOUT)
+        return footer
+
     def get_ajax_template_names(self):
         """
         To use a custom template, create a template in `reports` with this
@@ -115,7 +221,90 @@ class ReportBase(LoginRequiredMixin, AjaxResponseMixin, TemplateView):
         """
         raise NotImplementedError("Report class must implement `get_queryset`.")
 
-    def get_table(self, queryset, downloadable=False):
+    def export_response(self, report_format, param_report):
+        """
+        For reports with async_exports: with export=status, return JSON with
+        the status of the export job for this request, starting it if need
+        be, and once it's done, the URL to download it from (which is this
+        one with export=download).
+        """
+        if not self.async_exports or not self.streams_format(report_format):
+            raise Http404
+        report_name = self.get_report_url_name()
+        params = self.get_export_params()
+        job_key = export.export_job_key(report_name, params, self.get_export_scope(),
+                                        report_format)
+        job = export.get_export_job(job_key)
+
+        if self.request.GET['export'] == 'download':
+            if not job or job['status'] != export.JOB_DONE:
+                raise Http404
+            response = FileResponse(default_storage.open(job['name']),
+                                    content_type=export.content_type(report_format))
+            response['Content-Disposition'] = 'attachment; filename=%s.%s' % (param_report,
+                                                                              report_format)
+            return response
+
+        if job is None and export.claim_export_job(job_key):
+            export_report.delay(report_name, params, self.request.user.pk, report_format,
+                                job_key)
+            job = export.get_export_job(job_key)
+        data = {'status': job['status'] if job else export.JOB_PENDING}
+        if data['status'] == export.JOB_DONE:
+            query = self.request.GET.copy()
+            query['export'] = 'download'
+            data['url'] = '%s?%s' % (self.request.path, query.urlencode())
+        return self.render_json_response(data)
+
+    def get_export_params(self):
+        """
+        Return the request's filter and sort parameters in a normal form,
+        as a sorted list of (name, sorted list of values) pairs.
+        """
+        names = set(self.get_filter().form.fields) | {self.sort_param}
+        return self.normalize_params(names)
+
+    def get_fragment_params(self):
+        """
+        Return all of the request's parameters in a normal form, like
+        get_export_params(), since the table's links carry them all.
+        """
+        return self.normalize_params(self.request.GET)
+
+    def normalize_params(self, names):
+        params = []
+        for name in sorted(names):
+            values = sorted(value for value in self.request.GET.getlist(name) if value)
+            if values:
+                params.append((name, values))
+        return params
+
+    def get_export_scope(self):
+        """Whose data the user can see, as far as the report filters are concerned"""
+        user = self.request.user
+        return 'all' if user.has_perm('reports.view_all_partners') else user.pk
+
+    @classmethod
+    def for_export(cls, params, user):
+        """
+        Return an instance of the report as if the user had asked for it with
+        the parameters from get_export_params(), for an export job to use.
+        """
+        request = HttpRequest()
+        request.GET = QueryDict('', mutable=True)
+        for name, values in params:
+            request.GET.setlist(name, values)
+        request.user = user
+        return cls(request=request)
+
+    def get_download_table(self):
+        return self.get_table(self.get_filter().qs, downloadable=True, paginate=False)
+
+    def streams_format(self, report_format):
+        return self.streaming_downloads and \
+            report_format in [fmt for label, fmt in export.STREAMING_FORMATS]
+
+    def get_table(self, queryset, downloadable=False, paginate=True):
         """Convert the queryset to a report table."""
         if not getattr(self, 'table_class', None):
             raise ImproperlyConfigured("Report class must define `table_class`")
@@ -128,12 +317,76 @@ class ReportBase(LoginRequiredMixin, AjaxResponseMixin, TemplateView):
         else:
             table = self.table_class(data, empty_text=self.empty_text, attrs=self.attrs)
 
-        config = RequestConfig(self.request, paginate={
-            'per_page': self.page_size,
-        })
+        if self.streaming_downloads:
+            # Offer our streaming formats instead of the library's own
+            table.formats = export.STREAMING_FORMATS + [
+                (label, fmt) for label, fmt in table.formats if not self.streams_format(fmt)
+            ]
+        table.async_exports = self.async_exports and self.streaming_downloads
+
+        config = RequestConfig(self.request, paginate=False)
         config.configure(table)
+        if paginate:
+            self.paginate_table(table)
         return table
 
+    def paginate_table(self, table):
+        """
+        Paginate the (sorted) table by keyset if we can, and otherwise by
+        page number.
+        """
+        keys = None
+        if self.keyset_pagination:
+            keys = pagination.keyset_ordering(getattr(table.data, 'queryset', None))
+        if keys is None:
+            config = RequestConfig(self.request, paginate={'per_page': self.page_size})
+            config.configure(table)
+            return
+        queryset = table.data.queryset
+        # If the footer totals aren't cached, have the first page's query
+        # work them out (and the row count) in the same pass
+        totals = getattr(table, 'footer_totals', None)
+        if totals and cache.get(self.get_cache_key('footer')) is not None:
+            totals = None
+        table.page_field = self.cursor_param
+        table.paginator = pagination.KeysetPaginator(table, keys, self.page_size,
+                                                     count=lambda: self.get_count(queryset),
+                                                     totals=totals)
+        table.page = table.paginator.page(self.request.GET.get(table.prefixed_page_field))
+        if table.paginator.window_totals is not None:
+            cache.set_many({
+                self.get_cache_key('footer'): table.paginator.window_totals,
+                self.get_cache_key('count'): table.paginator.window_count,
+            }, COUNT_CACHE_TIMEOUT)
+
+    def get_count(self, queryset):
+        """
+        Return how many rows the report's filtered queryset has. It's cached,
+        so paging through the report doesn't count them again.
+        """
+        key = self.get_cache_key('count')
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, COUNT_CACHE_TIMEOUT)
+        return count
+
+    def get_cache_key(self, kind):
+        """
+        Return the key to cache something of the given kind about the
+        report's data under: it's for the report's filters (but not its
+        sorting) and the user's scope, as of the current data version.
+        """
+        return 'reports:%s:%s' % (kind, self.data_digest)
+
+    @cached_property
+    def data_digest(self):
+        params = [(name, values) for name, values in self.get_export_params()
+                  if name != self.sort_param]
+        value = repr((self.get_report_url_name(), params, self.get_export_scope(),
+                      get_data_version()))
+        return hashlib.md5(value).hexdigest()
+
     def get_table_data(self, queryset):
         """Additional processing before converting the queryset to a table."""
         return queryset
@@ -171,7 +424,10 @@ class ReportBase(LoginRequiredMixin, AjaxResponseMixin, TemplateView):
 
     @property
     def page_size(self):
-        return self.request.GET.get('page_size', self.default_page_size)
+        try:
+            return max(1, int(self.request.GET['page_size']))
+        except (KeyError, ValueError):
+            return self.default_page_size
 
 
 class PackageReport(ReportBase):
@@ -180,39 +436,31 @@ class PackageReport(ReportBase):
     downloadable_table_class = tables.PackageDownloadableTable
     template_name = 'reports/report_package.html'
     partners_may_access = True
+    async_exports = True
 
     def get_queryset(self):
         order_by = ('shipment__partner', '-shipment__shipment_date',
                     'shipment__description', 'number_in_shipment')
         packages = PackageDBView.objects.order_by(*order_by)
         packages = packages.prefetch_related(
-            'shipment', 'shipment__partner', 'last_scan')
+            'shipment', 'shipment__partner', 'last_scan', 'last_scan__country')
         return packages
 
-    def get_ajax_context_data(self, **kwargs):
-        context = super(PackageReport, self).get_ajax_context_data(**kwargs)
-        context.update(context['report'].get_table_footer(context['queryset']))
-        return context
-
 
 class DonorByShipmentReport(ReportBase):
     filter_class = filters.DonorByShipmentReportFilter
     table_class = tables.DonorByShipmentReportTable
     downloadable_table_class = tables.DonorByShipmentDownloadableTable
     partners_may_access = True
+    async_exports = True
 
     def get_queryset(self):
         order_by = ('shipment__partner', 'donor__name', 'donor',
                     'shipment__shipment_date', 'shipment')
         data = DonorShipmentData.objects.order_by(*order_by)
-        data = data.prefetch_related('donor', 'shipment')
+        data = data.prefetch_related('donor', 'shipment', 'shipment__partner')
         return data
 
-    def get_ajax_context_data(self, **kwargs):
-        context = super(DonorByShipmentReport, self).get_ajax_context_data(**kwargs)
-        context.update(context['report'].get_table_footer(context['queryset']))
-        return context
-
 
 class DonorByCategoryReport(ReportBase):
     filter_class = filters.DonorByCategoryReportFilter
@@ -226,17 +474,13 @@ class DonorByCategoryReport(ReportBase):
         data = data.prefetch_related('donor', 'category')
         return data
 
-    def get_ajax_context_data(self, **kwargs):
-        context = super(DonorByCategoryReport, self).get_ajax_context_data(**kwargs)
-        context.update(context['report'].get_table_footer(context['queryset']))
-        return context
-
 
 class ItemReport(ReportBase):
     filter_class = filters.ItemReportFilter
     table_class = tables.ItemReportTable
     downloadable_table_class = tables.ItemDownloadableTable
     partners_may_access = False
+    async_exports = True
 
     def get_queryset(self):
         order_by = ('package__shipment__shipment_date', 'package__shipment')
@@ -245,11 +489,6 @@ class ItemReport(ReportBase):
             'package', 'item_category', 'donor', 'package__shipment__partner')
         return items
 
-    def get_ajax_context_data(self, **kwargs):
-        context = super(ItemReport, self).get_ajax_context_data(**kwargs)
-        context.update(context['report'].get_table_footer(context['queryset']))
-        return context
-
 
 class ShipmentReport(ReportBase):
     filter_class = filters.ShipmentReportFilter
@@ -287,7 +526,7 @@ class ReceivedItemsByDonorOrPartnerReport(ReportBase):
         data = DonorShipmentData.objects.filter(
             shipment__status=Shipment.STATUS_RECEIVED
         ).order_by(*order_by)
-        data = data.prefetch_related('donor', 'shipment')
+        data = data.prefetch_related('donor', 'shipment', 'shipment__partner')
         return data
 
 
@@ -297,11 +536,14 @@ class ShipmentMonthlySummaryReport(ReportBase):
     partners_may_access = False
 
     def get_queryset(self):
-        truncate_date = connection.ops.date_trunc_sql('month', 'shipment_date')
-        qs = ShipmentDBView.objects.extra({'month': truncate_date})
+        # With a donor, count the shipments with that donor's items, from
+        # the per-donor rows; otherwise all the shipments
+        params = self.request.GET if hasattr(self, 'request') else {}
+        qs = ShipmentMonthlyData.objects.filter(all_donors=not params.get('donor', None))
         order_by = ('-month', )
-        if hasattr(self, 'request') and self.request.GET.get('partner', None):
-            data = qs.values('month', 'partner__name').annotate(Count('pk')).order_by(*order_by)
+        if params.get('partner', None):
+            qs = qs.values('month', 'partner__name')
         else:
-            data = qs.values('month').annotate(Count('pk')).order_by(*order_by)
+            qs = qs.values('month')
+        data = qs.annotate(shipments=Sum('shipment_count')).order_by(*order_by)
         return data
@@ -0,0 +1,175 @@
+"""
+A minimal XLSX writer that produces the file as it goes, so a
+spreadsheet of any size can be streamed in constant memory.
+
+An XLSX file is a zip archive of XML files. The rows are turned into the
+sheet's XML as they're read, and compressed straight into the archive,
+using zip entries that give their sizes after their data (in a "data
+descriptor") rather than before it, so nothing has to be seeked back to.
+
+It only does what the report downloads need: one sheet of text and
+numbers, without styles, and less than 4 GB of it (no zip64).
+"""
+from decimal import Decimal
+import re
+import struct
+import time
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+
+CONTENT_TYPES_XML = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    b'<Default Extension="rels"'
+    b' ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    b'<Default Extension="xml" ContentType="application/xml"/>'
+    b'<Override PartName="/xl/workbook.xml"'
+    b' ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    b'<Override PartName="/xl/worksheets/sheet1.xml"'
+    b' ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    b'</Types>'
+)
+
+RELS_XML = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    b'<Relationship Id="rId1" Target="xl/workbook.xml" Type="http://schemas.openxmlformats.org'
+    b'/officeDocument/2006/relationships/officeDocument"/>'
+    b'</Relationships>'
+)
+
+WORKBOOK_XML = (
+    u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    u'<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    u' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    u'<sheets><sheet name=%s sheetId="1" r:id="rId1"/></sheets>'
+    u'</workbook>'
+)
+
+WORKBOOK_RELS_XML = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    b'<Relationship Id="rId1" Target="worksheets/sheet1.xml"'
+    b' Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+    b'</Relationships>'
+)
+
+SHEET_START_XML = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    b'<sheetData>'
+)
+SHEET_END_XML = b'</sheetData></worksheet>'
+
+# Excel doesn't allow these in sheet names
+SHEET_NAME_CHARS = re.compile(u'[][:*?/\\\\]')
+MAX_SHEET_NAME_LENGTH = 31
+
+# Nor XML these in text
+INVALID_XML_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+NUMBER_TYPES = (int, long, float, Decimal)
+
+
+def xlsx_stream(rows, sheet_name='Sheet1'):
+    """
+    Yield the bytes of an XLSX file with one sheet holding the given rows.
+    Each row is a sequence of values: numbers are written as numbers,
+    None as an empty cell and anything else as text.
+    """
+    sheet_name = SHEET_NAME_CHARS.sub(u'', sheet_name)[:MAX_SHEET_NAME_LENGTH] or u'Sheet1'
+    archive = ZipStream()
+    for name, contents in [
+        ('[Content_Types].xml', [CONTENT_TYPES_XML]),
+        ('_rels/.rels', [RELS_XML]),
+        ('xl/workbook.xml', [(WORKBOOK_XML % quoteattr(sheet_name)).encode('utf-8')]),
+        ('xl/_rels/workbook.xml.rels', [WORKBOOK_RELS_XML]),
+        ('xl/worksheets/sheet1.xml', _sheet_xml(rows)),
+    ]:
+        for data in archive.entry(name, contents):
+            yield data
+    yield archive.close()
+
+
+def _sheet_xml(rows):
+    yield SHEET_START_XML
+    for row in rows:
+        yield b''.join([b'<row>'] + [_cell_xml(value) for value in row] + [b'</row>'])
+    yield SHEET_END_XML
+
+
+def _cell_xml(value):
+    if value is None:
+        return b'<c/>'
+    if isinstance(value, NUMBER_TYPES) and not isinstance(value, bool):
+        return b'<c><v>' + str(value).encode('ascii') + b'</v></c>'
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    else:
+        value = unicode(value)
+    value = escape(INVALID_XML_CHARS.sub(u'', value))
+    return u'<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' \
+        .encode('utf-8') % value.encode('utf-8')
+
+
+class ZipStream(object):
+    """
+    Writes a zip archive, one deflated entry at a time, as a series of
+    byte strings. Call entry() for each file and then close().
+    """
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def _output(self, data):
+        self.offset += len(data)
+        return data
+
+    def entry(self, name, chunks):
+        """
+        Yield the bytes of an entry with the given name, whose contents are
+        the byte strings in the iterable `chunks`.
+        """
+        name = name.encode('utf-8')
+        dos_time, dos_date = _dos_time_and_date(time.localtime())
+        header_offset = self.offset
+        # Local file header. Flag 0x08 means the CRC and sizes are zero here,
+        # and follow the data in a data descriptor.
+        yield self._output(struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, 0x08, zlib.DEFLATED,
+                                       dos_time, dos_date, 0, 0, 0, len(name), 0) + name)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield self._output(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xffffffff
+        yield self._output(data + struct.pack('<4s3L', b'PK\x07\x08', crc, compressed_size, size))
+        self.entries.append((name, dos_time, dos_date, crc, compressed_size, size, header_offset))
+
+    def close(self):
+        """Return the bytes of the archive's central directory, which ends it"""
+        start = self.offset
+        directory = b''.join(
+            struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 20, 0x08, zlib.DEFLATED,
+                        dos_time, dos_date, crc, compressed_size, size,
+                        len(name), 0, 0, 0, 0, 0, header_offset) + name
+            for name, dos_time, dos_date, crc, compressed_size, size, header_offset
+            in self.entries
+        )
+        end = struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(self.entries),
+                          len(self.entries), len(directory), start, 0)
+        return self._output(directory + end)
+
+
+def _dos_time_and_date(t):
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
@@ -0,0 +1,158 @@
+"""
+Inserting many rows at once, faster than Model.save() or bulk_create()
+allow in Django 1.8.
+
+On PostgreSQL, big batches (at least COPY_THRESHOLD rows) are written with
+COPY FROM STDIN, streamed from the rows as they're generated; smaller ones
+with a single multi-row INSERT. Other databases fall back to the ORM.
+"""
+from django.db import connection
+from django.utils.encoding import force_bytes
+
+
+# Use COPY for batches of at least this many rows
+COPY_THRESHOLD = 5000
+
+
+def _use_copy(num_rows, threshold):
+    return connection.vendor == 'postgresql' and num_rows >= threshold
+
+
+def insert_returning_ids(objs, threshold=COPY_THRESHOLD):
+    """
+    Insert the given unsaved model instances, all of the same model, and
+    set their PKs. (bulk_create() can't tell us the new PKs.) Uses a single
+    INSERT ... RETURNING statement, or for big batches, reserves the PKs
+    from the table's sequence and writes the rows with COPY.
+
+    Like bulk_create(), doesn't call save() or send any signals, except on
+    databases other than PostgreSQL, where it has to save() each one.
+    Returns the list of objects.
+    """
+    if not objs:
+        return objs
+    model = type(objs[0])
+    opts = model._meta
+    if connection.vendor != 'postgresql':
+        for obj in objs:
+            obj.save(force_insert=True)
+        return objs
+
+    cursor = connection.cursor()
+    if _use_copy(len(objs), threshold):
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s))"
+                       " FROM generate_series(1, %s)",
+                       [opts.db_table, opts.pk.column, len(objs)])
+        for obj, (pk,) in zip(objs, cursor.fetchall()):
+            obj.pk = pk
+        fields = opts.concrete_fields
+        _copy(cursor, opts.db_table, [f.column for f in fields], (
+            [f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields]
+            for obj in objs
+        ))
+    else:
+        fields = [f for f in opts.concrete_fields if f is not opts.auto_field]
+        qn = connection.ops.quote_name
+        params = []
+        for obj in objs:
+            params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+                          for f in fields)
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        sql = 'INSERT INTO %s (%s) VALUES %s RETURNING %s' % (
+            qn(opts.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join([row] * len(objs)),
+            qn(opts.pk.column),
+        )
+        cursor.execute(sql, params)
+        # PostgreSQL returns the rows in the order of the VALUES list
+        for obj, (pk,) in zip(objs, cursor.fetchall()):
+            obj.pk = pk
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = connection.alias
+    return objs
+
+
+def insert_rows(model, field_names, rows, num_rows=None, threshold=COPY_THRESHOLD):
+    """
+    Insert rows of raw values into the model's table without creating model
+    instances (except as a fallback on databases other than PostgreSQL).
+    Each row is a sequence of values for the named fields, already in the
+    form the database wants (e.g. PKs for foreign keys).
+
+    `rows` may be any iterable, e.g. a generator, in which case pass the
+    number of rows it will produce as `num_rows`.
+
+    Like bulk_create(), doesn't call save() or send any signals.
+    """
+    if num_rows is None:
+        rows = list(rows)
+        num_rows = len(rows)
+    if not num_rows:
+        return
+    opts = model._meta
+    fields = [opts.get_field(name) for name in field_names]
+    if connection.vendor != 'postgresql':
+        model.objects.bulk_create([
+            model(**dict((f.attname, value) for f, value in zip(fields, values)))
+            for values in rows
+        ])
+        return
+
+    cursor = connection.cursor()
+    columns = [f.column for f in fields]
+    if _use_copy(num_rows, threshold):
+        _copy(cursor, opts.db_table, columns, rows)
+    else:
+        qn = connection.ops.quote_name
+        row = '(%s)' % ', '.join(['%s'] * len(columns))
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            qn(opts.db_table),
+            ', '.join(qn(column) for column in columns),
+            ', '.join([row] * num_rows),
+        )
+        cursor.execute(sql, [value for values in rows for value in values])
+
+
+def _copy(cursor, table, columns, rows):
+    qn = connection.ops.quote_name
+    sql = 'COPY %s (%s) FROM STDIN' % (qn(table), ', '.join(qn(column) for column in columns))
+    cursor.copy_expert(sql, CopyStream(rows))
+
+
+def _copy_value(value):
+    """Format a value for COPY's text format"""
+    if value is None:
+        return b'\\N'
+    return force_bytes(value)\
+        .replace(b'\\', b'\\\\')\
+        .replace(b'\t', b'\\t')\
+        .replace(b'\n', b'\\n')\
+        .replace(b'\r', b'\\r')
+
+
+class CopyStream(object):
+    """
+    A read-only file-like object for COPY FROM STDIN to read the rows from,
+    which formats them only as they're read, so the whole batch is never in
+    memory as text.
+    """
+    def __init__(self, rows):
+        self.lines = (b'\t'.join(_copy_value(value) for value in row) + b'\n' for row in rows)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
@@ -1,14 +1,26 @@
 # To use in migrations
 # We need to remove the views before we can change any table that they
 # refer to, then put them back again.
-from django.db import connection
+from contextlib import contextmanager
+import threading
+
+from django.db import connection, transaction
 
 from shipments.models import Shipment
 
 
-def run_sql(query):
+def run_sql(query, params=None):
     cursor = connection.cursor()
-    cursor.execute(query)
+    cursor.execute(query, params)
+    return cursor
+
+
+def stats_tables_exist():
+    """
+    The rollup tables only exist from migration 0026 on. Earlier migrations
+    still call add_views, and need the old self-aggregating views.
+    """
+    return 'shipments_shipmentstats' in connection.introspection.table_names()
 
 
 def add_views(apps, schema_editor):
@@ -23,6 +35,40 @@ def add_views(apps, schema_editor):
     FROM shipments_packageitem
     """)
 
+    if not stats_tables_exist():
+        add_aggregate_views()
+        return
+
+    # View of each package with the totals of its items, as maintained
+    # in shipments_packagestats by the triggers below
+    run_sql("""
+    CREATE OR REPLACE VIEW packages_view AS
+    SELECT
+      pkg.*,
+      COALESCE(stats.price_usd, 0) AS PRICE_USD,
+      COALESCE(stats.price_local, 0) AS PRICE_LOCAL,
+      COALESCE(stats.num_items, 0) AS NUM_ITEMS
+    FROM shipments_package as pkg
+    LEFT OUTER JOIN shipments_packagestats as stats ON stats.package_id = pkg.id
+    """)
+
+    # View of each shipment with the totals of its packages, as maintained
+    # in shipments_shipmentstats by the triggers below
+    run_sql("""
+    CREATE OR REPLACE VIEW shipments_view AS
+    SELECT
+      shipment.*,
+      COALESCE(stats.price_usd, 0) as PRICE_USD,
+      COALESCE(stats.price_local, 0) as PRICE_local,
+      COALESCE(stats.num_items, 0) as NUM_ITEMS,
+      COALESCE(stats.num_received_items, 0) AS NUM_RECEIVED_ITEMS,
+      COALESCE(stats.num_packages, 0) AS NUM_PACKAGES
+    FROM shipments_shipment as shipment
+    LEFT OUTER JOIN shipments_shipmentstats AS stats ON stats.shipment_id = shipment.id
+    """)
+
+
+def add_aggregate_views():
     # View to compute the price of each package by summing the prices of its items
     run_sql("""
     CREATE OR REPLACE VIEW packages_view AS
@@ -56,3 +102,366 @@ def drop_views(apps, schema_editor):
     run_sql("DROP VIEW IF EXISTS shipments_view")
     run_sql("DROP VIEW IF EXISTS packages_view")
     run_sql("DROP VIEW IF EXISTS package_items_view")
+
+
+# Rollups
+#
+# shipments_packagestats and shipments_shipmentstats hold the same totals the
+# views used to compute on every read. These triggers apply the change in
+# each PackageItem, Package or Shipment row to them as it's written, so they
+# stay current no matter how the row was written (save(), bulk_create(),
+# QuerySet.update() or raw SQL), except inside deferred_stats_updates().
+
+# While this temporary table exists, the item and package triggers do
+# nothing in that connection
+STATS_SUSPENDED_TABLE = 'shipments_stats_suspended'
+
+
+def add_stats_triggers(apps, schema_editor):
+    run_sql("""
+    CREATE OR REPLACE FUNCTION shipments_stats_suspended() RETURNS boolean AS $$
+      SELECT to_regclass('pg_temp.%s') IS NOT NULL
+    $$ LANGUAGE sql STABLE
+    """ % STATS_SUSPENDED_TABLE)
+
+    # Add a change in the quantity or price of the items in a package to the
+    # package's totals and to its shipment's totals.
+    run_sql("""
+    CREATE OR REPLACE FUNCTION shipments_apply_item_delta(
+        d_package_id integer, d_items bigint, d_usd numeric, d_local numeric
+    ) RETURNS void AS $$
+    DECLARE
+      pkg RECORD;
+    BEGIN
+      UPDATE shipments_packagestats SET
+        num_items = num_items + d_items,
+        price_usd = price_usd + d_usd,
+        price_local = price_local + d_local
+      WHERE package_id = d_package_id;
+
+      SELECT shipment_id, status INTO pkg FROM shipments_package WHERE id = d_package_id;
+      IF FOUND THEN
+        UPDATE shipments_shipmentstats SET
+          num_items = num_items + d_items,
+          num_received_items = num_received_items
+            + CASE WHEN pkg.status = %(received)s THEN d_items ELSE 0 END,
+          price_usd = price_usd + d_usd,
+          price_local = price_local + d_local
+        WHERE shipment_id = pkg.shipment_id;
+      END IF;
+    END;
+    $$ LANGUAGE plpgsql
+    """ % {'received': Shipment.STATUS_RECEIVED})
+
+    run_sql("""
+    CREATE OR REPLACE FUNCTION shipments_packageitem_stats() RETURNS trigger AS $$
+    BEGIN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM shipments_apply_item_delta(
+          OLD.package_id, -OLD.quantity,
+          -OLD.quantity * OLD.price_usd, -OLD.quantity * OLD.price_local);
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM shipments_apply_item_delta(
+          NEW.package_id, NEW.quantity,
+          NEW.quantity * NEW.price_usd, NEW.quantity * NEW.price_local);
+      END IF;
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """)
+
+    # Add or remove a whole package's totals from its shipment's totals.
+    run_sql("""
+    CREATE OR REPLACE FUNCTION shipments_apply_package_delta(
+        d_package_id integer, d_shipment_id integer, d_status integer, sign integer
+    ) RETURNS void AS $$
+    BEGIN
+      UPDATE shipments_shipmentstats AS s SET
+        num_packages = s.num_packages + sign,
+        num_items = s.num_items + sign * p.num_items,
+        num_received_items = s.num_received_items
+          + CASE WHEN d_status = %(received)s THEN sign * p.num_items ELSE 0 END,
+        price_usd = s.price_usd + sign * p.price_usd,
+        price_local = s.price_local + sign * p.price_local
+      FROM shipments_packagestats AS p
+      WHERE p.package_id = d_package_id AND s.shipment_id = d_shipment_id;
+    END;
+    $$ LANGUAGE plpgsql
+    """ % {'received': Shipment.STATUS_RECEIVED})
+
+    run_sql("""
+    CREATE OR REPLACE FUNCTION shipments_package_stats() RETURNS trigger AS $$
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        INSERT INTO shipments_packagestats (package_id, price_usd, price_local, num_items)
+          VALUES (NEW.id, 0, 0, 0);
+        UPDATE shipments_shipmentstats SET num_packages = num_packages + 1
+          WHERE shipment_id = NEW.shipment_id;
+        RETURN NULL;
+      END IF;
+      IF TG_OP = 'UPDATE'
+          AND OLD.shipment_id = NEW.shipment_id
+          AND (OLD.status IS NOT DISTINCT FROM %(received)s)
+            = (NEW.status IS NOT DISTINCT FROM %(received)s) THEN
+        -- Nothing that the shipment totals depend on has changed
+        RETURN NULL;
+      END IF;
+      PERFORM shipments_apply_package_delta(OLD.id, OLD.shipment_id, OLD.status, -1);
+      IF TG_OP = 'UPDATE' THEN
+        PERFORM shipments_apply_package_delta(NEW.id, NEW.shipment_id, NEW.status, 1);
+      ELSE
+        DELETE FROM shipments_packagestats WHERE package_id = OLD.id;
+      END IF;
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """ % {'received': Shipment.STATUS_RECEIVED})
+
+    run_sql("""
+    CREATE OR REPLACE FUNCTION shipments_shipment_stats() RETURNS trigger AS $$
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        INSERT INTO shipments_shipmentstats
+          (shipment_id, price_usd, price_local, num_items, num_received_items, num_packages)
+          VALUES (NEW.id, 0, 0, 0, 0, 0);
+      ELSE
+        DELETE FROM shipments_shipmentstats WHERE shipment_id = OLD.id;
+      END IF;
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """)
+
+    drop_stats_triggers(apps, schema_editor)
+    run_sql("""
+    CREATE TRIGGER shipments_packageitem_stats
+    AFTER INSERT OR DELETE OR UPDATE OF package_id, quantity, price_usd, price_local
+    ON shipments_packageitem
+    FOR EACH ROW WHEN (NOT shipments_stats_suspended())
+    EXECUTE PROCEDURE shipments_packageitem_stats()
+    """)
+    run_sql("""
+    CREATE TRIGGER shipments_package_stats
+    AFTER INSERT OR DELETE OR UPDATE OF shipment_id, status
+    ON shipments_package
+    FOR EACH ROW WHEN (NOT shipments_stats_suspended())
+    EXECUTE PROCEDURE shipments_package_stats()
+    """)
+    run_sql("""
+    CREATE TRIGGER shipments_shipment_stats
+    AFTER INSERT OR DELETE
+    ON shipments_shipment
+    FOR EACH ROW EXECUTE PROCEDURE shipments_shipment_stats()
+    """)
+
+
+def drop_stats_triggers(apps, schema_editor):
+    run_sql("DROP TRIGGER IF EXISTS shipments_packageitem_stats ON shipments_packageitem")
+    run_sql("DROP TRIGGER IF EXISTS shipments_package_stats ON shipments_package")
+    run_sql("DROP TRIGGER IF EXISTS shipments_shipment_stats ON shipments_shipment")
+
+
+def _package_totals_sql(where='TRUE'):
+    """The totals of the packages matching `where`, computed from their items"""
+    return """
+    SELECT
+      pkg.id AS package_id,
+      COALESCE(SUM(item.quantity * item.price_usd), 0) AS price_usd,
+      COALESCE(SUM(item.quantity * item.price_local), 0) AS price_local,
+      COALESCE(SUM(item.quantity), 0) AS num_items
+    FROM shipments_package AS pkg
+    LEFT OUTER JOIN shipments_packageitem AS item ON item.package_id = pkg.id
+    WHERE %s
+    GROUP BY pkg.id
+    """ % where
+
+
+# The totals computed from scratch, the same way the views used to
+PACKAGE_TOTALS_SQL = _package_totals_sql()
+
+SHIPMENT_TOTALS_SQL = """
+    SELECT
+      shipment.id AS shipment_id,
+      COALESCE(SUM(pkg.price_usd), 0) AS price_usd,
+      COALESCE(SUM(pkg.price_local), 0) AS price_local,
+      COALESCE(SUM(pkg.num_items), 0) AS num_items,
+      COALESCE(SUM(CASE WHEN p.status = %(received)s THEN pkg.num_items ELSE 0 END), 0)
+        AS num_received_items,
+      COUNT(p.id) AS num_packages
+    FROM shipments_shipment AS shipment
+    LEFT OUTER JOIN shipments_package AS p ON p.shipment_id = shipment.id
+    LEFT OUTER JOIN (%(packages)s) AS pkg ON pkg.package_id = p.id
+    GROUP BY shipment.id
+""" % {'received': Shipment.STATUS_RECEIVED, 'packages': PACKAGE_TOTALS_SQL}
+
+
+def rebuild_stats():
+    """
+    Throw away the rollup tables' contents and recompute them from the
+    shipments, packages and items.
+    """
+    run_sql("DELETE FROM shipments_packagestats")
+    run_sql("""
+    INSERT INTO shipments_packagestats (package_id, price_usd, price_local, num_items)
+    SELECT package_id, price_usd, price_local, num_items FROM (%s) AS totals
+    """ % PACKAGE_TOTALS_SQL)
+    run_sql("DELETE FROM shipments_shipmentstats")
+    run_sql("""
+    INSERT INTO shipments_shipmentstats
+      (shipment_id, price_usd, price_local, num_items, num_received_items, num_packages)
+    SELECT shipment_id, price_usd, price_local, num_items, num_received_items, num_packages
+    FROM (%s) AS totals
+    """ % SHIPMENT_TOTALS_SQL)
+
+
+def rebuild_stats_for_migration(apps, schema_editor):
+    rebuild_stats()
+
+
+def find_stats_mismatches():
+    """
+    Compare the rollup tables to totals computed from scratch.
+
+    Returns a tuple of two lists: the pks of packages and the pks of
+    shipments whose stored totals are missing or wrong.
+    """
+    cursor = run_sql("""
+    SELECT COALESCE(totals.package_id, stats.package_id)
+    FROM (%s) AS totals
+    FULL OUTER JOIN shipments_packagestats AS stats ON stats.package_id = totals.package_id
+    WHERE (totals.price_usd, totals.price_local, totals.num_items)
+      IS DISTINCT FROM (stats.price_usd, stats.price_local, stats.num_items)
+    ORDER BY 1
+    """ % PACKAGE_TOTALS_SQL)
+    package_ids = [row[0] for row in cursor.fetchall()]
+    cursor = run_sql("""
+    SELECT COALESCE(totals.shipment_id, stats.shipment_id)
+    FROM (%s) AS totals
+    FULL OUTER JOIN shipments_shipmentstats AS stats ON stats.shipment_id = totals.shipment_id
+    WHERE (totals.price_usd, totals.price_local, totals.num_items,
+           totals.num_received_items, totals.num_packages)
+      IS DISTINCT FROM (stats.price_usd, stats.price_local, stats.num_items,
+                        stats.num_received_items, stats.num_packages)
+    ORDER BY 1
+    """ % SHIPMENT_TOTALS_SQL)
+    shipment_ids = [row[0] for row in cursor.fetchall()]
+    return package_ids, shipment_ids
+
+
+# Bulk writes
+#
+# For every item written, the triggers update the package's totals and
+# then its shipment's. So a COPY of 100,000 items into one shipment, or a
+# chunked delete of them, updates the same shipmentstats row 100,000
+# times, and every other transaction writing to that shipment waits for
+# it. Bulk writes turn the triggers off for their own transaction instead,
+# and recompute the totals they touched once at the end.
+
+_state = threading.local()
+
+
+def is_deferring_stats_updates():
+    return getattr(_state, 'depth', 0) > 0
+
+
+@contextmanager
+def deferred_stats_updates():
+    """
+    Run the block in a transaction with the item and package triggers
+    turned off for it, and recompute the totals of the packages and
+    shipments it marked with mark_stats_dirty() at the end of it. May be
+    nested; only the outermost block does the update.
+
+    Other connections' triggers keep running as usual.
+    """
+    with transaction.atomic():
+        if not is_deferring_stats_updates():
+            _state.depth = 0
+            _state.package_ids = set()
+            _state.shipment_ids = set()
+            run_sql("CREATE TEMPORARY TABLE %s () ON COMMIT DROP" % STATS_SUSPENDED_TABLE)
+        _state.depth += 1
+        try:
+            yield
+            if _state.depth == 1:
+                run_sql("DROP TABLE %s" % STATS_SUSPENDED_TABLE)
+                package_ids, _state.package_ids = _state.package_ids, set()
+                shipment_ids, _state.shipment_ids = _state.shipment_ids, set()
+                refresh_stats(package_ids, shipment_ids)
+        finally:
+            _state.depth -= 1
+
+
+def mark_stats_dirty(package_ids=(), shipment_ids=()):
+    """
+    Items in these packages, or packages in these shipments, have been
+    added, changed or deleted. Outside of deferred_stats_updates() the
+    triggers took care of it already.
+    """
+    if is_deferring_stats_updates():
+        _state.package_ids.update(package_ids)
+        _state.shipment_ids.update(shipment_ids)
+
+
+def refresh_stats(package_ids, shipment_ids):
+    """
+    Recompute the totals of these packages from their items, dropping those
+    of packages that are gone, and then the totals of these shipments from
+    their packages' totals.
+
+    Each table's rows are locked before they're recomputed, so a concurrent
+    transaction's trigger either finished with them first and is counted,
+    or waits and then applies its change on top of the new totals.
+    """
+    package_ids = sorted(set(package_ids))
+    shipment_ids = sorted(set(shipment_ids))
+    if package_ids:
+        run_sql("SELECT 1 FROM shipments_packagestats WHERE package_id = ANY(%s)"
+                " ORDER BY package_id FOR UPDATE", [package_ids])
+        run_sql("""
+        DELETE FROM shipments_packagestats AS stats
+        WHERE stats.package_id = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM shipments_package WHERE id = stats.package_id)
+        """, [package_ids])
+        run_sql("""
+        INSERT INTO shipments_packagestats (package_id, price_usd, price_local, num_items)
+        SELECT pkg.id, 0, 0, 0 FROM shipments_package AS pkg
+        WHERE pkg.id = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM shipments_packagestats WHERE package_id = pkg.id)
+        """, [package_ids])
+        run_sql("""
+        UPDATE shipments_packagestats AS stats SET
+          price_usd = totals.price_usd,
+          price_local = totals.price_local,
+          num_items = totals.num_items
+        FROM (%s) AS totals
+        WHERE stats.package_id = totals.package_id
+        """ % _package_totals_sql('pkg.id = ANY(%s)'), [package_ids])
+    if shipment_ids:
+        run_sql("SELECT 1 FROM shipments_shipmentstats WHERE shipment_id = ANY(%s)"
+                " ORDER BY shipment_id FOR UPDATE", [shipment_ids])
+        run_sql("""
+        UPDATE shipments_shipmentstats AS stats SET
+          price_usd = totals.price_usd,
+          price_local = totals.price_local,
+          num_items = totals.num_items,
+          num_received_items = totals.num_received_items,
+          num_packages = totals.num_packages
+        FROM (
+          SELECT
+            s.shipment_id,
+            COALESCE(SUM(p.price_usd), 0) AS price_usd,
+            COALESCE(SUM(p.price_local), 0) AS price_local,
+            COALESCE(SUM(p.num_items), 0) AS num_items,
+            COALESCE(SUM(CASE WHEN pkg.status = %(received)s THEN p.num_items ELSE 0 END), 0)
+              AS num_received_items,
+            COUNT(pkg.id) AS num_packages
+          FROM shipments_shipmentstats AS s
+          LEFT OUTER JOIN shipments_package AS pkg ON pkg.shipment_id = s.shipment_id
+          LEFT OUTER JOIN shipments_packagestats AS p ON p.package_id = pkg.id
+          WHERE s.shipment_id = ANY(%%s)
+          GROUP BY s.shipment_id
+        ) AS totals
+        WHERE stats.shipment_id = totals.shipment_id
+        """ % {'received': Shipment.STATUS_RECEIVED}, [shipment_ids])
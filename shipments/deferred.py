@@ -0,0 +1,138 @@
+"""
+Deferred recomputation of the fields on Shipment that are derived from
+other rows: `donor` (from the donors of its package items) and
+`last_scan_status_label` (from its most recent scan).
+
+Code that changes items or scans marks the affected shipments dirty.
+Outside of `deferred_shipment_updates()` they're brought up to date right
+away. Inside it, they're collected and brought up to date just before the
+block's transaction commits, with one grouped query for all of them, so
+adding 500 items to a shipment no longer recomputes its donor 500 times.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+
+from django.db.models import Count, Max
+
+from cts.versions import SHIPMENTS, bump_versions, versioned_atomic
+
+
+_state = threading.local()
+
+
+def is_deferring_shipment_updates():
+    return getattr(_state, 'depth', 0) > 0
+
+
+@contextmanager
+def deferred_shipment_updates():
+    """
+    Run the block in a transaction, and bring every shipment it marked
+    dirty up to date at the end of it. May be nested; only the outermost
+    block does the update.
+    """
+    with versioned_atomic():
+        if not is_deferring_shipment_updates():
+            _state.depth = 0
+            _state.donor_ids = set()
+            _state.scan_label_ids = set()
+        _state.depth += 1
+        try:
+            yield
+            if _state.depth == 1:
+                flush()
+        finally:
+            _state.depth -= 1
+
+
+def flush():
+    """Update every shipment marked dirty so far in this block"""
+    donor_ids, _state.donor_ids = _state.donor_ids, set()
+    scan_label_ids, _state.scan_label_ids = _state.scan_label_ids, set()
+    update_donor_names(donor_ids)
+    update_last_scan_status_labels(scan_label_ids)
+
+
+def mark_donor_dirty(shipment_ids):
+    """The donors of the items in these shipments might have changed"""
+    shipment_ids = set(pk for pk in shipment_ids if pk)
+    if is_deferring_shipment_updates():
+        _state.donor_ids.update(shipment_ids)
+    else:
+        update_donor_names(shipment_ids)
+
+
+def mark_scan_label_dirty(shipment_ids):
+    """These shipments might have new scans"""
+    shipment_ids = set(pk for pk in shipment_ids if pk)
+    if is_deferring_shipment_updates():
+        _state.scan_label_ids.update(shipment_ids)
+    else:
+        update_last_scan_status_labels(shipment_ids)
+
+
+def compute_donor_names(shipment_ids):
+    """
+    Return a dictionary mapping each of the shipment PKs to the name of its
+    donor: the name of the donor of all its items if there's just one,
+    "Multiple" if there's more than one, or "None" if no item has a donor.
+    """
+    from shipments.models import PackageItem
+
+    names = dict.fromkeys(shipment_ids, "None")
+    if not names:
+        return names
+    rows = PackageItem.objects\
+        .filter(package__shipment_id__in=names.keys())\
+        .exclude(donor=None)\
+        .values('package__shipment_id')\
+        .annotate(num_donors=Count('donor__name', distinct=True), donor_name=Max('donor__name'))
+    for row in rows:
+        if row['num_donors'] > 1:
+            names[row['package__shipment_id']] = "Multiple"
+        else:
+            names[row['package__shipment_id']] = row['donor_name']
+    return names
+
+
+def update_donor_names(shipment_ids):
+    from shipments.models import Shipment
+
+    if _update_grouped(Shipment, 'donor', compute_donor_names(shipment_ids)):
+        bump_versions(SHIPMENTS)
+
+
+def update_last_scan_status_labels(shipment_ids):
+    """Set each shipment's last_scan_status_label from its most recent scan"""
+    from shipments.models import PackageScan, Shipment
+
+    if not shipment_ids:
+        return
+    labels = dict(
+        PackageScan.objects
+        .filter(shipment_id__in=shipment_ids)
+        .order_by('shipment_id', '-when')
+        .distinct('shipment_id')
+        .values_list('shipment_id', 'status_label')
+    )
+    if _update_grouped(Shipment, 'last_scan_status_label', labels):
+        bump_versions(SHIPMENTS)
+
+
+def _update_grouped(model, field_name, values):
+    """
+    Given a dictionary mapping PKs to new values of the field, update the
+    rows with one query per distinct value, skipping rows that already
+    have it. Returns how many rows were updated.
+    """
+    pks_by_value = defaultdict(list)
+    for pk, value in values.items():
+        pks_by_value[value].append(pk)
+    count = 0
+    for value, pks in pks_by_value.items():
+        count += model.objects\
+            .filter(pk__in=pks)\
+            .exclude(**{field_name: value})\
+            .update(**{field_name: value})
+    return count
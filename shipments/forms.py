@@ -11,6 +11,10 @@ from django.utils.translation import ugettext_lazy as _
 
 from catalog.lookups import CatalogItemLookup
 from cts.utils import uniqid, is_int
+from reports.signals import bulk_updates, note_changed_items, note_changed_shipments
+from shipments.bulk import insert_returning_ids, insert_rows
+from shipments.db_views import deferred_stats_updates, mark_stats_dirty
+from shipments.deferred import mark_donor_dirty
 from shipments.models import Shipment, Package, Kit, PackageItem
 
 
@@ -98,39 +102,51 @@ def create_packages_and_items(shipment, name, description, num_packages, number_
     :param num_packages: How many packages to create
     :param number_of_each_kit: A dictionary, key is a Kit, value is the number of copies of
     the kit to add to each package.
-    :return: QuerySet of the packages that were created.
+    :return: List of the packages that were created.
     """
-    first_pkg_number = shipment.next_package_number_in_shipment()
-    kits = number_of_each_kit.keys()
-    if len(kits) == 1:
-        only_kit = kits[0]
-    else:
-        only_kit = None
-
-    Package.objects.bulk_create([
-        Package(shipment=shipment,
-                name=name,
-                description=description,
-                kit=only_kit,
-                number_in_shipment=i + first_pkg_number,
-                code='%s%d.%d' % (settings.PREFIX_URL, shipment.id, i + first_pkg_number))
-        for i in range(num_packages)
-    ])
-
-    # We don't know what PKs were assigned to our new packages, so we
-    # need to query for the created packages. It's just one query, though.
-    packages_created = shipment.packages.filter(number_in_shipment__gte=first_pkg_number)
-
-    if number_of_each_kit:
-        # Go ahead and create package items from kits in each package
-        PackageItem.objects.bulk_create([
-            PackageItem.from_kit_item(package, kit_item,
-                                      quantity=number_of_each_kit[kit] * kit_item.quantity,
-                                      save=False)
-            for package in packages_created
-            for kit in kits
-            for kit_item in kit.items.all()
+    # The package and shipment totals are recomputed once at the end,
+    # rather than by the triggers for each row
+    with bulk_updates(), deferred_stats_updates():
+        first_pkg_number = shipment.reserve_package_numbers(num_packages)
+        kits = number_of_each_kit.keys()
+        if len(kits) == 1:
+            only_kit = kits[0]
+        else:
+            only_kit = None
+
+        # One INSERT (or COPY, for a lot of them) for all the packages,
+        # which tells us their PKs
+        packages_created = insert_returning_ids([
+            Package(shipment=shipment,
+                    name=name,
+                    description=description,
+                    kit=only_kit,
+                    number_in_shipment=i + first_pkg_number,
+                    code='%s%d.%d' % (settings.PREFIX_URL, shipment.id, i + first_pkg_number))
+            for i in range(num_packages)
         ])
+        # The packages count in the monthly report data even if they're empty
+        note_changed_shipments([shipment.pk])
+        mark_stats_dirty([package.pk for package in packages_created], [shipment.pk])
+
+        if number_of_each_kit:
+            # Go ahead and create package items from kits in each package,
+            # with one more INSERT or COPY. Load each kit's contents once, and
+            # stamp out the same rows for every package as they're written.
+            template = [
+                (number_of_each_kit[kit] * quantity, catalog_item_id) + values
+                for kit in kits
+                for quantity, catalog_item_id, values in kit.package_item_template()
+            ]
+            field_names = ('package', 'quantity', 'catalog_item') + PackageItem.CATALOG_ITEM_FIELDS
+            insert_rows(PackageItem, field_names, (
+                (package.pk,) + row
+                for package in packages_created
+                for row in template
+            ), num_rows=len(packages_created) * len(template))
+            mark_donor_dirty([shipment.pk])
+            note_changed_items(PackageItem.objects.filter(
+                package__in=[package.pk for package in packages_created]))
     return packages_created
 
 
@@ -149,7 +165,7 @@ class PackageCreateForm(forms.ModelForm):
 
     def save(self, *args, **kwargs):
         """
-        :return: QuerySet of the packages that were created.
+        :return: List of the packages that were created.
         """
         return create_packages_and_items(self.shipment, self.cleaned_data['name'],
                                          self.cleaned_data['description'],
@@ -223,7 +239,7 @@ class NewPackageFromKitForm(forms.ModelForm):
 
     def save(self, *args, **kwargs):
         """
-        :return: QuerySet of the packages that were created.
+        :return: List of the packages that were created.
         """
         return create_packages_and_items(self.shipment,
                                          self.cleaned_data['name'],
@@ -0,0 +1,29 @@
+"""
+Recompute the package and shipment totals that the database triggers
+maintain, or just check them against totals computed from scratch.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from shipments.db_views import find_stats_mismatches, rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the package and shipment totals and verifies them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true', dest='verify_only',
+                            default=False,
+                            help='Only report packages and shipments whose totals are wrong')
+
+    def handle(self, *args, **options):
+        if not options['verify_only']:
+            with transaction.atomic():
+                rebuild_stats()
+            self.stdout.write("Rebuilt package and shipment totals")
+        package_ids, shipment_ids = find_stats_mismatches()
+        if package_ids or shipment_ids:
+            raise CommandError(
+                "Totals are wrong for packages %s and shipments %s"
+                % (package_ids, shipment_ids))
+        self.stdout.write("Package and shipment totals are correct")
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import models, migrations
+import django.db.models.deletion
+import cts.utils
+
+from ..db_views import add_views, drop_views, add_stats_triggers, drop_stats_triggers, \
+    rebuild_stats_for_migration
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipments', '0025_auto_20150914_1603'),
+    ]
+
+    operations = [
+        # Forward or back, we drop the views and then add them again
+        migrations.RunPython(drop_views, add_views),
+        migrations.CreateModel(
+            name='PackageStats',
+            fields=[
+                ('package', models.OneToOneField(related_name='stats', primary_key=True, on_delete=django.db.models.deletion.DO_NOTHING, serialize=False, to='shipments.Package')),
+                ('price_usd', cts.utils.USDCurrencyField(default=Decimal('0.00'), max_digits=16, decimal_places=3)),
+                ('price_local', models.DecimalField(default=Decimal('0.00'), max_digits=16, decimal_places=4)),
+                ('num_items', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'package stats',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ShipmentStats',
+            fields=[
+                ('shipment', models.OneToOneField(related_name='stats', primary_key=True, on_delete=django.db.models.deletion.DO_NOTHING, serialize=False, to='shipments.Shipment')),
+                ('price_usd', cts.utils.USDCurrencyField(default=Decimal('0.00'), max_digits=16, decimal_places=3)),
+                ('price_local', models.DecimalField(default=Decimal('0.00'), max_digits=16, decimal_places=4)),
+                ('num_items', models.BigIntegerField(default=0)),
+                ('num_received_items', models.BigIntegerField(default=0)),
+                ('num_packages', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'shipment stats',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(add_stats_triggers, drop_stats_triggers),
+        migrations.RunPython(rebuild_stats_for_migration, migrations.RunPython.noop),
+        migrations.RunPython(add_views, drop_views),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ..db_views import add_views, drop_views
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipments', '0026_shipment_package_stats'),
+    ]
+
+    operations = [
+        # Forward or back, we drop the views and then add them again
+        migrations.RunPython(drop_views, add_views),
+        migrations.AddField(
+            model_name='shipment',
+            name='deleted',
+            field=models.BooleanField(default=False, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(add_views, drop_views),
+    ]
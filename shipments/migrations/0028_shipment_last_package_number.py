@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ..db_views import add_views, drop_views
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipments', '0027_shipment_deleted'),
+    ]
+
+    operations = [
+        # Forward or back, we drop the views and then add them again
+        migrations.RunPython(drop_views, add_views),
+        migrations.AddField(
+            model_name='shipment',
+            name='last_package_number',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        # Start each counter from the highest number already used
+        migrations.RunSQL(
+            """
+            UPDATE shipments_shipment AS shipment
+            SET last_package_number = pkg.max_number
+            FROM (
+              SELECT shipment_id, MAX(number_in_shipment) AS max_number
+              FROM shipments_package
+              GROUP BY shipment_id
+            ) AS pkg
+            WHERE pkg.shipment_id = shipment.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunPython(add_views, drop_views),
+    ]
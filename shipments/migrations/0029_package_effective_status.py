@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ..db_views import add_views, drop_views
+
+
+# Package.get_status(), for the packages we already have: statuses 8, 7
+# and 1 (canceled, lost and in progress) as they are, otherwise received
+# (5), in transit (4), picked up (3) or ready (2) depending on the dates,
+# and overdue (6) if in transit past the shipment's date_expected.
+SET_EFFECTIVE_STATUS = """
+UPDATE shipments_package SET effective_status = CASE
+  WHEN status IN (8, 7, 1) THEN status
+  WHEN date_received IS NOT NULL THEN 5
+  WHEN date_in_transit IS NOT NULL THEN 4
+  WHEN date_picked_up IS NOT NULL THEN 3
+  ELSE 2
+END;
+UPDATE shipments_package AS pkg SET effective_status = 6
+FROM shipments_shipment AS shipment
+WHERE shipment.id = pkg.shipment_id
+  AND pkg.effective_status = 4
+  AND shipment.date_expected < CURRENT_DATE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipments', '0028_shipment_last_package_number'),
+    ]
+
+    operations = [
+        # Forward or back, we drop the views and then add them again
+        migrations.RunPython(drop_views, add_views),
+        migrations.AddField(
+            model_name='package',
+            name='effective_status',
+            field=models.IntegerField(default=1, editable=False, db_index=True, choices=[(1, b'In progress'), (2, b'Ready for pickup'), (3, b'Picked up'), (4, b'In transit'), (5, b'Received'), (6, b'Overdue'), (7, b'Lost'), (8, b'Canceled')]),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(SET_EFFECTIVE_STATUS, migrations.RunSQL.noop),
+        migrations.RunPython(add_views, drop_views),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from ..db_views import add_stats_triggers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipments', '0029_package_effective_status'),
+    ]
+
+    operations = [
+        # Recreate the item and package triggers so deferred_stats_updates()
+        # can turn them off
+        migrations.RunPython(add_stats_triggers, migrations.RunPython.noop),
+    ]
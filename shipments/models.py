@@ -4,14 +4,22 @@ from decimal import Decimal
 from django.conf import settings
 from django.contrib.gis.db import models as gis_models
 from django.core.validators import MinValueValidator
-from django.db import models, transaction, connection
-from django.db.models import Q, Sum, Max
+from django.db import models, connection
+from django.db.models import Case, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
 
 from accounts.models import CtsUser, ROLE_PARTNER
 from catalog.models import Donor, Supplier, Transporter, DonorCode
 from cts.utils import USDCurrencyField
+from cts.versions import PACKAGES, SCANS, bump_versions, versioned_atomic
 from reports.models import DonorShipmentData
+from shipments.deferred import compute_donor_names, deferred_shipment_updates, \
+    is_deferring_shipment_updates, mark_donor_dirty
+
+
+# Stands in for the value of a field that wasn't loaded
+NOT_LOADED = object()
 
 
 class ShipmentMixin(object):
@@ -57,15 +65,7 @@ class ShipmentMixin(object):
         If there are no package items with donors, return "None".
         :return:
         """
-        pkg_items = PackageItem.objects.filter(package__shipment_id=self.pk).exclude(donor=None)
-        donors = set(pkg_items.values_list('donor__name', flat=True))
-        if len(donors) == 1:
-            name = donors.pop()
-        elif len(donors) > 1:
-            name = "Multiple"
-        else:
-            name = "None"
-        return name
+        return compute_donor_names([self.pk])[self.pk]
 
     def is_finalized(self):
         return self.status != Shipment.STATUS_IN_PROGRESS
@@ -77,6 +77,27 @@ class ShipmentMixin(object):
         return bool(self.pk) and self.status == Shipment.STATUS_LOST
 
 
+class ShipmentManager(models.Manager):
+    """Leaves out shipments that have been deleted but not purged yet"""
+    def get_queryset(self):
+        return super(ShipmentManager, self).get_queryset().filter(deleted=False)
+
+
+class LiveShipmentRowsManager(models.Manager):
+    """
+    Leaves out the rows belonging to shipments that have been deleted but
+    not purged yet. `shipment_field` is the lookup for the row's shipment.
+    """
+    def __init__(self, shipment_field='shipment'):
+        super(LiveShipmentRowsManager, self).__init__()
+        self.shipment_field = shipment_field
+
+    def get_queryset(self):
+        deleted = Shipment.all_objects.filter(deleted=True).values('pk')
+        return super(LiveShipmentRowsManager, self).get_queryset()\
+            .exclude(**{'%s__in' % self.shipment_field: deleted})
+
+
 class Shipment(ShipmentMixin, models.Model):
     STATUS_IN_PROGRESS = 1
     STATUS_READY = 2
@@ -114,93 +135,241 @@ class Shipment(ShipmentMixin, models.Model):
     status_note = models.TextField(blank=True)
     donor = models.CharField(max_length=45, null=True, blank=True)
     last_scan_status_label = models.CharField(max_length=128, blank=True, null=True)
+    # Set by soft_delete(); the shipment is purged by fast_delete() later
+    deleted = models.BooleanField(default=False, db_index=True)
+    # The highest number_in_shipment handed out so far; see reserve_package_numbers()
+    last_package_number = models.IntegerField(default=0, editable=False)
+
+    objects = ShipmentManager()
+    all_objects = models.Manager()
+
+    # How many rows fast_delete() deletes at a time
+    DELETE_CHUNK_SIZE = 5000
 
     def finalize(self):
-        self.status = Shipment.STATUS_READY
-        self.save()
         # Any packages that haven't started changing status yet, move to ready status
-        self.packages.filter(Q(status=None) | Q(status=Shipment.STATUS_IN_PROGRESS))\
-            .update(status=Shipment.STATUS_READY)
+        packages = self.packages.filter(Q(status=None) | Q(status=Shipment.STATUS_IN_PROGRESS))
+        Shipment.apply_status_transition(packages.values('pk'), Shipment.STATUS_READY,
+                                         shipment_ids=[self.pk])
+        self.status = Shipment.STATUS_READY
 
     def cancel(self):
         self.status = Shipment.STATUS_CANCELED
         self.save()
 
     def reopen(self):
-        self.status = Shipment.STATUS_IN_PROGRESS
-        self.save()
         # Any packages that haven't started transit yet,
         # change back to ready (actually shouldn't be possible to re-open
         # once packages have started transit, but playing it safe)
-        self.packages\
-            .filter(status=Shipment.STATUS_READY)\
-            .update(status=Shipment.STATUS_IN_PROGRESS)
+        packages = self.packages.filter(status=Shipment.STATUS_READY)
+        Shipment.apply_status_transition(packages.values('pk'), Shipment.STATUS_IN_PROGRESS,
+                                         shipment_ids=[self.pk])
+        self.status = Shipment.STATUS_IN_PROGRESS
+
+    # The date field of a package or shipment that's set when it first
+    # gets to each status
+    PACKAGE_STATUS_DATE_FIELDS = {
+        STATUS_PICKED_UP: 'date_picked_up',
+        STATUS_IN_TRANSIT: 'date_in_transit',
+        STATUS_RECEIVED: 'date_received',
+    }
+    SHIPMENT_STATUS_DATE_FIELDS = {
+        STATUS_PICKED_UP: 'date_picked_up',
+        STATUS_IN_TRANSIT: 'date_in_transit',
+    }
+
+    @classmethod
+    def apply_status_transition(cls, package_ids, status, when=None, label=None,
+                                shipment_ids=()):
+        """
+        Move the packages with the given PKs, and the shipments they're in, to
+        `status`, with one UPDATE for the packages and one for the shipments.
+        Also moves the shipments with PKs in `shipment_ids`, even if none of
+        their packages are moving.
+
+        Sets the package and shipment date fields for the new status to `when`
+        (default now) if they haven't been set yet, and their
+        last_scan_status_label to `label` if it's given.
+
+        This is equivalent to changing and saving each package and shipment,
+        without the cascade of saves and recomputations that would cause.
+        `package_ids` may be a list or a queryset of PKs.
+        """
+        from reports.signals import bulk_updates, note_changed_items, note_changed_shipments
+
+        when = when or now()
+        packages = Package.objects.filter(pk__in=package_ids)
+        with bulk_updates():
+            shipment_ids = set(shipment_ids)
+            shipment_ids.update(
+                packages.order_by().values_list('shipment_id', flat=True).distinct())
+
+            updates = {'status': status}
+            if label is not None:
+                updates['last_scan_status_label'] = label
+            date_field = cls.PACKAGE_STATUS_DATE_FIELDS.get(status)
+            if date_field:
+                updates[date_field] = Coalesce(F(date_field), Value(when))
+            updates['effective_status'] = Package.effective_status_expression(status, date_field)
+            # The number of items delivered might change
+            note_changed_items(PackageItem.objects.filter(package__in=packages), categories=False)
+            packages.update(**updates)
+
+            updates = {'status': status}
+            if label is not None:
+                updates['last_scan_status_label'] = label
+            date_field = cls.SHIPMENT_STATUS_DATE_FIELDS.get(status)
+            if date_field:
+                updates[date_field] = Coalesce(F(date_field), Value(when.date()))
+            Shipment.all_objects.filter(pk__in=shipment_ids).update(**updates)
+            note_changed_shipments(shipment_ids)
+
+            if Package.can_become_in_transit(status):
+                Package.mark_overdue(Package.objects.filter(shipment_id__in=shipment_ids))
+
+    def __init__(self, *args, **kwargs):
+        super(Shipment, self).__init__(*args, **kwargs)
+        # So save() can tell whether it changed; not there if it's deferred
+        self._loaded_date_expected = self.__dict__.get('date_expected', NOT_LOADED)
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         if self.pk:
-            self.donor = self.compute_donor_name()
+            if is_deferring_shipment_updates():
+                # It will be computed once, at the end of the batch
+                mark_donor_dirty([self.pk])
+            else:
+                self.donor = self.compute_donor_name()
         # If a Shipment Status is set to In Transit or Picked Up; set the associated
         # date field
         if self.date_picked_up is None and self.status == Shipment.STATUS_PICKED_UP:
             self.date_picked_up = now().date()
         if self.date_in_transit is None and self.status == Shipment.STATUS_IN_TRANSIT:
             self.date_in_transit = now().date()
+        if not self._state.adding and kwargs.get('update_fields') is None \
+                and not kwargs.get('force_insert'):
+            # Only reserve_package_numbers() changes the package number counter,
+            # and only soft_delete() sets deleted, so don't overwrite them with
+            # what might be stale copies
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in ('last_package_number', 'deleted')
+            ]
         super(Shipment, self).save(*args, **kwargs)
+        if not adding and self.date_expected != self._loaded_date_expected:
+            # Packages in transit might be overdue now, or not any more
+            Package.update_overdue(Package.objects.filter(shipment_id=self.pk))
+        self._loaded_date_expected = self.date_expected
 
     def next_package_number_in_shipment(self):
-        """Return the next package number that should be assigned to a package
-        in this shipment"""
-        # Quick n' dirty - return 1 more than the max number already in use
-        if self.packages.exists():
-            max_number = self.packages.aggregate(max_number=Max('number_in_shipment'))['max_number']
-            return 1 + max_number
-        return 1
-
-    def fast_delete(self):
+        """Reserve and return the next package number that should be assigned
+        to a package in this shipment"""
+        return self.reserve_package_numbers(1)
+
+    def reserve_package_numbers(self, count):
+        """
+        Reserve `count` consecutive package numbers in this shipment, and
+        return the first one.
+
+        Bumps the shipment's counter with a single UPDATE ... RETURNING, so
+        concurrent callers always get different numbers.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE shipments_shipment SET last_package_number = last_package_number + %s"
+            " WHERE id = %s RETURNING last_package_number",
+            [count, self.pk])
+        self.last_package_number = cursor.fetchone()[0]
+        return self.last_package_number - count + 1
+
+    def soft_delete(self):
+        """
+        Hide this shipment everywhere right away. It's not actually removed
+        until fast_delete() is called, usually from the delete_shipment task.
+        """
+        from reports.filters import invalidate_shipment_choices
+        from reports.signals import bulk_updates, note_changed_items, note_changed_shipments
+
+        with bulk_updates():
+            Shipment.all_objects.filter(pk=self.pk).update(deleted=True)
+            self.deleted = True
+            # Take its items out of the donor report data
+            note_changed_items(PackageItem.objects.filter(package__shipment_id=self.pk))
+            note_changed_shipments([self.pk])
+        # update() sends no post_save to do this
+        invalidate_shipment_choices()
+
+    def fast_delete(self, chunk_size=None, progress=None):
         """
         Delete this shipment, and its packages and packageitems and scans, while bypassing the
         background stuff that doesn't matter so much while we're deleting anyway.
+
+        Rows are deleted `chunk_size` at a time, each chunk in its own transaction,
+        so a big shipment doesn't hold its locks for the whole delete. If given,
+        `progress` is called with the number of rows deleted so far and the total
+        after each chunk.
         """
-        # We'll have to update the report data ourselves later,
-        # so make a note of the donor, category combinations:
-        donor_categories = set(
-            (item.donor_id, item.item_category_id)
-            for item in PackageItem.objects.filter(package__shipment=self)
-        )
+        from reports.signals import note_report_keys, report_keys
+        from shipments.db_views import deferred_stats_updates, mark_stats_dirty
 
-        cursor = connection.cursor()
+        chunk_size = chunk_size or self.DELETE_CHUNK_SIZE
+        items = PackageItem.objects.filter(package__shipment_id=self.pk)
+        packages = Package.objects.filter(shipment_id=self.pk)
+        scans = PackageScan.objects.filter(package__shipment_id=self.pk)
 
-        # delete package items
-        item_pks = PackageItem.objects.filter(package__shipment=self).values_list('pk', flat=True)
-        if item_pks:
-            item_pks = ','.join(str(pk) for pk in item_pks)
-            cursor.execute("DELETE FROM shipments_packageitem WHERE id IN (%s)" % item_pks)
-
-        # delete packages
-        package_pks = Package.objects.filter(shipment=self).values_list('pk', flat=True)
-        if package_pks:
-            # Remove any references to scans
-            Package.objects.filter(pk__in=package_pks).exclude(last_scan=None)\
-                .update(last_scan=None)
-            # Delete scans
-            scan_pks = PackageScan.objects.filter(package_id__in=package_pks)\
-                .values_list('pk', flat=True)
-            if scan_pks:
-                scan_pks = ','.join(str(pk) for pk in scan_pks)
-                cursor.execute("DELETE FROM shipments_location WHERE id IN (%s)" % scan_pks)
-            package_pks = ','.join(str(pk) for pk in package_pks)
-            cursor.execute("DELETE FROM shipments_package WHERE id IN (%s)" % package_pks)
-
-        # Remove any report data specific to this shipment
-        DonorShipmentData.objects.filter(shipment=self).delete()
-
-        # delete shipment itself
-        self.delete()
-
-        # Now, update
-        from reports.signals import _update_donor_category_data
-        for (donor_id, category_id) in donor_categories:
-            _update_donor_category_data(donor_id, category_id)
+        # We'll have to update the report data ourselves later,
+        # so make a note of the donor, shipment and category combinations:
+        donor_shipments, donor_categories = report_keys(items)
+
+        total = items.count() + packages.count() + scans.count()
+        done = 0
+        if progress:
+            progress(done, total)
+
+        # Remove any references to scans
+        packages.exclude(last_scan=None).update(last_scan=None)
+
+        package_ids_sql = "SELECT id FROM shipments_package WHERE shipment_id = %s"
+        # For each table, the column with the package whose totals
+        # deleting its rows changes
+        for table, where, package_column in [
+            ('shipments_packageitem', "package_id IN (%s)" % package_ids_sql, 'package_id'),
+            ('shipments_location', "package_id IN (%s)" % package_ids_sql, None),
+            ('shipments_package', "shipment_id = %s", 'id'),
+        ]:
+            while True:
+                # Rather than have the triggers update the shipment's
+                # totals for every row, recompute them once per chunk
+                with deferred_stats_updates():
+                    cursor = connection.cursor()
+                    cursor.execute(
+                        "DELETE FROM %(table)s WHERE id IN "
+                        "(SELECT id FROM %(table)s WHERE %(where)s LIMIT %%s)"
+                        " RETURNING %(returning)s"
+                        % {'table': table, 'where': where,
+                           'returning': package_column or 'NULL'},
+                        [self.pk, chunk_size])
+                    deleted = cursor.rowcount
+                    if package_column:
+                        mark_stats_dirty(set(row[0] for row in cursor.fetchall()), [self.pk])
+                done += deleted
+                if progress:
+                    progress(done, total)
+                if deleted < chunk_size:
+                    break
+
+        with versioned_atomic():
+            # Remove any report data specific to this shipment
+            DonorShipmentData.objects.filter(shipment_id=self.pk).delete()
+
+            # delete shipment itself
+            self.delete()
+
+        # Now, update the report data for any other shipments and
+        # categories with one query per table
+        note_report_keys(donor_shipments, donor_categories)
+        # The raw deletes didn't send signals
+        bump_versions(PACKAGES, SCANS)
 
 
 class ShipmentDBView(ShipmentMixin, models.Model):
@@ -241,6 +410,10 @@ class ShipmentDBView(ShipmentMixin, models.Model):
     num_received_items = models.IntegerField()  # from view
     donor = models.CharField(max_length=45, null=True, blank=True)
     last_scan_status_label = models.CharField(max_length=128, blank=True, null=True)
+    deleted = models.BooleanField(default=False)
+
+    objects = ShipmentManager()
+    all_objects = models.Manager()
 
     class Meta(object):
         db_table = 'shipments_view'
@@ -300,12 +473,19 @@ class ShipmentDBView(ShipmentMixin, models.Model):
 
 
 class PackageMixin(object):
+    # Package statuses that get_status() doesn't second-guess
+    STATUSES_AS_IS = (Shipment.STATUS_CANCELED, Shipment.STATUS_LOST,
+                      Shipment.STATUS_IN_PROGRESS)
+
     def get_status(self):
         """
         Package status isn't as simple as just looking at the status field.
+
+        This works it out from the package and its shipment, so use it for
+        packages being changed. effective_status has the same answer as of
+        the last save, without fetching the shipment.
         """
-        if self.status in (Shipment.STATUS_CANCELED, Shipment.STATUS_LOST,
-                           Shipment.STATUS_IN_PROGRESS):
+        if self.status in self.STATUSES_AS_IS:
             return self.status
         elif self.date_received:
             return Shipment.STATUS_RECEIVED
@@ -318,9 +498,6 @@ class PackageMixin(object):
         else:
             return Shipment.STATUS_READY
 
-    def get_status_display(self):
-        return status_as_string(self.get_status())
-
     @property
     def date_expected(self):
         return self.shipment.date_expected
@@ -353,6 +530,14 @@ class Package(PackageMixin, models.Model):
     # TODO: Can this be combined with last_scan?
     last_scan_status_label = models.CharField(max_length=128, blank=True, null=True)
 
+    # What get_status() returns, stored so it can be filtered and sorted on
+    # without looking at the shipment. Kept up to date by save(),
+    # Shipment.apply_status_transition(), and the mark_overdue_packages task
+    # for packages that become overdue just by time passing.
+    effective_status = models.IntegerField(choices=Shipment.SHIPMENT_STATUS_CHOICES,
+                                           default=Shipment.STATUS_IN_PROGRESS,
+                                           editable=False, db_index=True)
+
     def __unicode__(self):
         return (u'Package #%d %s in shipment %s'
                 % (self.number_in_shipment, self.name, self.shipment))
@@ -380,8 +565,81 @@ class Package(PackageMixin, models.Model):
                 and self.shipment.status < Shipment.STATUS_PICKED_UP):
             self.shipment.status = Shipment.STATUS_PICKED_UP
             self.shipment.save()
+        self.effective_status = self.get_status()
         super(Package, self).save(*args, **kwargs)
 
+    @classmethod
+    def effective_status_expression(cls, status=None, date_field=None):
+        """
+        Return an expression for QuerySet.update() that works out
+        effective_status the way get_status() does, except for being
+        overdue (see mark_overdue()).
+
+        An UPDATE's expressions see the old values of the row, so if the
+        same update is setting the status, or one of the date fields, say so.
+        """
+        if status in cls.STATUSES_AS_IS:
+            return Value(status)
+        whens = []
+        if status is None:
+            whens.append(When(status__in=cls.STATUSES_AS_IS, then=F('status')))
+        default = Shipment.STATUS_READY
+        # Latest status first
+        for date_status, name in sorted(Shipment.PACKAGE_STATUS_DATE_FIELDS.items(),
+                                        reverse=True):
+            if name == date_field:
+                default = date_status
+                break
+            whens.append(When(**{name + '__isnull': False, 'then': Value(date_status)}))
+        if not whens:
+            return Value(default)
+        return Case(*whens, default=Value(default), output_field=models.IntegerField())
+
+    @classmethod
+    def can_become_in_transit(cls, status):
+        """
+        Whether effective_status_expression(status) can set a package's
+        effective status to in transit, so it might be overdue.
+        """
+        if status in cls.STATUSES_AS_IS:
+            return False
+        # Only a status with a later date than in transit overrides it
+        return status not in Shipment.PACKAGE_STATUS_DATE_FIELDS \
+            or status <= Shipment.STATUS_IN_TRANSIT
+
+    @classmethod
+    def mark_overdue(cls, packages=None, today=None):
+        """
+        Move the packages that are in transit past their shipment's
+        date_expected to overdue, with one UPDATE. Looks at all packages
+        unless given a queryset. Returns how many were moved.
+        """
+        if packages is None:
+            packages = cls.objects.all()
+        today = today or now().date()
+        count = packages\
+            .filter(effective_status=Shipment.STATUS_IN_TRANSIT,
+                    shipment__date_expected__lt=today)\
+            .update(effective_status=Shipment.STATUS_OVERDUE)
+        if count:
+            bump_versions(PACKAGES)
+        return count
+
+    @classmethod
+    def update_overdue(cls, packages):
+        """
+        Like mark_overdue(), but also move overdue packages back to in
+        transit if their shipment isn't expected yet any more.
+        """
+        today = now().date()
+        count = packages\
+            .filter(effective_status=Shipment.STATUS_OVERDUE)\
+            .exclude(shipment__date_expected__lt=today)\
+            .update(effective_status=Shipment.STATUS_IN_TRANSIT)
+        if count:
+            bump_versions(PACKAGES)
+        cls.mark_overdue(packages, today)
+
     @classmethod
     def make_from_kit(cls, shipment, kit, quantity):
         """
@@ -389,7 +647,7 @@ class Package(PackageMixin, models.Model):
         contents of the Kit to a new package.
         Returns the new package.
         """
-        with transaction.atomic():
+        with deferred_shipment_updates():
             pkg = cls.objects.create(
                 shipment=shipment,
                 name=kit.name,
@@ -469,6 +727,11 @@ class PackageDBView(PackageMixin, models.Model):
 
     last_scan_status_label = models.CharField(max_length=128, blank=True, null=True)
 
+    effective_status = models.IntegerField(choices=Shipment.SHIPMENT_STATUS_CHOICES)
+
+    objects = LiveShipmentRowsManager('shipment')
+    all_objects = models.Manager()
+
     class Meta(object):
         managed = False
         db_table = 'packages_view'
@@ -481,6 +744,44 @@ class PackageDBView(PackageMixin, models.Model):
         return status_as_string(self.status)
 
 
+class PackageStats(models.Model):
+    """
+    Running totals of the items in a package, read by packages_view.
+
+    Maintained by database triggers (see shipments/db_views.py), or by
+    bulk writes in deferred_stats_updates(); never written through the
+    ORM. Use the rebuild_shipment_stats command to recompute them from
+    scratch.
+    """
+    package = models.OneToOneField(Package, primary_key=True, related_name='stats',
+                                   on_delete=models.DO_NOTHING)
+    price_usd = USDCurrencyField(max_digits=16)
+    price_local = models.DecimalField(max_digits=16, decimal_places=4, default=Decimal('0.00'))
+    num_items = models.BigIntegerField(default=0)
+
+    class Meta(object):
+        verbose_name_plural = 'package stats'
+
+
+class ShipmentStats(models.Model):
+    """
+    Running totals of the packages and items in a shipment, read by
+    shipments_view.
+
+    Maintained by database triggers like PackageStats.
+    """
+    shipment = models.OneToOneField(Shipment, primary_key=True, related_name='stats',
+                                    on_delete=models.DO_NOTHING)
+    price_usd = USDCurrencyField(max_digits=16)
+    price_local = models.DecimalField(max_digits=16, decimal_places=4, default=Decimal('0.00'))
+    num_items = models.BigIntegerField(default=0)
+    num_received_items = models.BigIntegerField(default=0)
+    num_packages = models.BigIntegerField(default=0)
+
+    class Meta(object):
+        verbose_name_plural = 'shipment stats'
+
+
 class KitItem(models.Model):
     """
     An item in a kit.
@@ -535,6 +836,19 @@ class Kit(models.Model):
     def price_local(self):
         return sum([item.quantity * item.catalog_item.price_local for item in self.items.all()])
 
+    def package_item_template(self):
+        """
+        Return the contents of the kit, as needed to stamp out PackageItems
+        for it, from one query: a list of (quantity, catalog_item_id, values)
+        tuples, where values are the catalog item's values for
+        PackageItem.CATALOG_ITEM_FIELDS.
+        """
+        lookups = ['catalog_item__%s' % name for name in PackageItem.CATALOG_ITEM_FIELDS]
+        return [
+            (row[0], row[1], row[2:])
+            for row in self.items.order_by().values_list('quantity', 'catalog_item', *lookups)
+        ]
+
     class Meta(object):
         ordering = ['name']
 
@@ -591,11 +905,9 @@ class PackageItem(models.Model):
 
     def save(self, *args, **kwargs):
         super(PackageItem, self).save(*args, **kwargs)
-        if self.package and self.package.shipment:
+        if self.package and self.package.shipment_id:
             # Possibly update donor in shipment object
-            donor = self.package.shipment.compute_donor_name()
-            if donor != self.package.shipment.donor:
-                self.package.shipment.save()
+            mark_donor_dirty([self.package.shipment_id])
 
     def get_description(self):
         if self.description:
@@ -628,21 +940,26 @@ class PackageItem(models.Model):
             quantity=quantity,
             save=save)
 
+    # Fields whose values are copied from the catalog item
+    CATALOG_ITEM_FIELDS = (
+        'description',
+        'unit',
+        'price_usd',
+        'price_local',
+        'item_category',
+        'donor',
+        'donor_t1',
+        'supplier',
+        'weight',
+    )
+
     @staticmethod
     def from_catalog_item(package, catalog_item, quantity, save=True):
         item = PackageItem(
             package=package,
             quantity=quantity,
             catalog_item=catalog_item,
-            description=catalog_item.description,
-            unit=catalog_item.unit,
-            price_usd=catalog_item.price_usd,
-            price_local=catalog_item.price_local,
-            item_category=catalog_item.item_category,
-            donor=catalog_item.donor,
-            donor_t1=catalog_item.donor_t1,
-            supplier=catalog_item.supplier,
-            weight=catalog_item.weight,
+            **{name: getattr(catalog_item, name) for name in PackageItem.CATALOG_ITEM_FIELDS}
         )
         if save:
             item.save()
@@ -719,6 +1036,9 @@ class PackageItemDBView(models.Model):
         default=Decimal('0.00'),
     )
 
+    objects = LiveShipmentRowsManager('package__shipment')
+    all_objects = models.Manager()
+
     class Meta(object):
         managed = False
         db_table = 'package_items_view'
@@ -762,6 +1082,36 @@ class PackageScan(models.Model):
                 self.country = qs[0]
         super(PackageScan, self).save(*args, **kwargs)
 
+    @classmethod
+    def bulk_record(cls, scans):
+        """
+        Insert these new scans, which must have their package and shipment
+        set, and then set their countries and their packages' last_scan,
+        with a query each for the whole lot. This is what saving each of
+        them would do, without the queries per scan.
+        """
+        if not scans:
+            return
+        cls.objects.bulk_create(scans)
+        package_ids = list(set(scan.package_id for scan in scans))
+        whens = list(set(scan.when for scan in scans))
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE shipments_location AS scan SET country_id = border.id"
+            " FROM shipments_worldborder AS border"
+            ' WHERE scan.package_id = ANY(%s) AND scan."when" = ANY(%s)'
+            " AND scan.country_id IS NULL"
+            " AND ST_Contains(border.mpoly, ST_SetSRID(ST_MakePoint("
+            "     scan.longitude::float8, scan.latitude::float8), 4326))",
+            [package_ids, whens])
+        cursor.execute(
+            "UPDATE shipments_package AS package SET last_scan_id = ("
+            "     SELECT id FROM shipments_location WHERE package_id = package.id"
+            '     ORDER BY "when" DESC, id DESC LIMIT 1)'
+            " WHERE package.id = ANY(%s)",
+            [package_ids])
+        bump_versions(SCANS, PACKAGES)
+
 
 class WorldBorder(gis_models.Model):
     # Regular Django fields corresponding to the attributes in the
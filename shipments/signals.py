@@ -1,7 +1,8 @@
 from django.dispatch import receiver
 from django.db.models.signals import post_delete, post_save
 
-from shipments.models import PackageScan
+from cts.versions import CATALOG, ITEMS, PACKAGES, SCANS, SHIPMENTS, bump_versions
+from shipments.models import Kit, KitItem, Package, PackageItem, PackageScan, Shipment
 
 
 @receiver(post_save, sender=PackageScan)
@@ -16,4 +17,24 @@ def _update_last_scan(package):
         package.last_scan = None
     else:
         package.last_scan = locs[0]
-    package.save()
+    # Update just this column, without the rest of Package.save()
+    Package.objects.filter(pk=package.pk).update(last_scan=package.last_scan)
+    bump_versions(PACKAGES)
+
+
+# Which data version (see cts.versions) each model is part of
+VERSION_DOMAINS = {
+    Shipment: SHIPMENTS,
+    Package: PACKAGES,
+    PackageItem: ITEMS,
+    PackageScan: SCANS,
+    Kit: CATALOG,
+    KitItem: CATALOG,
+}
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_version_signal(sender, **kwargs):
+    if sender in VERSION_DOMAINS:
+        bump_versions(VERSION_DOMAINS[sender])
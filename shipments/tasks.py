@@ -1,22 +1,62 @@
 import logging
 from celery.task import task
-from shipments.models import Shipment
+from django.core.cache import cache
+from shipments.models import Package, Shipment
 
 
 logger = logging.getLogger(__name__)
 
+# How long to remember the progress of a delete_shipment task
+DELETE_PROGRESS_TIMEOUT = 24 * 60 * 60
+
+
+def delete_progress_key(shipment_id):
+    return 'shipments:delete_progress:%s' % shipment_id
+
+
+def get_delete_progress(shipment_id):
+    """
+    Return a dictionary with the number of rows the delete_shipment task has
+    deleted so far (`done`) out of `total`, and whether it's `finished`, or
+    None if there's no delete in progress for that shipment.
+    """
+    return cache.get(delete_progress_key(shipment_id))
+
 
 @task
 def delete_shipment(shipment_id):
     """
     Task to delete a shipment, because it can take more than 60 seconds.
+
+    The shipment has usually been soft-deleted already, so it's gone from
+    the UI while this purges it.
     """
+    key = delete_progress_key(shipment_id)
+
+    def record_progress(done, total):
+        cache.set(key, {'done': done, 'total': total, 'finished': False},
+                  DELETE_PROGRESS_TIMEOUT)
+        logger.debug("Deleting shipment %s: %d of %d rows deleted" % (shipment_id, done, total))
+
     try:
         try:
-            shipment = Shipment.objects.get(pk=shipment_id)
+            shipment = Shipment.all_objects.get(pk=shipment_id)
         except Shipment.DoesNotExist:
             logger.error("In delete_shipment task, no shipment with id %s" % shipment_id)
         else:
-            shipment.fast_delete()
+            shipment.fast_delete(progress=record_progress)
+            progress = cache.get(key) or {'done': 0, 'total': 0}
+            progress['finished'] = True
+            cache.set(key, progress, DELETE_PROGRESS_TIMEOUT)
     except Exception:
         logger.exception("Unexpected error in delete_shipment")
+
+
+@task
+def mark_overdue_packages():
+    """
+    Packages become overdue just by time passing, without anything being
+    saved, so move the ones whose shipments were expected by now.
+    """
+    count = Package.mark_overdue()
+    logger.info("%d packages are now overdue" % count)
@@ -0,0 +1,62 @@
+from django.test import TestCase
+
+from cts.tests.benchmark import benchmark, best_time, cpu_time
+from shipments.db_views import find_stats_mismatches
+from shipments.forms import create_packages_and_items
+from shipments.models import PackageItem, ShipmentStats
+from shipments.tests.factories import KitFactory, KitItemFactory, ShipmentFactory
+
+
+@benchmark
+class TestCreatePackagesBenchmark(TestCase):
+    num_packages = 1000
+    num_kit_items = 10
+
+    def setUp(self):
+        super(TestCreatePackagesBenchmark, self).setUp()
+        self.shipment = ShipmentFactory()
+        self.kit = KitFactory()
+        for i in range(self.num_kit_items):
+            KitItemFactory(kit=self.kit)
+
+    def test_create_packages_from_kit(self):
+        seconds = cpu_time(lambda: create_packages_and_items(
+            self.shipment, 'name', 'description', self.num_packages, {self.kit: 2}))
+        print("Created %d packages of %d items in %.3f CPU seconds"
+              % (self.num_packages, self.num_kit_items, seconds))
+        self.assertEqual(self.num_packages * self.num_kit_items,
+                         PackageItem.objects.filter(package__shipment=self.shipment).count())
+        self.assertLess(seconds, 0.5)
+
+
+@benchmark
+class TestCopyBenchmark(TestCase):
+    """
+    Writing 100,000 items into one shipment with COPY, and deleting them
+    again, shouldn't update the shipment's totals once per item.
+    """
+    num_packages = 10000
+    num_kit_items = 10
+
+    def setUp(self):
+        super(TestCopyBenchmark, self).setUp()
+        self.shipment = ShipmentFactory()
+        self.kit = KitFactory()
+        for i in range(self.num_kit_items):
+            KitItemFactory(kit=self.kit)
+
+    def test_copy_and_delete(self):
+        num_items = self.num_packages * self.num_kit_items
+        seconds = best_time(lambda: create_packages_and_items(
+            self.shipment, 'name', 'description', self.num_packages, {self.kit: 1}), repeat=1)
+        print("Copied %d items in %.3f seconds" % (num_items, seconds))
+        self.assertEqual(num_items,
+                         PackageItem.objects.filter(package__shipment=self.shipment).count())
+        self.assertEqual(self.num_packages,
+                         ShipmentStats.objects.get(pk=self.shipment.pk).num_packages)
+        self.assertEqual(([], []), find_stats_mismatches())
+
+        seconds = best_time(self.shipment.fast_delete, repeat=1)
+        print("Deleted %d items in %.3f seconds" % (num_items, seconds))
+        self.assertFalse(PackageItem.objects.exists())
+        self.assertEqual(([], []), find_stats_mismatches())
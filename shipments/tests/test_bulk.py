@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal
+
+from django.test import TestCase
+
+from shipments.bulk import CopyStream, insert_returning_ids, insert_rows
+from shipments.models import Package, PackageItem, PackageDBView, ShipmentDBView
+from shipments.tests.factories import ShipmentFactory
+
+
+class TestCopyStream(TestCase):
+    def test_read_in_pieces(self):
+        stream = CopyStream([(1, u'a\tb'), (None, u'caf\xe9\n')])
+        data = b''
+        piece = stream.read(3)
+        while piece:
+            data += piece
+            piece = stream.read(3)
+        self.assertEqual(b'1\ta\\tb\n\\N\tcaf\xc3\xa9\\n\n', data)
+
+
+class TestInsert(TestCase):
+    def setUp(self):
+        super(TestInsert, self).setUp()
+        self.shipment = ShipmentFactory()
+
+    def make_packages(self, threshold):
+        return insert_returning_ids([
+            Package(shipment=self.shipment, name=u'Caf\xe9 %d' % i, number_in_shipment=i,
+                    code='code-%d-%d' % (threshold, i))
+            for i in range(1, 4)
+        ], threshold=threshold)
+
+    def check_insert(self, threshold):
+        packages = self.make_packages(threshold)
+        for pkg in packages:
+            self.assertEqual(pkg.name, Package.objects.get(pk=pkg.pk).name)
+        field_names = ['package', 'quantity', 'price_usd', 'price_local', 'unit', 'description',
+                       'donor']
+        insert_rows(PackageItem, field_names, [
+            (pkg.pk, 2, Decimal('1.5'), Decimal('0'), '', u'tab\there', None)
+            for pkg in packages
+        ], threshold=threshold)
+        for pkg in packages:
+            item = PackageItem.objects.get(package=pkg)
+            self.assertEqual(u'tab\there', item.description)
+            self.assertEqual(Decimal('1.5'), item.price_usd)
+            self.assertIsNone(item.donor)
+            self.assertEqual(2, PackageDBView.objects.get(pk=pkg.pk).num_items)
+        self.assertEqual(6, ShipmentDBView.objects.get(pk=self.shipment.pk).num_items)
+
+    def test_insert(self):
+        self.check_insert(threshold=1000)
+
+    def test_copy(self):
+        self.check_insert(threshold=1)
@@ -1,9 +1,13 @@
 from decimal import Decimal
 
+from django.core.management import call_command, CommandError
 from django.test import TestCase
+from django.utils.six import StringIO
 from django.utils.timezone import now
 
-from shipments.models import PackageItemDBView, PackageDBView, ShipmentDBView, Shipment
+from shipments.db_views import deferred_stats_updates, find_stats_mismatches, mark_stats_dirty
+from shipments.models import PackageItemDBView, PackageDBView, ShipmentDBView, Shipment, \
+    PackageItem, Package, ShipmentStats
 from shipments.tests.factories import PackageItemFactory, PackageFactory, ShipmentFactory
 
 
@@ -131,3 +135,81 @@ class TestShipmentDBView(TestCase):
         # Now should show no percentage, just the status
         self.assertEqual(2, shipment.num_packages)
         self.assertEqual('Received', shipment.get_verbose_status())
+
+
+class TestStats(TestCase):
+    def setUp(self):
+        super(TestStats, self).setUp()
+        self.shipment = ShipmentFactory()
+        self.package = PackageFactory(shipment=self.shipment)
+        self.item = PackageItemFactory(package=self.package, quantity=2,
+                                       price_usd=Decimal('3.00'), price_local=Decimal('4.00'))
+
+    def assertStats(self, num_packages, num_items, num_received_items, price_usd):
+        shipment = ShipmentDBView.objects.get(pk=self.shipment.pk)
+        self.assertEqual(num_packages, shipment.num_packages)
+        self.assertEqual(num_items, shipment.num_items)
+        self.assertEqual(num_received_items, shipment.num_received_items)
+        self.assertEqual(price_usd, shipment.price_usd)
+        self.assertEqual(([], []), find_stats_mismatches())
+
+    def test_item_changes(self):
+        self.assertStats(1, 2, 0, Decimal('6.0'))
+        PackageItem.objects.filter(pk=self.item.pk).update(quantity=5)
+        self.assertStats(1, 5, 0, Decimal('15.0'))
+        PackageItem.objects.bulk_create([
+            PackageItem(package=self.package, quantity=1, price_usd=Decimal('1.00'))
+        ])
+        self.assertStats(1, 6, 0, Decimal('16.0'))
+        self.item.delete()
+        self.assertStats(1, 1, 0, Decimal('1.0'))
+
+    def test_item_moved_to_another_shipment(self):
+        other = PackageFactory()
+        PackageItem.objects.filter(pk=self.item.pk).update(package=other)
+        self.assertStats(1, 0, 0, Decimal('0'))
+        self.assertEqual(2, PackageDBView.objects.get(pk=other.pk).num_items)
+
+    def test_package_received(self):
+        self.package.status = Shipment.STATUS_RECEIVED
+        self.package.save()
+        self.assertStats(1, 2, 2, Decimal('6.0'))
+        Package.objects.filter(pk=self.package.pk).update(status=Shipment.STATUS_IN_TRANSIT)
+        self.assertStats(1, 2, 0, Decimal('6.0'))
+
+    def test_package_deleted(self):
+        PackageFactory(shipment=self.shipment)
+        self.assertStats(2, 2, 0, Decimal('6.0'))
+        self.package.delete()
+        self.assertStats(1, 0, 0, Decimal('0'))
+
+    def test_deferred_updates(self):
+        with deferred_stats_updates():
+            PackageItem.objects.bulk_create([
+                PackageItem(package=self.package, quantity=1, price_usd=Decimal('1.00'))
+            ])
+            package = PackageFactory(shipment=self.shipment)
+            # The triggers are off until the end of the block
+            self.assertEqual(2, ShipmentStats.objects.get(pk=self.shipment.pk).num_items)
+            mark_stats_dirty([self.package.pk, package.pk], [self.shipment.pk])
+        self.assertStats(2, 3, 0, Decimal('7.0'))
+        # And back on after it
+        self.item.delete()
+        self.assertStats(2, 1, 0, Decimal('1.0'))
+
+    def test_fast_delete(self):
+        other = ShipmentFactory()
+        for i in range(3):
+            package = PackageFactory(shipment=other)
+            PackageItemFactory(package=package)
+            PackageItemFactory(package=package)
+        other.fast_delete(chunk_size=2)
+        self.assertStats(1, 2, 0, Decimal('6.0'))
+
+    def test_command_rebuilds(self):
+        ShipmentStats.objects.filter(pk=self.shipment.pk).update(num_items=99)
+        self.assertEqual(([], [self.shipment.pk]), find_stats_mismatches())
+        with self.assertRaises(CommandError):
+            call_command('rebuild_shipment_stats', verify_only=True, stdout=StringIO())
+        call_command('rebuild_shipment_stats', stdout=StringIO())
+        self.assertStats(1, 2, 0, Decimal('6.0'))
@@ -4,9 +4,10 @@ from django.utils import timezone
 from accounts.models import ROLE_PARTNER
 from accounts.tests.factories import CtsUserFactory
 from catalog.tests.factories import CatalogItemFactory
-from shipments.forms import ShipmentEditForm, PackageEditForm, PackageItemCreateForm
-from shipments.models import Shipment, PackageItem
-from shipments.tests.factories import ShipmentFactory, PackageFactory
+from shipments.forms import ShipmentEditForm, PackageEditForm, PackageItemCreateForm, \
+    create_packages_and_items
+from shipments.models import Shipment, Package, PackageItem
+from shipments.tests.factories import ShipmentFactory, PackageFactory, KitItemFactory
 
 
 class BaseFormTestCase(TestCase):
@@ -203,3 +204,33 @@ class TestPackageItemCreateForm(TestCase):
         self.assertEqual(item.quantity, self.data['quantity'])
         self.assertEqual(item.catalog_item, self.catalog_item)
         self.assertEqual(PackageItem.objects.count(), 1)
+
+
+class CreatePackagesAndItemsTestCase(TestCase):
+    def setUp(self):
+        self.shipment = ShipmentFactory()
+        self.kit_item = KitItemFactory(quantity=2)
+
+    def test_numbers_and_items(self):
+        PackageFactory(shipment=self.shipment)
+        packages = create_packages_and_items(self.shipment, 'name', 'description', 3,
+                                             {self.kit_item.kit: 5})
+        self.assertEqual([2, 3, 4], [pkg.number_in_shipment for pkg in packages])
+        for pkg in packages:
+            self.assertEqual(pkg, Package.objects.get(pk=pkg.pk))
+            item = PackageItem.objects.get(package=pkg)
+            self.assertEqual(10, item.quantity)
+            catalog_item = self.kit_item.catalog_item
+            self.assertEqual(catalog_item, item.catalog_item)
+            self.assertEqual(catalog_item.description, item.description)
+            self.assertEqual(catalog_item.price_usd, item.price_usd)
+            self.assertEqual(catalog_item.item_category, item.item_category)
+
+    def test_stale_shipment_does_not_reset_numbers(self):
+        stale = Shipment.objects.get(pk=self.shipment.pk)
+        create_packages_and_items(self.shipment, 'name', 'description', 2, {})
+        stale.description = 'changed'
+        stale.save()
+        packages = create_packages_and_items(self.shipment, 'name', 'description', 1, {})
+        self.assertEqual(3, packages[0].number_in_shipment)
+        self.assertEqual('changed', Shipment.objects.get(pk=self.shipment.pk).description)
@@ -1,10 +1,18 @@
+from datetime import timedelta
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
-from catalog.tests.factories import CatalogItemFactory
+from mock import patch
+
+from catalog.tests.factories import CatalogItemFactory, DonorFactory
 
-from shipments.models import PackageItem, Shipment, ShipmentDBView, status_as_string
-from shipments.tests.factories import PackageFactory, ShipmentFactory, KitItemFactory
+from shipments.deferred import deferred_shipment_updates, mark_scan_label_dirty
+from shipments.models import Package, PackageItem, Shipment, ShipmentDBView, status_as_string
+from shipments.tests.factories import PackageFactory, ShipmentFactory, KitItemFactory, \
+    PackageScanFactory
 
 
 class TestPackageItem(TestCase):
@@ -121,3 +129,149 @@ class TestShipmentVerboseStatus(TestCase):
             shipment.delete()
         if failed:
             self.fail("Test failed; see previous messages for details")
+
+
+class TestDeferredShipmentUpdates(TestCase):
+    def setUp(self):
+        super(TestDeferredShipmentUpdates, self).setUp()
+        self.package = PackageFactory()
+        self.shipment = self.package.shipment
+        self.catalog_item = CatalogItemFactory(donor=DonorFactory())
+
+    def get_donor(self):
+        return Shipment.objects.get(pk=self.shipment.pk).donor
+
+    def test_donor_updated_immediately_outside_batch(self):
+        PackageItem.from_catalog_item(self.package, self.catalog_item, 1)
+        self.assertEqual(self.catalog_item.donor.name, self.get_donor())
+        PackageItem.from_catalog_item(self.package, CatalogItemFactory(donor=DonorFactory()), 1)
+        self.assertEqual("Multiple", self.get_donor())
+
+    def test_donor_computed_once_per_batch(self):
+        with CaptureQueriesContext(connection) as queries:
+            with deferred_shipment_updates():
+                for i in range(20):
+                    PackageItem.from_catalog_item(self.package, self.catalog_item, 1)
+                self.assertNotEqual(self.catalog_item.donor.name, self.get_donor())
+        donor_queries = [q for q in queries.captured_queries if 'COUNT(DISTINCT' in q['sql']]
+        self.assertEqual(1, len(donor_queries))
+        self.assertEqual(self.catalog_item.donor.name, self.get_donor())
+
+    def test_donor_none(self):
+        self.assertEqual("None", self.shipment.compute_donor_name())
+
+    def test_last_scan_status_label(self):
+        PackageScanFactory(package=self.package, status_label='Older',
+                           when=now() - timedelta(days=1))
+        PackageScanFactory(package=self.package, status_label='Newest')
+        mark_scan_label_dirty([self.shipment.pk])
+        self.assertEqual('Newest',
+                         Shipment.objects.get(pk=self.shipment.pk).last_scan_status_label)
+
+
+class TestApplyStatusTransition(TestCase):
+    def setUp(self):
+        super(TestApplyStatusTransition, self).setUp()
+        self.shipment1 = ShipmentFactory(status=Shipment.STATUS_READY)
+        self.shipment2 = ShipmentFactory(status=Shipment.STATUS_READY)
+        self.packages = [PackageFactory(shipment=self.shipment1) for i in range(3)] + \
+            [PackageFactory(shipment=self.shipment2)]
+
+    def test_packages_and_shipments(self):
+        when = now() - timedelta(days=1)
+        earlier = when - timedelta(days=1)
+        Package.objects.filter(pk=self.packages[0].pk).update(date_picked_up=earlier)
+        Shipment.apply_status_transition([p.pk for p in self.packages], Shipment.STATUS_PICKED_UP,
+                                         when=when, label='Zero point')
+        for pkg in Package.objects.filter(pk__in=[p.pk for p in self.packages]):
+            self.assertEqual(Shipment.STATUS_PICKED_UP, pkg.status)
+            self.assertEqual('Zero point', pkg.last_scan_status_label)
+            expected = earlier if pkg.pk == self.packages[0].pk else when
+            self.assertEqual(expected, pkg.date_picked_up)
+        for shipment in Shipment.objects.filter(pk__in=[self.shipment1.pk, self.shipment2.pk]):
+            self.assertEqual(Shipment.STATUS_PICKED_UP, shipment.status)
+            self.assertEqual('Zero point', shipment.last_scan_status_label)
+            self.assertEqual(when.date(), shipment.date_picked_up)
+
+    def test_number_of_queries_does_not_depend_on_packages(self):
+        with CaptureQueriesContext(connection) as queries:
+            Shipment.apply_status_transition([self.packages[0].pk], Shipment.STATUS_IN_TRANSIT)
+        num_queries = len(queries)
+        with CaptureQueriesContext(connection) as queries:
+            Shipment.apply_status_transition([p.pk for p in self.packages[1:]],
+                                             Shipment.STATUS_IN_TRANSIT)
+        self.assertEqual(num_queries, len(queries))
+
+
+class TestEffectiveStatus(TestCase):
+    def setUp(self):
+        super(TestEffectiveStatus, self).setUp()
+        self.shipment = ShipmentFactory(status=Shipment.STATUS_READY,
+                                        date_expected=now().date() + timedelta(days=2))
+        self.package = PackageFactory(shipment=self.shipment, status=Shipment.STATUS_READY)
+
+    def effective_status(self):
+        return Package.objects.get(pk=self.package.pk).effective_status
+
+    def test_save(self):
+        self.assertEqual(Shipment.STATUS_READY, self.effective_status())
+        self.package.status = Shipment.STATUS_IN_TRANSIT
+        self.package.date_in_transit = now()
+        self.package.save()
+        self.assertEqual(Shipment.STATUS_IN_TRANSIT, self.effective_status())
+
+    def test_expression_matches_get_status(self):
+        date_fields = Shipment.PACKAGE_STATUS_DATE_FIELDS.values()
+        for status in [None] + [status for status, label in Shipment.SHIPMENT_STATUS_CHOICES]:
+            for date_field in [None] + date_fields:
+                dates = dict((name, now() if name == date_field else None)
+                             for name in date_fields)
+                Package.objects.filter(pk=self.package.pk).update(
+                    status=status, effective_status=Package.effective_status_expression(),
+                    **dates)
+                package = Package.objects.get(pk=self.package.pk)
+                self.assertEqual(package.get_status(), package.effective_status)
+
+    def test_apply_status_transition(self):
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_IN_TRANSIT)
+        self.assertEqual(Shipment.STATUS_IN_TRANSIT, self.effective_status())
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_PICKED_UP)
+        # It's been in transit, and that's what get_status() goes by
+        self.assertEqual(Shipment.STATUS_IN_TRANSIT, self.effective_status())
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_RECEIVED)
+        self.assertEqual(Shipment.STATUS_RECEIVED, self.effective_status())
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_LOST)
+        self.assertEqual(Shipment.STATUS_LOST, self.effective_status())
+
+    def test_overdue(self):
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_IN_TRANSIT)
+        self.assertEqual(0, Package.mark_overdue())
+        # Time passes
+        self.assertEqual(1, Package.mark_overdue(today=now().date() + timedelta(days=3)))
+        self.assertEqual(Shipment.STATUS_OVERDUE, self.effective_status())
+        # The shipment is expected later after all
+        self.shipment.date_expected = now().date() + timedelta(days=5)
+        self.shipment.save()
+        self.assertEqual(Shipment.STATUS_IN_TRANSIT, self.effective_status())
+        # Or has been expected for a while
+        self.shipment.date_expected = now().date() - timedelta(days=1)
+        self.shipment.save()
+        self.assertEqual(Shipment.STATUS_OVERDUE, self.effective_status())
+
+    def test_overdue_after_later_transition(self):
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_IN_TRANSIT)
+        Shipment.objects.filter(pk=self.shipment.pk).update(
+            date_expected=now().date() - timedelta(days=1))
+        # Picked up isn't later than in transit, so it's still in transit, and late
+        Shipment.apply_status_transition([self.package.pk], Shipment.STATUS_PICKED_UP)
+        self.assertEqual(Shipment.STATUS_OVERDUE, self.effective_status())
+
+    def test_save_without_changing_date_expected(self):
+        shipment = Shipment.objects.get(pk=self.shipment.pk)
+        shipment.description = 'Something else'
+        with patch.object(Package, 'update_overdue') as update_overdue:
+            shipment.save()
+            self.assertFalse(update_overdue.called)
+            shipment.date_expected += timedelta(days=1)
+            shipment.save()
+            self.assertTrue(update_overdue.called)
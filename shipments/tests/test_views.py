@@ -5,9 +5,10 @@ from io import BytesIO
 
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.forms.models import model_to_dict
 from django.test import TestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 from django.utils.encoding import force_text
 from accounts.models import ROLE_PARTNER
@@ -19,10 +20,11 @@ from catalog.tests.factories import CatalogItemFactory, DonorFactory, \
 from ona.models import FormSubmission
 from ona.representation import PackageScanFormSubmission
 from ona.tests.test_models import PACKAGE_DATA, QR_CODE
-from shipments.models import Shipment, Package, PackageItem
+from shipments.models import Shipment, ShipmentDBView, Package, PackageItem
+from shipments.tasks import delete_shipment, get_delete_progress
 from shipments.views import ShipmentCreateView
 from shipments.tests.factories import ShipmentFactory, PackageFactory, \
-    KitFactory, KitItemFactory, PackageItemFactory
+    KitFactory, KitItemFactory, PackageItemFactory, PackageScanFactory
 
 
 class BaseViewTestCase(TestCase):
@@ -66,6 +68,20 @@ class ShipmentsListViewTest(BaseViewTestCase):
         self.assertTemplateUsed(rsp, 'shipments/list.html')
         self.assertContains(rsp, self.description)
 
+    def test_not_modified(self):
+        url = reverse('shipments_list')
+        etag = self.client.get(url)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            rsp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, rsp.status_code)
+        self.assertEqual('', rsp.content)
+        # Nothing about shipments was looked up
+        self.assertFalse([query for query in queries if 'shipments_' in query['sql']])
+        # Until something changes
+        ShipmentFactory(partner=self.user)
+        rsp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, rsp.status_code)
+
 
 class ShipmentCreateViewTest(BaseViewTestCase):
     def test_get(self):
@@ -282,10 +298,51 @@ class ShipmentDeleteViewTest(BaseViewTestCase):
 
     def test_post(self):
         rsp = self.client.post(self.url)
-        self.assertRedirects(rsp, reverse('shipments_list'))
+        self.assertRedirects(rsp, '%s?deleting=%d' % (reverse('shipments_list'), self.shipment.pk))
         self.assertFalse(Shipment.objects.filter(pk=self.shipment.pk).exists())
         self.assertFalse(Package.objects.filter(pk=self.package.pk).exists())
         self.assertFalse(PackageItem.objects.filter(pk=self.item.pk).exists())
+        self.assertFalse(Shipment.all_objects.filter(pk=self.shipment.pk).exists())
+        self.assertTrue(get_delete_progress(self.shipment.pk)['finished'])
+
+    def test_progress(self):
+        url = reverse('delete_shipment_progress', kwargs={'pk': self.shipment.pk})
+        # Not being deleted
+        self.assertEqual(404, self.client.get(url).status_code)
+        self.shipment.soft_delete()
+        rsp = self.client.get(url)
+        self.assertEqual({'done': 0, 'total': 0, 'finished': False}, json.loads(rsp.content))
+        rsp = self.client.get('%s?deleting=%d' % (reverse('shipments_list'), self.shipment.pk))
+        self.assertContains(rsp, url)
+        delete_shipment(self.shipment.pk)
+        rsp = self.client.get(url)
+        self.assertEqual({'done': 2, 'total': 2, 'finished': True}, json.loads(rsp.content))
+
+    def test_save_after_soft_delete(self):
+        # A copy loaded before the soft delete doesn't bring it back
+        shipment = Shipment.objects.get(pk=self.shipment.pk)
+        self.shipment.soft_delete()
+        shipment.description = 'Changed'
+        shipment.save()
+        self.assertFalse(Shipment.objects.filter(pk=self.shipment.pk).exists())
+
+    def test_soft_delete(self):
+        self.shipment.soft_delete()
+        self.assertFalse(Shipment.objects.filter(pk=self.shipment.pk).exists())
+        self.assertFalse(ShipmentDBView.objects.filter(pk=self.shipment.pk).exists())
+        self.assertTrue(Shipment.all_objects.filter(pk=self.shipment.pk).exists())
+        rsp = self.client.get(reverse('shipments_list'))
+        self.assertNotIn(self.shipment.pk, [s.pk for s in rsp.context['object_list']])
+
+    def test_fast_delete_in_chunks(self):
+        for i in range(4):
+            PackageItemFactory(package=self.package)
+        PackageScanFactory(package=self.package)
+        progress = []
+        self.shipment.fast_delete(chunk_size=2, progress=lambda *args: progress.append(args))
+        self.assertFalse(Shipment.all_objects.filter(pk=self.shipment.pk).exists())
+        self.assertFalse(PackageItem.objects.filter(package=self.package).exists())
+        self.assertEqual((7, 7), progress[-1])
 
     def test_just_partner(self):
         # Partner may not delete a shipment
@@ -866,6 +923,12 @@ class ShipmentPackageMapViewTest(BaseViewTestCase):
         ctx = rsp.context
         self.assertEqual(ctx['package'], self.package)
 
+    def test_effective_status(self):
+        Package.objects.filter(pk=self.package.pk).update(
+            status=Shipment.STATUS_IN_TRANSIT, effective_status=Shipment.STATUS_OVERDUE)
+        rsp = self.client.get(self.url)
+        self.assertContains(rsp, 'Status: Overdue')
+
     def test_get_ajax(self):
         kwargs = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
         rsp = self.client.get(self.url, **kwargs)
@@ -894,3 +957,11 @@ class ShipmentPackagesViewTest(BaseViewTestCase):
         self.just_partner()
         rsp = self.client.get(self.url)
         self.assertEqual(200, rsp.status_code)
+
+    def test_effective_status(self):
+        Shipment.objects.filter(pk=self.shipment.pk).update(status=Shipment.STATUS_IN_TRANSIT)
+        Package.objects.filter(pk=self.package.pk).update(
+            status=Shipment.STATUS_IN_TRANSIT, effective_status=Shipment.STATUS_OVERDUE)
+        rsp = self.client.get(self.url)
+        self.assertContains(rsp, 'Overdue')
+        self.assertNotContains(rsp, 'In transit')
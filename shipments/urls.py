@@ -25,6 +25,8 @@ urlpatterns = patterns(
         views.ShipmentUpdateView.as_view(), name='edit_shipment_no_pk'),
     url(r'^shipment/delete/(?P<pk>\d+)/$',
         views.ShipmentDeleteView.as_view(), name='delete_shipment'),
+    url(r'^shipment/delete/(?P<pk>\d+)/progress/$',
+        views.ShipmentDeleteProgressView.as_view(), name='delete_shipment_progress'),
     url(r'^shipment/lost/(?P<pk>\d+)/$',
         views.ShipmentLostView.as_view(), name='lost_shipment'),
     url(r'^shipment/editlost/(?P<pk>\d+)/$',
@@ -4,14 +4,16 @@ from django.conf import settings
 from django.contrib import messages
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.db.models import Sum
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect, get_object_or_404, render
+from django.utils.decorators import method_decorator
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView, TemplateView, \
     FormView, View
 from django.views.generic.detail import SingleObjectMixin
 from accounts.models import CtsUser, ROLE_PARTNER
 from catalog.models import Donor
 from catalog.views import FormErrorReturns400Mixin
+from cts.conditional import conditional_on_versions
 from cts.utils import DeleteViewMixin, make_form_readonly
 from qrcode import QRCode, ERROR_CORRECT_M, ERROR_CORRECT_Q, ERROR_CORRECT_L
 from shipments.forms import ShipmentEditForm, \
@@ -19,8 +21,11 @@ from shipments.forms import ShipmentEditForm, \
     PackageEditForm, PackageItemEditForm, PackageItemCreateForm, \
     ShipmentLostForm, PackageItemBulkEditForm, PrintForm, PRINT_FORMAT_SUMMARY, PRINT_FORMAT_FULL, \
     PRINT_FORMAT_DETAILS, PRINT_FORMAT_CODES, QRCODE_FORMATS, LABEL_FORMATS
+from reports.models import ShipmentMonthlyData
+from reports.signals import bulk_updates, note_changed_items, note_changed_shipments
+from shipments.deferred import mark_donor_dirty
 from shipments.models import Shipment, ShipmentDBView, PackageDBView, Package, PackageItem, Kit
-from shipments.tasks import delete_shipment
+from shipments.tasks import delete_shipment, get_delete_progress
 
 
 class ShipmentPartnerMixin(object):
@@ -56,6 +61,10 @@ class ShipmentsListView(PermissionRequiredMixin, ShipmentPartnerMixin, ListView)
     model = ShipmentDBView
     template_name = 'shipments/list.html'
 
+    @method_decorator(conditional_on_versions())
+    def get(self, request, *args, **kwargs):
+        return super(ShipmentsListView, self).get(request, *args, **kwargs)
+
     def get_queryset(self):
         # Override so we can prefetch_related
         return self.get_shipment_queryset().prefetch_related('partner')
@@ -63,6 +72,10 @@ class ShipmentsListView(PermissionRequiredMixin, ShipmentPartnerMixin, ListView)
     def get_context_data(self, **kwargs):
         context = super(ShipmentsListView, self).get_context_data(**kwargs)
         context['nav_shipments'] = True
+        # Just deleted this shipment, so show how the delete is going
+        deleting = self.request.GET.get('deleting', '')
+        if deleting.isdigit():
+            context['deleting_shipment_id'] = int(deleting)
         return context
 
 
@@ -216,10 +229,33 @@ class ShipmentDeleteView(PermissionRequiredMixin, FormErrorReturns400Mixin, Dele
 
     def delete(self, request, *args, **kwargs):
         shipment = self.get_object()
+        # Hide it now; the task purges it
+        shipment.soft_delete()
         delete_shipment.delay(shipment.pk)
         messages.info(request, "Shipment will be deleted in the background.  "
                                "It should be gone within a few minutes.")
-        return HttpResponseRedirect(self.success_url)
+        return HttpResponseRedirect('%s?deleting=%d' % (self.success_url, shipment.pk))
+
+
+class ShipmentDeleteProgressView(PermissionRequiredMixin, JSONResponseMixin, View):
+    """
+    How far the delete_shipment task has got with deleting a shipment, for
+    the shipments list to poll after a delete.
+    """
+    permission_required = 'shipments.delete_shipment'
+
+    def get(self, request, *args, **kwargs):
+        pk = int(kwargs['pk'])
+        progress = get_delete_progress(pk)
+        if progress is None:
+            # Either the task hasn't started, or it finished long ago
+            if Shipment.all_objects.filter(pk=pk, deleted=True).exists():
+                progress = {'done': 0, 'total': 0, 'finished': False}
+            elif Shipment.all_objects.filter(pk=pk).exists():
+                raise Http404
+            else:
+                progress = {'done': 0, 'total': 0, 'finished': True}
+        return self.render_json_response(progress)
 
 
 # Ajax
@@ -248,7 +284,7 @@ class NewPackageFromKitModalView(PermissionRequiredMixin, FormErrorReturns400Mix
 
     def form_valid(self, form):
         packages = form.save()
-        num_packages = packages.count()
+        num_packages = len(packages)
         messages.info(self.request, "Created %d package%s" %
                       (num_packages, '' if num_packages == 1 else 's'))
         # Return the PK of the created package for the page to use
@@ -289,7 +325,7 @@ class NewPackageModalView(PermissionRequiredMixin, FormErrorReturns400Mixin, Cre
 
     def form_valid(self, form):
         packages = form.save()
-        num_packages = packages.count()
+        num_packages = len(packages)
         messages.info(self.request, "Created %d package%s" %
                       (num_packages, '' if num_packages == 1 else 's'))
         # This is just a modal, no point in rendering a response
@@ -411,7 +447,14 @@ class PackageItemsBulkEditView(PermissionRequiredMixin, FormErrorReturns400Mixin
 
     def form_valid(self, form):
         kwargs = {k: v for k, v in form.cleaned_data.items() if v}
-        count = PackageItem.objects.filter(pk__in=self.get_selected_item_pks()).update(**kwargs)
+        items = PackageItem.objects.filter(pk__in=self.get_selected_item_pks())
+        with bulk_updates():
+            # Update the report data for the old donors and categories and the new ones
+            note_changed_items(items)
+            count = items.update(**kwargs)
+            note_changed_items(items)
+            if 'donor' in kwargs:
+                mark_donor_dirty(items.values_list('package__shipment_id', flat=True).distinct())
         messages.info(self.request, "Changes saved to %d items" % count)
         return HttpResponse()
 
@@ -535,10 +578,14 @@ class PackageBarcodesView(SummaryManifestView):
     def get(self, request, *args, **kwargs):
         rsp = super(PackageBarcodesView, self).get(request, *args, **kwargs)
         # Mark shipment and packages ready for pickup if they haven't been already
-        Shipment.objects.filter(pk=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
-            .update(status=Shipment.STATUS_READY)
-        Package.objects.filter(shipment_id=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
+        count = Shipment.objects.filter(pk=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
             .update(status=Shipment.STATUS_READY)
+        count += Package.objects\
+            .filter(shipment_id=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
+            .update(status=Shipment.STATUS_READY,
+                    effective_status=Package.effective_status_expression(Shipment.STATUS_READY))
+        if count:
+            note_changed_shipments([self.object.pk])
         return rsp
 
 
@@ -548,10 +595,14 @@ class FullManifestsView(SummaryManifestView):
     def get(self, request, *args, **kwargs):
         rsp = super(FullManifestsView, self).get(request, *args, **kwargs)
         # Mark shipment and packages ready for pickup if they haven't been already
-        Shipment.objects.filter(pk=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
-            .update(status=Shipment.STATUS_READY)
-        Package.objects.filter(shipment_id=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
+        count = Shipment.objects.filter(pk=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
             .update(status=Shipment.STATUS_READY)
+        count += Package.objects\
+            .filter(shipment_id=self.object.pk, status=Shipment.STATUS_IN_PROGRESS)\
+            .update(status=Shipment.STATUS_READY,
+                    effective_status=Package.effective_status_expression(Shipment.STATUS_READY))
+        if count:
+            note_changed_shipments([self.object.pk])
         return rsp
 
 
@@ -577,8 +628,30 @@ class ShipmentsDashboardView(LoginRequiredMixin, JSONResponseMixin, AjaxResponse
             id__in=shipments.values('partner_id')
         )
         value = packages
+        number = shipments.count()
+
+        return packages, items, partners, value, number
+
+    def _monthly_aggregates(self, monthly_data):
+        """
+        The same as _shipments_aggregates(), but from the pre-aggregated
+        monthly report data, which is much quicker than going through every
+        shipment. Only the all_donors rows should be passed.
+        """
+        totals = monthly_data.aggregate(
+            pkg_count=Sum('package_count'),
+            sum_price_usd=Sum('price_usd'),
+            sum_price_local=Sum('price_local'),
+            item_count=Sum('quantity'),
+            number=Sum('shipment_count'))
+        items = {'item_count': totals.pop('item_count')}
+        number = totals.pop('number') or 0
+        partners = CtsUser.objects.filter(
+            id__in=monthly_data.values('partner_id')
+        )
+        value = packages = totals
 
-        return packages, items, partners, value
+        return packages, items, partners, value, number
 
     def get(self, request, *args, **kwargs):
         if request.user.is_just_partner():
@@ -632,12 +705,29 @@ class ShipmentsDashboardView(LoginRequiredMixin, JSONResponseMixin, AjaxResponse
                     }
                     map_data.append(shipment_data)
 
-                # Delivered Shipments
-                d_shipments = shipments.filter(status=Shipment.STATUS_RECEIVED)
-                d_packages, d_items, d_partners, d_value = self._shipments_aggregates(d_shipments)
-                # Undelivered Shipments
-                u_shipments = shipments.exclude(status=Shipment.STATUS_RECEIVED)
-                u_packages, u_items, u_partners, u_value = self._shipments_aggregates(u_shipments)
+                if shipment_filter or donor_filter:
+                    # Delivered Shipments
+                    d_shipments = shipments.filter(status=Shipment.STATUS_RECEIVED)
+                    d_packages, d_items, d_partners, d_value, d_number = \
+                        self._shipments_aggregates(d_shipments)
+                    # Undelivered Shipments
+                    u_shipments = shipments.exclude(status=Shipment.STATUS_RECEIVED)
+                    u_packages, u_items, u_partners, u_value, u_number = \
+                        self._shipments_aggregates(u_shipments)
+                else:
+                    # Whole shipments of all or one partner, which the monthly
+                    # report data has the totals for
+                    monthly_data = ShipmentMonthlyData.objects.filter(all_donors=True)
+                    if request.user.is_just_partner():
+                        monthly_data = monthly_data.filter(partner=request.user)
+                    if partner_filter:
+                        monthly_data = monthly_data.filter(partner_id=partner_filter)
+                    d_packages, d_items, d_partners, d_value, d_number = \
+                        self._monthly_aggregates(
+                            monthly_data.filter(status=Shipment.STATUS_RECEIVED))
+                    u_packages, u_items, u_partners, u_value, u_number = \
+                        self._monthly_aggregates(
+                            monthly_data.exclude(status=Shipment.STATUS_RECEIVED))
 
                 if donor_filter:
                     # get options for dropdowns
@@ -653,14 +743,14 @@ class ShipmentsDashboardView(LoginRequiredMixin, JSONResponseMixin, AjaxResponse
                     'items': d_items,
                     'partners': ', '.join([x.name for x in d_partners.only('name')]) or None,
                     'total_value': d_value,
-                    'number': d_shipments.count()
+                    'number': d_number
                 }
                 data['undelivered'] = {
                     'packages': u_packages,
                     'items': u_items,
                     'partners': ', '.join([x.name for x in u_partners.only('name')]) or None,
                     'total_value': u_value,
-                    'number': u_shipments.count()
+                    'number': u_number
                 }
             return self.render_json_response(data)
 